@@ -1,459 +1,13 @@
 import streamlit as st
-import pandas as pd
-import numpy as np
-from openpyxl import load_workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.styles import PatternFill, Font, Border, Side
-from openpyxl.utils import get_column_letter
-import io
-
-# --- 1. Configuración de Constantes y Nombres ---
-HOJA_ACTUAL = 'Costos ACTUAL'
-HOJA_ANTERIOR = 'Costos ANTERIOR'
-HOJA_PROCESADA = 'Costos_procesado'
-HOJA_CONSOLIDADO = 'Consolidado_Impactos'
-
-COLUMNA_RESULTADO = 'Result'
-CLAVE_MERGE = 'Material'
-NOMBRES_COSTOS_INTERNOS = ['Marteri', 'Materia_Costo', 'Alistam', 'Mano de', 'Maquila', 'Energ', 'Maqui', 'Cif']
-
-# Columnas que deben ser ENTEROS (Redondeo a 0 decimales)
-COLUMNAS_ENTEROS = [
-    'Marteri', 'Materia_Costo', 'Alistam', 'Mano de', 
-    'Maquila', 'Energ', 'Maqui', 'Cif'
-]
-
-# Mapeo de nombres internos a nombres de salida (para encabezados)
-output_cost_names = {
-    'Marteri': 'Marteri', 
-    'Materia_Costo': 'Material d', 
-    'Alistam': 'Alistam', 
-    'Mano de': 'Mano de', 
-    'Maquila': 'Maquila', 
-    'Energ': 'Energ', 
-    'Maqui': 'Maqui', 
-    'Cif': 'Cif'
-}
-
-# Definición del tipo de borde para los bloques de cálculo
-side_medium = Side(border_style='medium', color="000000")
-border_left = Border(left=side_medium)
-border_right = Border(right=side_medium)
-
-# --- FUNCIÓN 1: Aplicar Formato a la Hoja Procesada (AJUSTADA PARA USAR WORKBOOK) ---
-def apply_excel_formatting(wb, sheet_name):
-    try:
-        # --- Configuración de Estilos ---
-        fill_actual_orange = PatternFill(start_color='FCE4D6', end_color='FCE4D6', fill_type='solid')
-        fill_variacion_blue = PatternFill(start_color='DDEBF7', end_color='DDEBF7', fill_type='solid')
-        fill_impacto_green = PatternFill(start_color='E2F0D9', end_color='E2F0D9', fill_type='solid')
-        font_black_bold = Font(color="000000", bold=True)
-        currency_format = '#,##0'
-
-        if sheet_name not in wb.sheetnames:
-            st.warning(f"Advertencia: La hoja '{sheet_name}' no se encontró para aplicar formato.")
-            return
-
-        ws = wb[sheet_name]
-        header = [cell.value for cell in ws[1]]
-        
-        # Mapeo para formateo (Costos y Resultados)
-        cost_cols_names = [f'{c} Actual' for c in NOMBRES_COSTOS_INTERNOS] + [f'{c} Antes' for c in NOMBRES_COSTOS_INTERNOS] + ['Result actualizado', 'Resultado anterior']
-        cost_cols_indices = [idx + 1 for idx, name in enumerate(header) if name in cost_cols_names]
-        
-        # AJUSTE CRÍTICO: Formato de Entero para Columnas Específicas
-        integer_cols_names = [f'{c} Actual' for c in COLUMNAS_ENTEROS] + [f'{c} Antes' for c in COLUMNAS_ENTEROS]
-        integer_cols_indices = [idx + 1 for idx, name in enumerate(header) if name in integer_cols_names]
-        integer_format = '#,##0' # Formato para números enteros
-
-        # Mapeo de columnas para el formateo de bordes
-        first_col_in_block_names = [f'{output_cost_names.get(c, c)} Actual' for c in NOMBRES_COSTOS_INTERNOS]
-        last_col_in_block_names = [f'Impacto {output_cost_names.get(c, c)}' for c in NOMBRES_COSTOS_INTERNOS]
-        
-        first_col_in_block_indices = [idx + 1 for idx, name in enumerate(header) if name in first_col_in_block_names]
-        last_col_in_block_indices = [idx + 1 for idx, name in enumerate(header) if name in last_col_in_block_names]
-
-        # --- Parte 1: Aplicación de Formato de Porcentaje, Moneda y ENTERO ---
-        percentage_cols_names = ['% desv', '% parti', '% Variacion Resultado', 'Suma %Parti', 'Suma Impacto']
-        for costo in NOMBRES_COSTOS_INTERNOS:
-            costo_output = output_cost_names.get(costo, costo)
-            percentage_cols_names.append(f'Impacto {costo_output}')
-
-        percentage_indices = [idx + 1 for idx, name in enumerate(header) if name in percentage_cols_names]
-
-        for col_idx in range(1, len(header) + 1):
-            for row in range(2, ws.max_row + 1):
-                cell = ws.cell(row=row, column=col_idx)
-                if cell.value is not None:
-                    if col_idx in percentage_indices:
-                        cell.number_format = '0.00%'
-                    elif col_idx in integer_cols_indices:
-                        cell.number_format = integer_format # Aplicar formato de entero
-                    elif col_idx in cost_cols_indices:
-                        # Aplicar formato de moneda a los que no son enteros y a los resultados
-                        cell.number_format = currency_format
-
-
-        # --- Parte 2: Aplicación de Negrita y Color a Encabezados (Fila 1) ---
-        for cell in ws[1]:
-            col_name = cell.value
-            
-            if cell.value is not None:
-                cell.font = font_black_bold
-
-            if col_name == '% Variacion Resultado':
-                cell.fill = fill_variacion_blue
-            elif col_name and 'Impacto' in col_name:
-                cell.fill = fill_impacto_green
-            elif col_name and ('Actual' in col_name or col_name == 'Result actualizado'):
-                cell.fill = fill_actual_orange
-        
-        
-        # --- Parte 3: Aplicación de BORDES a TODAS las FILAS ---
-        for col_idx in first_col_in_block_indices:
-            for row_idx in range(1, ws.max_row + 1):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                current_border = cell.border if cell.border else Border()
-                cell.border = Border(left=side_medium, top=current_border.top,  
-                                     bottom=current_border.bottom, right=current_border.right)
-
-        for col_idx in last_col_in_block_indices:
-            for row_idx in range(1, ws.max_row + 1):
-                cell = ws.cell(row=row_idx, column=col_idx)
-                current_border = cell.border if cell.border else Border()
-                cell.border = Border(right=side_medium, top=current_border.top,  
-                                     bottom=current_border.bottom, left=current_border.left)
-        
-        
-
-    except Exception as e:
-        st.error(f"❌ Error al aplicar el formato de Excel con openpyxl: {e}")
-
-
-# --- FUNCIÓN 2: Aplicar Fórmulas Dinámicas al Consolidado (AJUSTADA Y CORREGIDA) ---
-def apply_consolidation_formulas(wb, processed_sheet_name, consolidated_sheet_name, df_output_headers, df_consolidado_headers):
-    """
-    Remplaza los valores estáticos en la hoja consolidada con fórmulas 
-    de Excel que referencian a la hoja procesada, asegurando el formato de porcentaje.
-    """
-    try:
-        
-        if consolidated_sheet_name not in wb.sheetnames:
-            st.warning(f"Advertencia: La hoja '{consolidated_sheet_name}' no se encontró para aplicar fórmulas.")
-            return
-            
-        ws_consolidado = wb[consolidated_sheet_name]
-        
-        # 1. Mapear la posición de cada columna de salida en la hoja de origen
-        header_map = {col_name: idx + 1 for idx, col_name in enumerate(df_output_headers)}
-        
-        # 2. Definir formato de porcentaje y moneda para el Consolidado
-        currency_format = '#,##0'
-        percentage_format = '0.00%'
-        font_black_bold = Font(color="000000", bold=True)
-        fill_impacto_green = PatternFill(start_color='E2F0D9', end_color='E2F0D9', fill_type='solid')
-        fill_variacion_blue = PatternFill(start_color='DDEBF7', end_color='DDEBF7', fill_type='solid')
-        
-        # 3. Aplicar formato y fórmulas celda por celda
-        for col_idx_con, col_name_con in enumerate(df_consolidado_headers):
-            
-            # Obtener el índice de la columna en la hoja de origen (df_output)
-            col_name_source = col_name_con 
-            source_col_idx = header_map.get(col_name_source)
-            
-            if source_col_idx is None:
-                st.warning(f"Advertencia: Columna '{col_name_source}' no encontrada en la hoja origen. Se saltará.")
-                continue
-
-            source_col_letter = get_column_letter(source_col_idx)
-            
-            # Aplicar formato de encabezado (negrita y color)
-            header_cell = ws_consolidado.cell(row=1, column=col_idx_con + 1)
-            header_cell.font = font_black_bold
-            if 'Impacto' in col_name_con:
-                header_cell.fill = fill_impacto_green
-            elif col_name_con == '% Variacion Resultado':
-                header_cell.fill = fill_variacion_blue
-            
-            # Recorrer todas las filas de datos (empezando desde la fila 2)
-            for row_idx in range(2, ws_consolidado.max_row + 1):
-                cell = ws_consolidado.cell(row=row_idx, column=col_idx_con + 1)
-                
-                # Crear la fórmula de vinculación
-                formula = f"='{processed_sheet_name}'!{source_col_letter}{row_idx}"
-                cell.value = formula
-                
-                # Aplicar formato de número
-                # Priorizamos las columnas de porcentaje/impacto para evitar conflictos de formato.
-                if col_name_con == '% Variacion Resultado' or 'Impacto' in col_name_con:
-                    cell.number_format = percentage_format
-                elif 'Result' in col_name_con:
-                    cell.number_format = currency_format
-                    
-
-    except Exception as e:
-        st.error(f"❌ Error al aplicar las fórmulas de Excel con openpyxl: {e}")
-        return
-
-# --- FUNCIÓN 3: Escritura y Formateo de la Hoja Procesada con Fórmulas
-
-def write_processed_sheet_with_formulas(wb, sheet_name, df_data, cost_names_internal, output_cost_names, initial_cols):
-
-    try:
-        
-        # 1. Determinar la posición (índice) de la hoja procesada
-        index = 0
-        if sheet_name in wb.sheetnames:
-            # Obtener el índice actual de la hoja para recrearla en la misma posición
-            sheet_names_list = wb.sheetnames
-            index = sheet_names_list.index(sheet_name)
-            del wb[sheet_name]
-        
-        # Crear la hoja en su posición original
-        ws = wb.create_sheet(sheet_name, index=index)
-
-        # 2. Definir el encabezado final y mapeo de columnas
-        header = initial_cols[:]
-        for costo in cost_names_internal:
-            costo_output = output_cost_names.get(costo, costo)
-            header.extend([
-                f'{costo_output} Actual',
-                f'{costo_output} Antes',
-                '% desv',
-                '% parti',
-                f'Impacto {costo_output}'
-            ])
-        header.extend(['Result actualizado', 'Resultado anterior', '% Variacion Resultado', 'Suma %Parti', 'Suma Impacto'])
-        
-        # Escribir el encabezado (Fila 1)
-        ws.append(header)
-        
-        # Crear el mapeo de columnas para las fórmulas
-        col_map = {name: get_column_letter(idx + 1) for idx, name in enumerate(header)}
-        
-        # Mapear las columnas de resultados a sus letras de columna
-        result_actual_letter = col_map['Result actualizado']
-        result_antes_letter = col_map['Resultado anterior']
-        
-        # 3. Iterar sobre las filas de datos de pandas e insertar valores/fórmulas
-        for row_idx, row in df_data.iterrows():
-            excel_row_num = row_idx + 2 # Fila de Excel: 1 (Encabezado) + 1 (Index 0 de Pandas)
-            
-            current_col_index = 0 # Inicia en la columna 1 (A)
-            
-            current_parti_cols = []
-            current_impacto_cols = []
-            
-            # --- Bloque Inicial de Columnas (Datos Estáticos) ---
-            for col in initial_cols:
-                current_col_index += 1
-                # Escribir el valor tal cual
-                ws.cell(row=excel_row_num, column=current_col_index, value=row[col])
-
-            # --- Bloque de Costos (Valores y Fórmulas) ---
-            for costo_interno in cost_names_internal:
-                
-                # Columna 'Actual' (Valor estático)
-                current_col_index += 1
-                col_actual = get_column_letter(current_col_index)
-                ws.cell(row=excel_row_num, column=current_col_index, value=row[f'{costo_interno} Actual'])
-                
-                # Columna 'Antes' (Valor estático)
-                current_col_index += 1
-                col_antes = get_column_letter(current_col_index)
-                ws.cell(row=excel_row_num, column=current_col_index, value=row[f'{costo_interno} Antes'])
-                
-                # Columna '% desv' (Fórmula)
-                current_col_index += 1
-                cell = ws.cell(row=excel_row_num, column=current_col_index)
-                col_desv = get_column_letter(current_col_index)
-                # Asegurar el signo de igualdad (=)
-                formula_desv = f"=IFERROR(ROUND(({col_actual}{excel_row_num}-{col_antes}{excel_row_num})/{col_antes}{excel_row_num}, 4), 0)"
-                cell.value = formula_desv
-                
-                # Columna '% parti' (Fórmula)
-                current_col_index += 1
-                cell = ws.cell(row=excel_row_num, column=current_col_index)
-                col_parti = get_column_letter(current_col_index)
-                # Asegurar el signo de igualdad (=)
-                formula_parti = f"=IFERROR(ROUND({col_actual}{excel_row_num}/{result_actual_letter}{excel_row_num}, 4), 0)"
-                cell.value = formula_parti
-                current_parti_cols.append(f"{col_parti}{excel_row_num}")
-
-                # Columna 'Impacto' (Fórmula)
-                current_col_index += 1
-                cell = ws.cell(row=excel_row_num, column=current_col_index)
-                col_impacto = get_column_letter(current_col_index)
-                # Asegurar el signo de igualdad (=)
-                formula_impacto = f"=ROUND({col_desv}{excel_row_num}*{col_parti}{excel_row_num}, 4)"
-                cell.value = formula_impacto
-                current_impacto_cols.append(f"{col_impacto}{excel_row_num}")
-                
-            # --- Bloque de Resultados (Valores y Fórmulas) ---
-            
-            # Result actualizado (Valor estático)
-            current_col_index += 1
-            ws.cell(row=excel_row_num, column=current_col_index, value=row['Result actualizado'])
-            
-            # Resultado anterior (Valor estático)
-            current_col_index += 1
-            ws.cell(row=excel_row_num, column=current_col_index, value=row['Resultado anterior'])
-            
-            # % Variacion Resultado (Fórmula)
-            current_col_index += 1
-            cell = ws.cell(row=excel_row_num, column=current_col_index)
-            # Asegurar el signo de igualdad (=)
-            formula_var_res = f"=IFERROR(ROUND(({result_actual_letter}{excel_row_num}-{result_antes_letter}{excel_row_num})/{result_antes_letter}{excel_row_num}, 4), 0)"
-            cell.value = formula_var_res
-            
-            # Suma %Parti (Fórmula)
-            current_col_index += 1
-            cell = ws.cell(row=excel_row_num, column=current_col_index)
-            # Asegurar el signo de igualdad (=)
-            formula_suma_parti = f"=ROUND(SUM({'+'.join(current_parti_cols)}), 4)"
-            cell.value = formula_suma_parti
-            
-            # Suma Impacto (Fórmula)
-            current_col_index += 1
-            cell = ws.cell(row=excel_row_num, column=current_col_index)
-            # Asegurar el signo de igualdad (=)
-            formula_suma_impacto = f"=ROUND(SUM({'+'.join(current_impacto_cols)}), 4)"
-            cell.value = formula_suma_impacto
-            
-        return header # Retornar el encabezado final para el mapeo del Consolidado
-        
-    except Exception as e:
-        st.error(f"❌ Error al escribir la hoja procesada con fórmulas: {e}")
-        return []
-
-# --- FUNCIÓN PRINCIPAL DE PROCESAMIENTO ---
-def process_excel_data(uploaded_file):
-    
-    # 1. Carga del archivo a un objeto BytesIO y a DataFrames de pandas
-    try:
-        excel_data = uploaded_file.read()
-        
-        df_actual = pd.read_excel(excel_data, sheet_name=HOJA_ACTUAL, header=0)
-        df_anterior = pd.read_excel(excel_data, sheet_name=HOJA_ANTERIOR, header=0)
-        
-    except Exception as e:
-        st.error(f"❌ ERROR al cargar las hojas de Excel: Asegúrese de que existen las hojas '{HOJA_ACTUAL}' y '{HOJA_ANTERIOR}'. Error: {e}")
-        return None, None
-
-    # --- Asignar nombres únicos para manejo interno (Materia vs Material) ---
-    column_names_for_df = list(df_actual.columns)
-    column_names_for_df = [('Materia_Costo' if col == 'Materia' else col) for col in column_names_for_df]
-    
-    df_actual.columns = column_names_for_df
-    df_anterior.columns = column_names_for_df
-    
-    # --- 3. Preparación de columnas para la combinación ---
-    df_actual = df_actual.rename(columns={COLUMNA_RESULTADO: 'Result actualizado'})
-    df_anterior = df_anterior.rename(columns={COLUMNA_RESULTADO: 'Resultado anterior'})
-    
-    rename_actual = {col: f'{col} Actual' for col in NOMBRES_COSTOS_INTERNOS}
-    rename_anterior = {col: f'{col} Antes' for col in NOMBRES_COSTOS_INTERNOS}
-    
-    df_actual_renamed = df_actual.rename(columns=rename_actual).copy()
-    df_anterior_renamed = df_anterior.rename(columns=rename_anterior).copy()
-    
-    cols_to_keep_anterior = [CLAVE_MERGE, 'Resultado anterior'] + list(rename_anterior.values())
-    df_anterior_slim = df_anterior_renamed[cols_to_keep_anterior]
-    
-    # --- 4. Combinación (Merge) ---
-    df_procesado = pd.merge(df_actual_renamed, df_anterior_slim, on=CLAVE_MERGE, how='left')
-    
-    # --- 5. Preparación de datos y columnas a mantener (Aplicación de redondeo) ---
-    cols_to_keep = ['Versi', 'Ce.', CLAVE_MERGE, 'Texto breve material', 'Pr', 'UMB', 'Válido de', 'Tam.lot', 'Costo d', 'Result actualizado', 'Resultado anterior']
-    
-    for costo in NOMBRES_COSTOS_INTERNOS:
-        cols_to_keep.append(f'{costo} Actual')
-        cols_to_keep.append(f'{costo} Antes')
-    
-    df_input_for_excel = df_procesado[cols_to_keep].copy()
-    
-    # Convertir columnas numéricas que se usarán en fórmulas (asegurar el tipo)
-    cols_numeric = [f'{c} Actual' for c in NOMBRES_COSTOS_INTERNOS] + [f'{c} Antes' for c in NOMBRES_COSTOS_INTERNOS] + ['Result actualizado', 'Resultado anterior']
-    
-    # APLICACIÓN DE REDONDEO SOLICITADO
-    cols_integer_actual = [f'{c} Actual' for c in COLUMNAS_ENTEROS]
-    cols_integer_antes = [f'{c} Antes' for c in COLUMNAS_ENTEROS]
-    
-    for col in cols_numeric:
-        col_series = pd.to_numeric(df_input_for_excel[col], errors='coerce')
-        if col in cols_integer_actual or col in cols_integer_antes:
-            # Redondeo a 0 decimales (Entero)
-            df_input_for_excel[col] = col_series.round(0).fillna(0).astype(int) 
-        else:
-            # Redondeo a 2 decimales para los demás (manteniendo la lógica original)
-            df_input_for_excel[col] = col_series.round(2)
-            
-    # -------------------------------------------------------------------------------------
-    # --- 6. Guardar y Formatear las hojas en un objeto de memoria ---
-    # -------------------------------------------------------------------------------------
-    
-    output_file = io.BytesIO()
-    
-    try:
-        # Cargamos el archivo original en el Workbook de openpyxl
-        wb = load_workbook(io.BytesIO(excel_data))
-        
-        initial_cols = ['Versi', 'Ce.', CLAVE_MERGE, 'Texto breve material', 'Pr', 'UMB', 'Válido de', 'Tam.lot', 'Costo d']
-        
-        # 6.1 Escritura de la Hoja PROCESADA con FÓRMULAS
-        df_output_headers = write_processed_sheet_with_formulas(wb, HOJA_PROCESADA, df_input_for_excel, NOMBRES_COSTOS_INTERNOS, output_cost_names, initial_cols)
-        
-        if not df_output_headers:
-            st.error("\nEl script se detuvo debido a un error al escribir la hoja procesada.")
-            return None, None
-            
-        
-        
-        # 6.2 Aplicar formato a la hoja de PROCESADO
-        apply_excel_formatting(wb, HOJA_PROCESADA)
-
-        # -------------------------------------------------------------------------------------
-        # --- 6.5. PREPARACIÓN Y ESCRITURA DEL CONSOLIDADO 
-        # -------------------------------------------------------------------------------------
-        
-        cols_consolidado = [CLAVE_MERGE, 'Texto breve material', 'Result actualizado', 'Resultado anterior', '% Variacion Resultado']
-        
-        for costo_interno in NOMBRES_COSTOS_INTERNOS:
-            costo_output = output_cost_names.get(costo_interno, costo_interno)
-            cols_consolidado.append(f'Impacto {costo_output}')
-        
-        df_consolidado_headers = cols_consolidado 
-        
-        # Guardar la hoja Consolidado con el tamaño correcto usando openpyxl
-        num_rows = len(df_input_for_excel)
-        
-        index_consolidado = 0
-        if HOJA_CONSOLIDADO in wb.sheetnames:
-            index_consolidado = wb.sheetnames.index(HOJA_CONSOLIDADO)
-            del wb[HOJA_CONSOLIDADO]
-            
-        ws_consolidado = wb.create_sheet(HOJA_CONSOLIDADO, index=index_consolidado)
-        
-        # Escribir el encabezado
-        ws_consolidado.append(df_consolidado_headers)
-        # Llenar con celdas dummy (el contenido será reemplazado por fórmulas)
-        for _ in range(num_rows):
-            ws_consolidado.append([0] * len(df_consolidado_headers))
-
-        
-        # 6.3 Aplicar FÓRMULAS VINCULANTES y formato a la hoja de CONSOLIDADO
-        apply_consolidation_formulas(wb, HOJA_PROCESADA, HOJA_CONSOLIDADO, df_output_headers, df_consolidado_headers)
-
-        # Guardar el libro de trabajo en el buffer de memoria
-        wb.save(output_file)
-        
-        st.success("\n¡El script ha terminado exitosamente! Las hojas ahora contienen fórmulas Excel y el orden original se ha mantenido.")
-        
-        return output_file, uploaded_file.name.replace(".xlsx", "_PROCESADO.xlsx")
-
-    except Exception as e:
-        st.error(f"❌ Ocurrió un error inesperado durante el procesamiento final: {e}")
-        return None, None
+import json
+import logging
+import os
+# Solo constantes (biblioteca estándar): el motor, con pandas, NumPy y openpyxl, se importa en get_engine
+from constantes_costos import (
+    COLUMNA_AGRUPACION, COLUMNA_VALOR, COLUMNAS_AGRUPACION, COLUMNAS_IMPACTO_RESUMEN, DESCRIPCION_ETAPAS, DUPLICADOS_ERROR, DUPLICADOS_PRIMERO, DUPLICADOS_SUMA, DUPLICADOS_ULTIMO, EXITO, FORMATO_PARQUET, FORMATO_XLSX,
+    HOJA_ACTUAL, HOJA_ANTERIOR, HOJA_TENDENCIA, MAX_TRABAJOS_SIMULTANEOS, MODO_FORMULAS, MODO_FORMULAS_CACHE, MODO_VALORES, TAREA_BLOQUES,
+    TAREA_PROCESAR, TAREA_TENDENCIA, TRABAJO_EN_COLA, TRABAJO_EN_CURSO, TRABAJO_TERMINADO, file_format
+)
 
 # --- Interfaz de Streamlit ---
 st.set_page_config(
@@ -468,46 +22,278 @@ st.markdown("---")
 st.info("""
     Este programa lee las hojas **'Costos Mqlla H5 ACTUAL'** y **'Costos Mqlla H5 ANTERIOR'** del archivo Excel cargado.
 
-    Realiza el cálculo de desvío, participación e impacto entre los costos, y genera dos hojas de salida:
+    Realiza el cálculo de desvío, participación e impacto entre los costos, y genera tres hojas de salida:
     1.  **'Costos_procesado'**: Con todos los detalles y valores estáticos para los campos establecidos
     2.  **'Consolidado_Impactos'**: Resumen con los resultados finales.
+    3.  **'Resumen_Impactos'**: Impactos agrupados por planta, versión y Pr.
 
     ⚠️ **Importante**: Asegúrese de que las hojas de origen y destino existan en el archivo original.
 """)
 
-uploaded_file = st.file_uploader(
-    "📤 Seleccione el archivo Excel de Costos:",
-    type=["xlsx"],
-    accept_multiple_files=False
-)
+@st.cache_resource(show_spinner="Cargando el motor de procesamiento...")
+def get_engine():
+    """
+    Módulo procesamiento_costos, importado una sola vez por proceso y recién cuando se necesita
+    (al encolar el primer trabajo): abrir la página no carga pandas, NumPy ni openpyxl.
+    """
+    import procesamiento_costos
+    return procesamiento_costos
 
-if uploaded_file is not None:
-    st.success(f"Archivo cargado: **{uploaded_file.name}**")
-    
-    if st.button("🚀 Iniciar Procesamiento y Formateo"):
-        with st.spinner("Procesando datos, generando fórmulas y aplicando formato..."):
-            output_buffer, output_filename = process_excel_data(uploaded_file)
-        
-        st.markdown("---")
 
-        if output_buffer:
+@st.cache_resource
+def get_result_cache():
+    """
+    Caché de resultados compartida por todas las sesiones y por los procesos de la cola de trabajos: en
+    CACHE_DIR_COSTOS si se define (sobrevive a reinicios) o en un directorio temporal de la cola.
+    """
+    return get_engine().ResultCache(directorio=os.environ.get('CACHE_DIR_COSTOS'))
+
+
+@st.cache_resource
+def get_job_queue():
+    """Cola de trabajos compartida por todas las sesiones: como máximo TRABAJOS_COSTOS procesamientos a la vez."""
+    return get_engine().JobQueue(int(os.environ.get('TRABAJOS_COSTOS', MAX_TRABAJOS_SIMULTANEOS)), cache=get_result_cache())
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def period_sheet_names(datos):
+    """Hojas del libro cargado; se leen una sola vez por archivo y no en cada recarga de la página."""
+    return get_engine().workbook_sheet_names(datos)
+
+
+def show_message(nivel, texto):
+    """Muestra en la página un mensaje del procesamiento según su nivel."""
+    if nivel >= logging.ERROR:
+        st.error(texto)
+    elif nivel >= logging.WARNING:
+        st.warning(texto)
+    elif nivel >= EXITO:
+        st.success(texto)
+    else:
+        st.info(texto)
+
+
+def submit_job(tarea, descripcion, **argumentos):
+    """Encola el trabajo y lo agrega a los de la sesión; avisa si la cola está llena."""
+    job_id = get_job_queue().submit(tarea, descripcion, **argumentos)
+    if job_id is None:
+        st.warning("⏳ Hay demasiados trabajos en espera en el servidor. Intente de nuevo en unos minutos.")
+        return
+    st.session_state.setdefault("trabajos", []).append(job_id)
+    st.success(f"Trabajo #{job_id} en cola: **{descripcion}**. Puede seguir su avance en **Trabajos en segundo plano**.")
+
+
+def discard_job(job_id):
+    get_job_queue().discard(job_id)
+    st.session_state["trabajos"].remove(job_id)
+
+
+def show_impact_summary(resumen):
+    """Resumen de impactos por planta, versión y Pr, una pestaña por agrupación."""
+    formatos = {col: "{:.2%}" for col in ["% Variacion Resultado"] + COLUMNAS_IMPACTO_RESUMEN}
+    formatos.update({col: "{:,.0f}" for col in ["Materiales", "Result actualizado", "Resultado anterior"]})
+    with st.expander("📊 Resumen de impactos", expanded=True):
+        for pestaña, agrupacion in zip(st.tabs(COLUMNAS_AGRUPACION), COLUMNAS_AGRUPACION):
+            with pestaña:
+                tabla = resumen[resumen[COLUMNA_AGRUPACION] == agrupacion].drop(columns=COLUMNA_AGRUPACION)
+                # Los valores de una columna de agrupación pueden mezclar textos y números
+                tabla = tabla.astype({COLUMNA_VALOR: str})
+                st.dataframe(tabla.style.format(formatos, na_rep=""), hide_index=True, use_container_width=True)
+
+
+@st.fragment(run_every=1.0)
+def show_pending_jobs(job_ids):
+    """
+    Trabajos en cola o en curso; se actualizan cada segundo sin recargar la página. Cuando alguno
+    termina (o se cancela) se recarga la página entera: los terminados se dibujan fuera de esta
+    actualización periódica, así su resultado no se vuelve a enviar cada segundo.
+    """
+    cola = get_job_queue()
+    for job_id in job_ids:
+        trabajo = cola.status(job_id)
+        if trabajo is None or trabajo['estado'] not in (TRABAJO_EN_COLA, TRABAJO_EN_CURSO):
+            st.rerun()
+
+        with st.container(border=True):
+            st.markdown(f"**#{job_id} · {trabajo['descripcion']}**")
+            if trabajo['estado'] == TRABAJO_EN_COLA:
+                st.info(f"⏳ En espera ({cola.position(job_id)} trabajos antes).")
+                st.button("Cancelar", key=f"descartar_{job_id}", on_click=discard_job, args=(job_id,))
+            else:
+                st.progress(trabajo['avance'], text=DESCRIPCION_ETAPAS.get(trabajo['etapa'], "Iniciando...") + "...")
+
+
+def show_finished_job(cola, job_id, trabajo):
+    """Mensajes, medición, resumen y descarga de un trabajo terminado o fallido."""
+    with st.container(border=True):
+        st.markdown(f"**#{job_id} · {trabajo['descripcion']}**")
+        for nivel, texto in trabajo['mensajes']:
+            show_message(nivel, texto)
+
+        if trabajo['perfil'] and trabajo['perfil']['etapas']:
+            with st.expander("⏱️ Tiempo y memoria por etapa"):
+                st.dataframe(trabajo['perfil']['etapas'], use_container_width=True)
+                st.download_button(
+                    label="Descargar medición (JSON)",
+                    data=json.dumps(trabajo['perfil'], ensure_ascii=False, indent=2),
+                    file_name=os.path.splitext(trabajo['nombre_salida'] or f"trabajo_{job_id}")[0] + "_medicion.json",
+                    mime="application/json",
+                    key=f"medicion_{job_id}",
+                    on_click="ignore"
+                )
+
+        if trabajo['resumen'] is not None and not trabajo['resumen'].empty:
+            show_impact_summary(trabajo['resumen'])
+
+        resultado = cola.result(job_id) if trabajo['estado'] == TRABAJO_TERMINADO else None
+        if resultado is not None:
+            es_parquet = trabajo['nombre_salida'].endswith(".parquet")
             st.download_button(
-                label="📥 Descargar Archivo Excel Procesado",
-                data=output_buffer.getvalue(),
-                file_name=output_filename,
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                label="📥 Descargar Resultado (Parquet)" if es_parquet else "📥 Descargar Archivo Excel Procesado",
+                data=resultado,
+                file_name=trabajo['nombre_salida'],
+                mime="application/vnd.apache.parquet" if es_parquet else "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                key=f"resultado_{job_id}",
+                on_click="ignore"
             )
-        
+        elif trabajo['estado'] == TRABAJO_TERMINADO:
+            st.warning("El resultado ya no está disponible en el servidor. Vuelva a procesar el archivo.")
         else:
-
             st.error("El procesamiento falló. Revise los mensajes de error anteriores.")
+        st.button("Descartar", key=f"descartar_{job_id}", on_click=discard_job, args=(job_id,))
+
+
+def show_jobs():
+    """Trabajos de la sesión: solo los pendientes se actualizan cada segundo; los terminados se dibujan una vez por recarga."""
+    cola = get_job_queue()
+    pendientes, terminados = [], []
+    for job_id in list(st.session_state.get("trabajos", [])):
+        trabajo = cola.status(job_id)
+        if trabajo is None:
+            # Descartado por los topes de trabajos terminados del servidor
+            st.session_state["trabajos"].remove(job_id)
+        elif trabajo['estado'] in (TRABAJO_EN_COLA, TRABAJO_EN_CURSO):
+            pendientes.append(job_id)
+        else:
+            terminados.append((job_id, trabajo))
 
+    if pendientes:
+        show_pending_jobs(pendientes)
+    for job_id, trabajo in terminados:
+        show_finished_job(cola, job_id, trabajo)
 
 
+uploaded_file = st.file_uploader(
+    "📤 Seleccione el archivo Excel de Costos (o la tabla ACTUAL en Parquet, Feather o CSV):",
+    type=["xlsx", "parquet", "feather", "csv"],
+    accept_multiple_files=False
+)
 
+# Con una tabla columnar, el período anterior se carga como un segundo archivo del mismo formato
+previous_file = None
+if uploaded_file is not None and file_format(uploaded_file.name) != FORMATO_XLSX:
+    previous_file = st.file_uploader(
+        f"📤 Seleccione la tabla del período anterior ('{HOJA_ANTERIOR}'):",
+        type=["parquet", "feather", "csv"],
+        accept_multiple_files=False,
+        key="tabla_anterior"
+    )
+
+# Contenido de las columnas calculadas (% desv, % parti, Impacto, etc.)
+MODOS_SALIDA = {
+    "Fórmulas Excel (se calculan al abrir en Excel)": MODO_FORMULAS,
+    "Fórmulas con valores ya calculados": MODO_FORMULAS_CACHE,
+    "Solo valores estáticos": MODO_VALORES,
+}
+modo_salida = st.radio("🧮 Columnas calculadas:", list(MODOS_SALIDA))
+
+# Qué hacer si un material aparece más de una vez en la hoja ANTERIOR
+CRITERIOS_DUPLICADOS = {
+    "Usar la primera fila (como BUSCARV)": DUPLICADOS_PRIMERO,
+    "Usar la última fila": DUPLICADOS_ULTIMO,
+    "Sumar las filas repetidas": DUPLICADOS_SUMA,
+    "Detener el procesamiento": DUPLICADOS_ERROR,
+}
+criterio_duplicados = st.selectbox("🔁 Materiales repetidos en el período anterior:", list(CRITERIOS_DUPLICADOS))
 
+# Parquet: solo el resultado combinado con las métricas calculadas, sin generar el libro de Excel
+FORMATOS_SALIDA = {
+    "Libro de Excel": FORMATO_XLSX,
+    "Tabla Parquet (sin libro de Excel)": FORMATO_PARQUET,
+}
+formato_salida = st.radio("💾 Formato de salida:", list(FORMATOS_SALIDA), horizontal=True)
+
+# Libros muy grandes: se leen y escriben por bloques de filas, sin cargar el libro entero en memoria
+bloques_disponible = FORMATOS_SALIDA[formato_salida] == FORMATO_XLSX and (uploaded_file is None or file_format(uploaded_file.name) == FORMATO_XLSX)
+por_bloques = st.checkbox(
+    "🧱 Procesar por bloques (libros muy grandes)",
+    disabled=not bloques_disponible,
+    help="Solo para libros de Excel con salida Excel. No usa la caché de resultados."
+) and bloques_disponible
+
+# Re-procesar un libro corregido: solo se reescriben las filas nuevas o modificadas desde la última corrida del mismo archivo
+incremental_disponible = FORMATOS_SALIDA[formato_salida] == FORMATO_XLSX and not por_bloques
+incremental = st.checkbox(
+    "♻️ Reescribir solo los materiales nuevos o modificados",
+    disabled=not incremental_disponible,
+    help="Busca cada material en la última corrida del archivo con el mismo nombre y modo de salida; los que no cambiaron se copian aunque hayan cambiado de fila. Solo para salida Excel sin bloques."
+) and incremental_disponible
+
+# Medición más detallada para investigar el consumo de memoria de un libro
+trazar_memoria = st.checkbox(
+    "🔬 Medir la memoria de Python de cada etapa",
+    help="Agrega el pico de memoria de Python (tracemalloc) a la medición por etapa. Hace el procesamiento bastante más lento."
+)
 
+if uploaded_file is not None:
+    st.success(f"Archivo cargado: **{uploaded_file.name}**")
+    
+    # El procesamiento corre en segundo plano: la página sigue disponible y el resultado se descarga al terminar
+    if st.button("🚀 Iniciar Procesamiento y Formateo"):
+        if por_bloques:
+            submit_job(TAREA_BLOQUES, f"{uploaded_file.name} (por bloques)", datos=uploaded_file.getvalue(), nombre=uploaded_file.name,
+                       output_mode=MODOS_SALIDA[modo_salida], duplicate_policy=CRITERIOS_DUPLICADOS[criterio_duplicados], trace_memory=trazar_memoria)
+        else:
+            submit_job(TAREA_PROCESAR, uploaded_file.name, datos=uploaded_file.getvalue(), nombre=uploaded_file.name,
+                       output_mode=MODOS_SALIDA[modo_salida], duplicate_policy=CRITERIOS_DUPLICADOS[criterio_duplicados],
+                       previous_data=previous_file.getvalue() if previous_file is not None else None,
+                       previous_name=previous_file.name if previous_file is not None else None,
+                       output_format=FORMATOS_SALIDA[formato_salida], incremental=incremental, trace_memory=trazar_memoria)
 
 
+# --- Tendencia de varios períodos ---
+st.markdown("---")
+st.subheader("📈 Tendencia de varios períodos")
+st.markdown(f"""
+    Cargue **varios archivos** (se usa la hoja **'{HOJA_ACTUAL}'** de cada uno, ordenados por nombre) o **un solo archivo**
+    y elija sus hojas de período en orden cronológico. Se genera la hoja **'{HOJA_TENDENCIA}'** con el desvío, la
+    participación y el impacto de cada material respecto del período anterior.
+""")
 
+archivos_periodo = st.file_uploader(
+    "📤 Seleccione los archivos de los períodos:",
+    type=["xlsx"],
+    accept_multiple_files=True,
+    key="archivos_periodo"
+)
 
+if archivos_periodo:
+    archivos_periodo = sorted(archivos_periodo, key=lambda archivo: archivo.name)
+    hojas_periodo = None
+    if len(archivos_periodo) == 1:
+        hojas_periodo = st.multiselect(
+            "🗂️ Hojas de período (en orden cronológico):",
+            period_sheet_names(archivos_periodo[0].getvalue())
+        )
+
+    if st.button("📈 Calcular Tendencia"):
+        submit_job(TAREA_TENDENCIA, f"Tendencia de {len(hojas_periodo) if hojas_periodo is not None else len(archivos_periodo)} períodos",
+                   archivos=[(archivo.name, archivo.getvalue()) for archivo in archivos_periodo], hojas=hojas_periodo,
+                   duplicate_policy=CRITERIOS_DUPLICADOS[criterio_duplicados], trace_memory=trazar_memoria)
+
+
+# --- Trabajos de la sesión (al final: incluye los que se acaban de encolar) ---
+if st.session_state.get("trabajos"):
+    st.markdown("---")
+    st.subheader("🗂️ Trabajos en segundo plano")
+    show_jobs()
@@ -0,0 +1,99 @@
+"""
+Micro-benchmark: arranque de la página de Streamlit.
+
+Cada caso corre en un intérprete nuevo (arranque en frío, como un contenedor recién creado)
+y mide el tiempo de importación y qué dependencias pesadas quedan cargadas:
+
+    constantes   lo que importa la página al abrirse (constantes_costos)
+    motor        lo que importaba antes al abrirse, y ahora al encolar el primer trabajo (procesamiento_costos)
+
+Si streamlit está instalado se mide además la primera ejecución de la página y una recarga
+con streamlit.testing (AppTest), como la ve un usuario que recién la abre.
+
+Uso:
+    python benchmarks/bench_arranque.py [--repeticiones N]
+"""
+import argparse
+import importlib.util
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+PAGINA = RAIZ / 'Variacion Costos Hornos.py'
+MODULOS_PESADOS = ['pandas', 'numpy', 'openpyxl', 'pyarrow', 'procesamiento_costos']
+
+_PESADOS = f'[m for m in {MODULOS_PESADOS!r} if m in sys.modules]'
+CASOS = {
+    'constantes': f"""
+import sys, time, json
+t0 = time.perf_counter()
+import constantes_costos
+print(json.dumps({{'segundos': time.perf_counter() - t0, 'cargados': {_PESADOS}}}))
+""",
+    'motor': f"""
+import sys, time, json
+t0 = time.perf_counter()
+import procesamiento_costos
+print(json.dumps({{'segundos': time.perf_counter() - t0, 'cargados': {_PESADOS}}}))
+""",
+}
+# Primera ejecución y recarga de la página (sin contar la importación de streamlit)
+CASO_PAGINA = f"""
+import sys, time, json
+from streamlit.testing.v1 import AppTest
+pagina = AppTest.from_file({str(PAGINA)!r}, default_timeout=60)
+t0 = time.perf_counter()
+pagina.run()
+t1 = time.perf_counter()
+pagina.run()
+t2 = time.perf_counter()
+print(json.dumps({{'segundos': t1 - t0, 'recarga': t2 - t1, 'cargados': {_PESADOS}}}))
+"""
+
+
+def run_child(codigo):
+    """Ejecuta el código en un intérprete nuevo; devuelve su medición y el tiempo total del proceso."""
+    inicio = time.perf_counter()
+    salida = subprocess.run([sys.executable, '-c', codigo], cwd=RAIZ, capture_output=True, text=True, check=True).stdout
+    total = time.perf_counter() - inicio
+    medicion = json.loads(salida.strip().splitlines()[-1])
+    medicion['proceso'] = total
+    return medicion
+
+
+def measure(codigo, repeticiones):
+    mediciones = [run_child(codigo) for _ in range(repeticiones)]
+    resultado = {clave: statistics.median(m[clave] for m in mediciones) for clave in mediciones[0] if clave != 'cargados'}
+    resultado['cargados'] = mediciones[0].get('cargados', [])
+    return resultado
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mide el arranque en frío de la página de Streamlit.')
+    parser.add_argument('--repeticiones', type=int, default=5, help='Se informa la mediana')
+    args = parser.parse_args(argv)
+
+    casos = dict(CASOS)
+    if importlib.util.find_spec('streamlit') is not None:
+        casos['pagina'] = CASO_PAGINA
+    else:
+        print('streamlit no está instalado: se omite la ejecución de la página.\n')
+
+    # Arranque del intérprete solo, para separar lo que agrega cada importación
+    base = measure('import json; print(json.dumps({}))', args.repeticiones)['proceso']
+    print(f"{'caso':<12}{'importación':>13}{'proceso':>11}  dependencias cargadas")
+    print(f"{'intérprete':<12}{'':>13}{base:10.3f}s")
+    for nombre, codigo in casos.items():
+        resultado = measure(codigo, args.repeticiones)
+        print(f"{nombre:<12}{resultado['segundos']:12.3f}s{resultado['proceso']:10.3f}s  {', '.join(resultado['cargados']) or '-'}")
+        if 'recarga' in resultado:
+            print(f"{'  recarga':<12}{resultado['recarga']:12.3f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
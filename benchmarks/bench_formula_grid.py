@@ -0,0 +1,96 @@
+"""
+Micro-benchmark: generación de fórmulas de la hoja procesada.
+
+Compara el ciclo original (f-strings fila por fila, como en
+write_processed_sheet_with_formulas) contra build_formula_grid (columna por columna
+con NumPy), procesando las filas por lotes igual que el motor streaming.
+
+Uso:
+    python benchmarks/bench_formula_grid.py [filas ...]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import procesamiento_costos as app  # noqa: E402
+
+FILAS_POR_DEFECTO = [10_000, 100_000, 500_000]
+REPETICIONES = 3
+
+
+def formulas_loop(app, initial_cols, inicio, fin):
+    """Réplica del ciclo original: una lista de fórmulas por fila."""
+    from openpyxl.utils import get_column_letter
+
+    header = app.build_processed_header(initial_cols, app.NOMBRES_COSTOS_INTERNOS, app.output_cost_names)
+    col_map = {name: get_column_letter(idx + 1) for idx, name in enumerate(header)}
+    result_actual_letter = col_map['Result actualizado']
+    result_antes_letter = col_map['Resultado anterior']
+
+    filas = []
+    for excel_row_num in range(inicio, fin):
+        current_col_index = len(initial_cols)
+        current_parti_cols = []
+        current_impacto_cols = []
+        formulas = []
+        for _ in app.NOMBRES_COSTOS_INTERNOS:
+            current_col_index += 1
+            col_actual = get_column_letter(current_col_index)
+            current_col_index += 1
+            col_antes = get_column_letter(current_col_index)
+            current_col_index += 1
+            col_desv = get_column_letter(current_col_index)
+            formulas.append(f"=IFERROR(ROUND(({col_actual}{excel_row_num}-{col_antes}{excel_row_num})/{col_antes}{excel_row_num}, 4), 0)")
+            current_col_index += 1
+            col_parti = get_column_letter(current_col_index)
+            formulas.append(f"=IFERROR(ROUND({col_actual}{excel_row_num}/{result_actual_letter}{excel_row_num}, 4), 0)")
+            current_parti_cols.append(f"{col_parti}{excel_row_num}")
+            current_col_index += 1
+            col_impacto = get_column_letter(current_col_index)
+            formulas.append(f"=ROUND({col_desv}{excel_row_num}*{col_parti}{excel_row_num}, 4)")
+            current_impacto_cols.append(f"{col_impacto}{excel_row_num}")
+        current_col_index += 2
+        formulas.append(f"=IFERROR(ROUND(({result_actual_letter}{excel_row_num}-{result_antes_letter}{excel_row_num})/{result_antes_letter}{excel_row_num}, 4), 0)")
+        formulas.append(f"=ROUND(SUM({'+'.join(current_parti_cols)}), 4)")
+        formulas.append(f"=ROUND(SUM({'+'.join(current_impacto_cols)}), 4)")
+        filas.append(formulas)
+    return filas
+
+
+def formulas_grid(app, initial_cols, inicio, fin):
+    plantillas = app.build_formula_templates(initial_cols, app.NOMBRES_COSTOS_INTERNOS)
+    return app.build_formula_grid(plantillas, np.arange(inicio, fin))
+
+
+def medir(funcion, app, initial_cols, num_rows, lote):
+    mejor = float('inf')
+    for _ in range(REPETICIONES):
+        t0 = time.perf_counter()
+        for inicio in range(2, num_rows + 2, lote):
+            funcion(app, initial_cols, inicio, min(inicio + lote, num_rows + 2))
+        mejor = min(mejor, time.perf_counter() - t0)
+    return mejor
+
+
+def main(argv):
+    initial_cols = ['Versi', 'Ce.', app.CLAVE_MERGE, 'Texto breve material', 'Pr', 'UMB', 'Válido de', 'Tam.lot', 'Costo d']
+    tamanos = [int(x) for x in argv] or FILAS_POR_DEFECTO
+
+    # Ambas versiones deben producir exactamente las mismas fórmulas
+    esperado = formulas_loop(app, initial_cols, 2, 1002)
+    obtenido = np.char.decode(formulas_grid(app, initial_cols, 2, 1002), 'utf-8').tolist()
+    assert esperado == obtenido, 'build_formula_grid no coincide con el ciclo original'
+
+    print(f"{'filas':>10} {'ciclo (s)':>12} {'rejilla (s)':>12} {'aceleración':>12}")
+    for num_rows in tamanos:
+        t_loop = medir(formulas_loop, app, initial_cols, num_rows, app.TAMANO_LOTE_FILAS)
+        t_grid = medir(formulas_grid, app, initial_cols, num_rows, app.TAMANO_LOTE_FILAS)
+        print(f'{num_rows:>10} {t_loop:>12.3f} {t_grid:>12.3f} {t_loop / t_grid:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
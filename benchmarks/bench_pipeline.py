@@ -0,0 +1,197 @@
+"""
+Suite de rendimiento de process_excel_data con libros sintéticos (generar_libro.py).
+
+Cada caso (filas x tasa de coincidencia) se ejecuta en un proceso nuevo para que el pico
+de memoria sea solo el del caso. Se mide el tiempo total y el de cada etapa (PipelineProfile)
+y los resultados se guardan en JSON junto con las versiones usadas, para compararlos con una
+corrida anterior (--comparar) antes de actualizar dependencias o cambiar el código.
+
+Los libros generados se guardan en benchmarks/.datos y se reutilizan entre corridas.
+
+Uso:
+    python benchmarks/bench_pipeline.py [--filas 1000 10000 100000] [--coincidencia 0.95 0.5]
+                                        [--salida resultados.json] [--comparar base.json]
+                                        [--bloques [FILAS]]
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAIZ))
+
+import procesamiento_costos as app  # noqa: E402
+from generar_libro import generate_cost_workbook  # noqa: E402
+
+DIR_DATOS = Path(__file__).resolve().parent / '.datos'
+DIR_RESULTADOS = Path(__file__).resolve().parent / 'resultados'
+FILAS_POR_DEFECTO = [1_000, 10_000, 100_000]
+UMBRAL_REGRESION = 0.10
+
+
+class _ArchivoEntrada:
+    """Objeto con read() y name, como el archivo cargado en Streamlit."""
+
+    def __init__(self, ruta):
+        self.name = Path(ruta).name
+        self._ruta = ruta
+
+    def read(self):
+        return Path(self._ruta).read_bytes()
+
+
+def workbook_for(filas, coincidencia, semilla):
+    """Ruta del libro sintético del caso; se genera solo si no existe."""
+    ruta = DIR_DATOS / f'costos_{filas}_{coincidencia:g}_{semilla}.xlsx'
+    if not ruta.exists():
+        DIR_DATOS.mkdir(parents=True, exist_ok=True)
+        print(f'Generando {ruta.name} ...', flush=True)
+        temporal = ruta.with_suffix('.tmp')
+        generate_cost_workbook(temporal, filas, coincidencia, semilla)
+        temporal.replace(ruta)
+    return ruta
+
+
+def run_case(ruta, output_engine, output_mode, trace_memory, chunk_rows=None):
+    """Procesa el libro una vez (en el proceso actual) y devuelve la medición."""
+    perfil = app.PipelineProfile(trace_memory)
+    errores = []
+    inicio = time.perf_counter()
+    with app.capture_messages(lambda nivel, texto: errores.append(texto.strip()) if nivel >= logging.ERROR else None):
+        if chunk_rows:
+            with tempfile.TemporaryFile() as destino:
+                ok = app.process_excel_chunked(ruta, destino, output_mode, profile=perfil, chunk_rows=chunk_rows)
+                bytes_salida = destino.tell() if ok else None
+        else:
+            output_buffer, _ = app.process_excel_data(_ArchivoEntrada(ruta), output_engine, output_mode, profile=perfil)
+            ok = output_buffer is not None
+            bytes_salida = output_buffer.getbuffer().nbytes if ok else None
+    total = time.perf_counter() - inicio
+    # Las etapas reinician el pico del proceso (Linux): el del caso es el mayor de sus etapas
+    pico = perfil.peak_rss_mb()
+    return {
+        'ok': ok,
+        'errores': errores,
+        'segundos': round(total, 4),
+        'rss_pico_mb': pico if pico is not None else app._peak_rss_mb(),
+        'bytes_salida': bytes_salida,
+        'perfil': perfil.to_dict(),
+    }
+
+
+def run_suite(filas, coincidencias, semilla=0, repeticiones=1, output_engine=app.MOTOR_STREAMING, output_mode=app.MODO_FORMULAS, trace_memory=False, chunk_rows=None):
+    casos = []
+    for n in filas:
+        for coincidencia in coincidencias:
+            ruta = workbook_for(n, coincidencia, semilla)
+            mediciones = []
+            for _ in range(repeticiones):
+                # Proceso nuevo por repetición: el pico de RSS no arrastra casos anteriores
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    mediciones.append(executor.submit(run_case, str(ruta), output_engine, output_mode, trace_memory, chunk_rows).result())
+            mejor = min(mediciones, key=lambda m: m['segundos'])
+            caso = {
+                'filas': n,
+                'coincidencia': coincidencia,
+                'motor': output_engine,
+                'modo': output_mode,
+                'bloques': chunk_rows,
+                'repeticiones': [m['segundos'] for m in mediciones],
+                **mejor,
+            }
+            casos.append(caso)
+            print(f"{n:>9} filas  coincidencia {coincidencia:<5g} {caso['segundos']:9.2f} s  "
+                  f"pico RSS {caso['rss_pico_mb'] or 0:8.1f} MB  {'OK' if caso['ok'] else 'ERROR'}", flush=True)
+            for etapa in caso['perfil']['etapas']:
+                print(f"{'':>12}{etapa['etapa']:<20}{etapa['segundos']:9.2f} s", flush=True)
+    return casos
+
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'plataforma': platform.platform(),
+        'procesador': platform.processor() or platform.machine(),
+        'python': platform.python_version(),
+        'versiones': {'pandas': pd.__version__, 'numpy': np.__version__, 'openpyxl': openpyxl.__version__},
+    }
+
+
+def _clave(caso):
+    return (caso['filas'], caso['coincidencia'], caso['motor'], caso['modo'], caso.get('bloques'))
+
+
+def compare_results(base, actual, umbral=UMBRAL_REGRESION):
+    """Compara los casos comunes de dos corridas; devuelve la cantidad de regresiones de tiempo."""
+    casos_base = {_clave(caso): caso for caso in base['casos']}
+    regresiones = 0
+    print(f"\nComparación con {base['entorno'].get('commit')} ({base['entorno'].get('fecha')}):")
+    for caso in actual['casos']:
+        anterior = casos_base.get(_clave(caso))
+        if anterior is None:
+            continue
+        cambio = caso['segundos'] / anterior['segundos'] - 1
+        marca = ''
+        if cambio > umbral:
+            regresiones += 1
+            marca = '  <-- REGRESIÓN'
+        print(f"{caso['filas']:>9} filas  coincidencia {caso['coincidencia']:<5g} "
+              f"{anterior['segundos']:9.2f} s -> {caso['segundos']:9.2f} s ({cambio:+.0%}){marca}")
+        etapas_base = {etapa['etapa']: etapa['segundos'] for etapa in anterior['perfil']['etapas']}
+        for etapa in caso['perfil']['etapas']:
+            if etapa['etapa'] in etapas_base:
+                print(f"{'':>12}{etapa['etapa']:<20}{etapas_base[etapa['etapa']]:9.2f} s -> {etapa['segundos']:9.2f} s")
+    return regresiones
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mide process_excel_data con libros sintéticos.')
+    parser.add_argument('--filas', type=int, nargs='+', default=FILAS_POR_DEFECTO, help='Tamaños (hasta 1.000.000 filas)')
+    parser.add_argument('--coincidencia', type=float, nargs='+', default=[0.95], help='Tasas de coincidencia de materiales')
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--repeticiones', type=int, default=1, help='Se guarda la mejor de las repeticiones')
+    parser.add_argument('--motor', choices=[app.MOTOR_STREAMING, app.MOTOR_CELDAS], default=app.MOTOR_STREAMING)
+    parser.add_argument('--modo', choices=[app.MODO_FORMULAS, app.MODO_FORMULAS_CACHE, app.MODO_VALORES], default=app.MODO_FORMULAS)
+    parser.add_argument('--bloques', metavar='FILAS', type=int, nargs='?', const=app.FILAS_POR_BLOQUE,
+                        help='Mide el procesamiento por bloques (process_excel_chunked) en lugar del procesamiento en memoria')
+    parser.add_argument('--trazar-memoria', action='store_true', help='Pico de memoria por etapa con tracemalloc (más lento)')
+    parser.add_argument('--salida', help='JSON de resultados (por defecto benchmarks/resultados/<fecha>.json)')
+    parser.add_argument('--comparar', help='JSON de una corrida anterior para detectar regresiones')
+    args = parser.parse_args(argv)
+
+    resultados = {
+        'entorno': environment_info(),
+        'parametros': {'semilla': args.semilla, 'trazar_memoria': args.trazar_memoria},
+        'casos': run_suite(args.filas, args.coincidencia, args.semilla, args.repeticiones, args.motor, args.modo, args.trazar_memoria, args.bloques),
+    }
+
+    salida = Path(args.salida) if args.salida else DIR_RESULTADOS / f"{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    salida.write_text(json.dumps(resultados, ensure_ascii=False, indent=2), encoding='utf-8')
+    print(f'\nResultados guardados en {salida}')
+
+    if args.comparar:
+        base = json.loads(Path(args.comparar).read_text(encoding='utf-8'))
+        return 1 if compare_results(base, resultados) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Generador de libros de costos sintéticos para las pruebas de rendimiento.
+
+Crea las hojas HOJA_ACTUAL y HOJA_ANTERIOR con el mismo diseño de columnas que los libros
+reales, más una hoja 'Resumen' y una hoja procesada previa (que el procesamiento reemplaza).
+La tasa de coincidencia es la fracción de materiales de ACTUAL que también están en ANTERIOR;
+el resto de las filas de ANTERIOR son materiales que ya no existen en ACTUAL.
+
+Uso:
+    python benchmarks/generar_libro.py FILAS SALIDA.xlsx [--coincidencia 0.95] [--semilla 0]
+"""
+import argparse
+import datetime
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from procesamiento_costos import (  # noqa: E402
+    CLAVE_MERGE, COLUMNA_RESULTADO, HOJA_ACTUAL, HOJA_ANTERIOR, HOJA_PROCESADA, NOMBRES_COSTOS_INTERNOS
+)
+
+# En el libro de origen la columna de costo 'Materia_Costo' se llama 'Materia'
+COLUMNAS_COSTO = [('Materia' if c == 'Materia_Costo' else c) for c in NOMBRES_COSTOS_INTERNOS]
+COLUMNAS = ['Versi', 'Ce.', CLAVE_MERGE, 'Texto breve material', 'Pr', 'UMB', 'Válido de', 'Tam.lot', 'Costo d'] + COLUMNAS_COSTO + [COLUMNA_RESULTADO]
+CENTROS = ['H501', 'H502', 'H503', 'H504']
+PRIMER_MATERIAL = 1_000_000
+
+
+def generate_cost_frames(filas, coincidencia=0.95, semilla=0):
+    """DataFrames (actual, anterior) de filas filas cada uno, con la tasa de coincidencia de materiales dada."""
+    rng = np.random.default_rng(semilla)
+    coincidentes = int(round(filas * coincidencia))
+
+    materiales_actual = PRIMER_MATERIAL + np.arange(filas)
+    # ANTERIOR: los materiales coincidentes en otro orden, más materiales dados de baja
+    materiales_anterior = np.concatenate([
+        rng.permutation(materiales_actual)[:coincidentes],
+        PRIMER_MATERIAL + filas + np.arange(filas - coincidentes),
+    ])
+
+    def periodo(materiales, fecha, variacion):
+        n = len(materiales)
+        # Costos enteros con ~20 % de ceros por columna (costos que no aplican al material)
+        base = (materiales % 997 + 1)[:, None] * rng.uniform(1, 50, (1, len(COLUMNAS_COSTO)))
+        costos = np.round(base * rng.normal(1, variacion, (n, len(COLUMNAS_COSTO))))
+        costos[rng.random(costos.shape) < 0.2] = 0
+        df = pd.DataFrame({
+            'Versi': 'V1',
+            'Ce.': np.array(CENTROS)[materiales % len(CENTROS)],
+            CLAVE_MERGE: materiales,
+            'Texto breve material': [f'Material sintético {m}' for m in materiales.tolist()],
+            'Pr': 'PR',
+            'UMB': 'KG',
+            'Válido de': fecha,
+            'Tam.lot': 1000,
+            'Costo d': 'S',
+        })
+        for nombre, valores in zip(COLUMNAS_COSTO, costos.T):
+            df[nombre] = valores.astype(np.int64)
+        df[COLUMNA_RESULTADO] = np.round(costos.sum(axis=1) * rng.uniform(0.98, 1.02, n), 2)
+        return df[COLUMNAS]
+
+    df_actual = periodo(materiales_actual, datetime.datetime(2024, 2, 1), 0.05)
+    df_anterior = periodo(materiales_anterior, datetime.datetime(2024, 1, 1), 0.0)
+    return df_actual, df_anterior
+
+
+def write_cost_workbook(ruta, df_actual, df_anterior):
+    """Escribe el libro sintético (modo write-only de openpyxl)."""
+    wb = Workbook(write_only=True)
+    resumen = wb.create_sheet('Resumen')
+    resumen.append(['Libro sintético de costos'])
+    resumen.append(['Filas', len(df_actual)])
+    for nombre, df in [(HOJA_ACTUAL, df_actual), (HOJA_ANTERIOR, df_anterior)]:
+        ws = wb.create_sheet(nombre)
+        ws.append(list(df.columns))
+        for fila in df.itertuples(index=False, name=None):
+            ws.append(fila)
+    wb.create_sheet(HOJA_PROCESADA).append(['Hoja procesada anterior'])
+    wb.save(ruta)
+
+
+def generate_cost_workbook(ruta, filas, coincidencia=0.95, semilla=0):
+    """Genera y guarda el libro sintético; devuelve la ruta."""
+    df_actual, df_anterior = generate_cost_frames(filas, coincidencia, semilla)
+    write_cost_workbook(ruta, df_actual, df_anterior)
+    return ruta
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Genera un libro de costos sintético.')
+    parser.add_argument('filas', type=int)
+    parser.add_argument('salida')
+    parser.add_argument('--coincidencia', type=float, default=0.95, help='Fracción de materiales de ACTUAL presentes en ANTERIOR')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args(argv)
+    generate_cost_workbook(args.salida, args.filas, args.coincidencia, args.semilla)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Constantes compartidas por el motor (procesamiento_costos.py) y sus interfaces.
+
+Solo usa la biblioteca estándar: la página de Streamlit lo importa al arrancar y arma la
+interfaz sin cargar pandas, NumPy ni openpyxl. El motor se importa recién cuando se
+necesita (al encolar el primer trabajo) y procesamiento_costos reexporta estos nombres.
+"""
+import logging
+import os
+
+# --- 1. Configuración de Constantes y Nombres ---
+HOJA_ACTUAL = 'Costos ACTUAL'
+HOJA_ANTERIOR = 'Costos ANTERIOR'
+HOJA_PROCESADA = 'Costos_procesado'
+HOJA_CONSOLIDADO = 'Consolidado_Impactos'
+
+COLUMNA_RESULTADO = 'Result'
+CLAVE_MERGE = 'Material'
+# Columnas del libro de origen que se copian al inicio de la hoja procesada
+COLUMNAS_INICIALES = ['Versi', 'Ce.', CLAVE_MERGE, 'Texto breve material', 'Pr', 'UMB', 'Válido de', 'Tam.lot', 'Costo d']
+NOMBRES_COSTOS_INTERNOS = ['Marteri', 'Materia_Costo', 'Alistam', 'Mano de', 'Maquila', 'Energ', 'Maqui', 'Cif']
+
+# Columnas que deben ser ENTEROS (Redondeo a 0 decimales)
+COLUMNAS_ENTEROS = [
+    'Marteri', 'Materia_Costo', 'Alistam', 'Mano de',
+    'Maquila', 'Energ', 'Maqui', 'Cif'
+]
+
+# Mapeo de nombres internos a nombres de salida (para encabezados)
+output_cost_names = {
+    'Marteri': 'Marteri',
+    'Materia_Costo': 'Material d',
+    'Alistam': 'Alistam',
+    'Mano de': 'Mano de',
+    'Maquila': 'Maquila',
+    'Energ': 'Energ',
+    'Maqui': 'Maqui',
+    'Cif': 'Cif'
+}
+
+# Nivel del aviso de éxito final (INFO queda para los resúmenes informativos)
+EXITO = logging.INFO + 5
+logging.addLevelName(EXITO, 'EXITO')
+
+# --- Formatos de Entrada y Salida ---
+FORMATO_XLSX = 'xlsx'
+FORMATO_PARQUET = 'parquet'
+FORMATO_FEATHER = 'feather'
+FORMATO_CSV = 'csv'
+# Extensión del archivo -> formato (las demás extensiones se leen como libro de Excel)
+EXTENSIONES_FORMATO = {'.parquet': FORMATO_PARQUET, '.pq': FORMATO_PARQUET, '.feather': FORMATO_FEATHER, '.arrow': FORMATO_FEATHER, '.csv': FORMATO_CSV}
+
+
+def file_format(nombre):
+    """Formato de un archivo de entrada según su extensión."""
+    return EXTENSIONES_FORMATO.get(os.path.splitext(nombre)[1].lower(), FORMATO_XLSX)
+
+
+# Contenido de las columnas calculadas
+MODO_FORMULAS = 'formulas'
+MODO_VALORES = 'valores'
+MODO_FORMULAS_CACHE = 'formulas_cache'
+
+# Materiales repetidos en la hoja ANTERIOR
+DUPLICADOS_PRIMERO = 'primero'
+DUPLICADOS_ULTIMO = 'ultimo'
+DUPLICADOS_SUMA = 'suma'
+DUPLICADOS_ERROR = 'error'
+
+# --- Hojas Adicionales (tendencia y resumen de impactos) ---
+HOJA_TENDENCIA = 'Tendencia_Costos'
+HOJA_RESUMEN_IMPACTOS = 'Resumen_Impactos'
+COLUMNAS_AGRUPACION = ['Ce.', 'Versi', 'Pr']
+COLUMNA_AGRUPACION = 'Agrupación'
+COLUMNA_VALOR = 'Valor'
+COLUMNAS_IMPACTO_RESUMEN = [f'Impacto {output_cost_names.get(c, c)}' for c in NOMBRES_COSTOS_INTERNOS] + ['Suma Impacto']
+
+# --- Trabajos en Segundo Plano ---
+TRABAJO_EN_COLA = 'en_cola'
+TRABAJO_EN_CURSO = 'en_curso'
+TRABAJO_TERMINADO = 'terminado'
+TRABAJO_FALLIDO = 'fallido'
+MAX_TRABAJOS_SIMULTANEOS = 2
+MAX_TRABAJOS_EN_ESPERA = 8
+MAX_TRABAJOS_TERMINADOS = 20
+# Los resultados terminados se guardan en archivos temporales, con este tope total en disco
+MAX_BYTES_TRABAJOS_TERMINADOS = 2 * 2**30
+
+TAREA_PROCESAR = 'procesar'
+TAREA_BLOQUES = 'bloques'
+TAREA_TENDENCIA = 'tendencia'
+# Etapas de cada tarea en el orden en que se ejecutan (las que no aplican se saltan)
+ETAPAS_TAREA = {
+    TAREA_PROCESAR: ['cache', 'lectura', 'combinacion', 'redondeo', 'huellas', 'valores_calculados', 'hoja_procesada', 'formato', 'consolidado', 'resumen_impactos', 'parquet', 'guardado'],
+    TAREA_BLOQUES: ['indice_anterior', 'bloques', 'resumen_impactos', 'guardado'],
+    TAREA_TENDENCIA: ['lectura', 'apilado', 'tendencia', 'hoja_tendencia', 'guardado'],
+}
+DESCRIPCION_ETAPAS = {
+    'cache': 'Buscando el resultado en la caché',
+    'lectura': 'Cargando las hojas de origen',
+    'indice_anterior': 'Cargando el período anterior',
+    'combinacion': 'Combinando ACTUAL con ANTERIOR',
+    'redondeo': 'Redondeando los costos',
+    'huellas': 'Comparando con la corrida anterior',
+    'valores_calculados': 'Calculando las fórmulas',
+    'hoja_procesada': 'Escribiendo la hoja procesada',
+    'formato': 'Aplicando formato',
+    'consolidado': 'Escribiendo el consolidado',
+    'resumen_impactos': 'Calculando el resumen de impactos',
+    'bloques': 'Procesando los bloques de filas',
+    'apilado': 'Apilando los períodos',
+    'tendencia': 'Calculando la tendencia',
+    'hoja_tendencia': 'Escribiendo la hoja de tendencia',
+    'parquet': 'Guardando la tabla Parquet',
+    'guardado': 'Guardando el libro',
+}
@@ -0,0 +1,2939 @@
+import pandas as pd
+from pandas.io.parsers import TextParser
+import numpy as np
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.styles import PatternFill, Font, Border, Side
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import to_excel
+from openpyxl.compat import safe_string
+import hashlib
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+import threading
+import types
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from copy import copy
+import re
+import shutil
+import tempfile
+import zipfile
+import zlib
+import posixpath
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xml.sax.saxutils import escape, quoteattr
+
+from constantes_costos import (
+    CLAVE_MERGE, COLUMNA_AGRUPACION, COLUMNA_RESULTADO, COLUMNA_VALOR, COLUMNAS_AGRUPACION, COLUMNAS_ENTEROS, COLUMNAS_IMPACTO_RESUMEN, COLUMNAS_INICIALES,
+    DESCRIPCION_ETAPAS, DUPLICADOS_ERROR, DUPLICADOS_PRIMERO, DUPLICADOS_SUMA, DUPLICADOS_ULTIMO, ETAPAS_TAREA, EXITO, EXTENSIONES_FORMATO, FORMATO_CSV,
+    FORMATO_FEATHER, FORMATO_PARQUET, FORMATO_XLSX, HOJA_ACTUAL, HOJA_ANTERIOR, HOJA_CONSOLIDADO, HOJA_PROCESADA, HOJA_RESUMEN_IMPACTOS, HOJA_TENDENCIA,
+    MAX_BYTES_TRABAJOS_TERMINADOS, MAX_TRABAJOS_EN_ESPERA, MAX_TRABAJOS_SIMULTANEOS, MAX_TRABAJOS_TERMINADOS, MODO_FORMULAS, MODO_FORMULAS_CACHE, MODO_VALORES, NOMBRES_COSTOS_INTERNOS,
+    TAREA_BLOQUES, TAREA_PROCESAR, TAREA_TENDENCIA, TRABAJO_EN_COLA, TRABAJO_EN_CURSO, TRABAJO_FALLIDO, TRABAJO_TERMINADO, file_format, output_cost_names
+)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# --- 1. Configuración de Constantes y Nombres ---
+# Nombres de hojas y columnas, formatos de archivo, modos y etapas de los trabajos: constantes_costos.py
+# (sin dependencias pesadas, para que la interfaz los use sin importar este módulo)
+
+# Definición del tipo de borde para los bloques de cálculo
+side_medium = Side(border_style='medium', color="000000")
+border_left = Border(left=side_medium)
+border_right = Border(right=side_medium)
+# Bordes de la primera y la última columna de cada bloque de costo (los demás lados, explícitamente sin borde)
+border_first = Border(left=side_medium, top=Side(), bottom=Side(), right=Side())
+border_last = Border(right=side_medium, top=Side(), bottom=Side(), left=Side())
+
+# Estilos compartidos por todas las hojas de salida (se registran en cada libro al asignarlos)
+fill_actual_orange = PatternFill(start_color='FCE4D6', end_color='FCE4D6', fill_type='solid')
+fill_variacion_blue = PatternFill(start_color='DDEBF7', end_color='DDEBF7', fill_type='solid')
+fill_impacto_green = PatternFill(start_color='E2F0D9', end_color='E2F0D9', fill_type='solid')
+font_black_bold = Font(color="000000", bold=True)
+currency_format = '#,##0'
+integer_format = '#,##0'
+percentage_format = '0.00%'
+
+# --- Mensajes del Procesamiento ---
+# Los errores, advertencias y el aviso de éxito se emiten por logging; la interfaz que llama
+# (Streamlit o la línea de comandos) decide cómo mostrarlos con capture_messages.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class _MessageHandler(logging.Handler):
+    def __init__(self, destino):
+        super().__init__(logging.INFO)
+        self.destino = destino
+        self.hilo = threading.get_ident()
+
+    def emit(self, record):
+        # Solo los mensajes del hilo que abrió la captura (Streamlit atiende cada sesión en su hilo)
+        if record.thread == self.hilo:
+            self.destino(record.levelno, record.getMessage())
+
+
+@contextmanager
+def capture_messages(destino):
+    """Envía a destino(nivel, texto) los mensajes del procesamiento emitidos en este hilo durante el bloque."""
+    handler = _MessageHandler(destino)
+    logger.addHandler(handler)
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+
+
+# --- Medición de Etapas del Procesamiento ---
+def _rss_mb():
+    """Memoria residente actual del proceso en MB (None si el sistema no la expone)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss_mb():
+    """Pico de memoria residente del proceso desde su inicio (o desde el último _reset_peak_rss), en MB."""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo reporta en KB y macOS en bytes
+    return pico / 2**20 if sys.platform == 'darwin' else pico / 2**10
+
+
+def _reset_peak_rss():
+    """Reinicia el pico de memoria residente del proceso (solo Linux). Devuelve False si no se pudo."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# Etapas en curso en todo el proceso (trabajos simultáneos de la interfaz): el pico de memoria
+# residente y tracemalloc son del proceso, así que solo los reinicia la etapa que empieza sin otras en curso
+_medicion_lock = threading.Lock()
+_etapas_en_curso = 0
+_etapas_trazadas = 0
+_traza_propia = False
+_pico_por_etapa = False  # el sistema permite reiniciar el pico de memoria residente
+
+
+class PipelineProfile:
+    """
+    Tiempo, memoria y conteos de filas/celdas de cada etapa de process_excel_data.
+    rss_pico_mb es el pico de memoria residente durante la etapa (en Linux se reinicia al empezar
+    cada etapa; en otros sistemas queda en None). Con trabajos simultáneos en el mismo proceso, el
+    pico es el del proceso desde que empezó la más antigua de las etapas en curso.
+    Con trace_memory=True también se mide el pico de memoria de Python de cada etapa con
+    tracemalloc (hace el procesamiento bastante más lento). on_stage(nombre), si se indica,
+    se llama al comenzar cada etapa (avance de los trabajos en segundo plano).
+    """
+
+    def __init__(self, trace_memory=False, on_stage=None):
+        self.trace_memory = trace_memory
+        self.on_stage = on_stage
+        self.etapas = []
+
+    @contextmanager
+    def stage(self, nombre, filas=None, celdas=None):
+        """Mide el bloque como la etapa nombre. Devuelve el registro para completar los conteos."""
+        registro = {'etapa': nombre, 'segundos': None, 'filas': filas, 'celdas': celdas}
+        if self.on_stage is not None:
+            self.on_stage(nombre)
+        global _etapas_en_curso, _etapas_trazadas, _traza_propia, _pico_por_etapa
+        with _medicion_lock:
+            if _etapas_en_curso == 0:
+                _pico_por_etapa = _reset_peak_rss()
+            _etapas_en_curso += 1
+            if self.trace_memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _traza_propia = True
+                elif _etapas_trazadas == 0:
+                    tracemalloc.reset_peak()
+                _etapas_trazadas += 1
+        inicio = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            registro['segundos'] = round(time.perf_counter() - inicio, 4)
+            with _medicion_lock:
+                if self.trace_memory:
+                    registro['tracemalloc_pico_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                    _etapas_trazadas -= 1
+                    if _etapas_trazadas == 0 and _traza_propia:
+                        tracemalloc.stop()
+                        _traza_propia = False
+                rss, pico = _rss_mb(), _peak_rss_mb() if _pico_por_etapa else None
+                _etapas_en_curso -= 1
+            registro['rss_mb'] = round(rss, 1) if rss is not None else None
+            registro['rss_pico_mb'] = round(pico, 1) if pico is not None else None
+            self.etapas.append(registro)
+
+    def to_dict(self):
+        return {
+            'total_segundos': round(sum(etapa['segundos'] for etapa in self.etapas), 4),
+            'trace_memory': self.trace_memory,
+            'rss_pico_mb': self.peak_rss_mb(),
+            'etapas': self.etapas,
+        }
+
+    def peak_rss_mb(self):
+        """Mayor pico de memoria residente de las etapas medidas (None si no se pudo medir por etapa)."""
+        picos = [etapa['rss_pico_mb'] for etapa in self.etapas if etapa.get('rss_pico_mb') is not None]
+        return max(picos) if picos else None
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+
+# --- FUNCIÓN 1: Aplicar Formato a la Hoja Procesada (AJUSTADA PARA USAR WORKBOOK) ---
+def _styled_cell(ws, number_format=None, font=None, fill=None, border=None):
+    """Celda suelta con la combinación de estilo ya registrada en el libro de ws."""
+    cell = WriteOnlyCell(ws)
+    if number_format:
+        cell.number_format = number_format
+    if font:
+        cell.font = font
+    if fill:
+        cell.fill = fill
+    if border:
+        cell.border = border
+    return cell
+
+
+def apply_excel_formatting(wb, sheet_name, layout=None):
+    try:
+        if sheet_name not in wb.sheetnames:
+            logger.warning(f"Advertencia: La hoja '{sheet_name}' no se encontró para aplicar formato.")
+            return
+
+        # Roles de columna y estilos: ya resueltos por nombre en la disposición compartida
+        if layout is None:
+            layout = sheet_layout()
+        ws = wb[sheet_name]
+        header = [cell.value for cell in ws[1]]
+
+        # --- Estilo de cada columna: se resuelve una sola vez y se copia a todas sus celdas ---
+        # (Excel da prioridad al estilo de la celda sobre el de la columna, por eso se asigna
+        # a las celdas existentes y no a column_dimensions)
+        max_row = ws.max_row
+
+        for col_idx, col_name in enumerate(header, start=1):
+            # Parte 1: Formato de Porcentaje, Moneda y ENTERO (solo celdas con valor)
+            # Parte 2: Negrita y Color del Encabezado (Fila 1)
+            # Parte 3: BORDES de bloque en TODAS las FILAS
+            number_format, fill, border = layout.processed_style(col_name)
+
+            font = font_black_bold if col_name is not None else None
+            ws.cell(row=1, column=col_idx)._style = _styled_cell(ws, font=font, fill=fill, border=border)._style
+
+            if number_format is None and border is None:
+                continue
+            estilo_valor = _styled_cell(ws, number_format=number_format, border=border)._style
+            estilo_vacio = _styled_cell(ws, border=border)._style
+            for (cell,) in ws.iter_rows(min_row=2, max_row=max_row, min_col=col_idx, max_col=col_idx):
+                cell._style = copy(estilo_valor if cell.value is not None else estilo_vacio)
+
+    except Exception as e:
+        logger.error(f"❌ Error al aplicar el formato de Excel con openpyxl: {e}")
+
+
+# --- FUNCIÓN 2: Aplicar Fórmulas Dinámicas al Consolidado (AJUSTADA Y CORREGIDA) ---
+def apply_consolidation_formulas(wb, processed_sheet_name, consolidated_sheet_name, df_output_headers, df_consolidado_headers, layout=None):
+    """
+    Remplaza los valores estáticos en la hoja consolidada con fórmulas 
+    de Excel que referencian a la hoja procesada, asegurando el formato de porcentaje.
+    """
+    try:
+        
+        if consolidated_sheet_name not in wb.sheetnames:
+            logger.warning(f"Advertencia: La hoja '{consolidated_sheet_name}' no se encontró para aplicar fórmulas.")
+            return
+            
+        ws_consolidado = wb[consolidated_sheet_name]
+        if layout is None:
+            layout = sheet_layout()
+        
+        # 1. Mapear la posición de cada columna de salida en la hoja de origen
+        if list(df_output_headers) == layout.header:
+            header_map = layout.header_map
+        else:
+            header_map = {col_name: idx + 1 for idx, col_name in enumerate(df_output_headers)}
+        max_row = ws_consolidado.max_row
+        
+        # 2. Aplicar formato y fórmulas por columna: el estilo se resuelve una vez y se copia a sus celdas
+        for col_idx_con, col_name_con in enumerate(df_consolidado_headers):
+            
+            # Obtener el índice de la columna en la hoja de origen (df_output)
+            col_name_source = col_name_con 
+            source_col_idx = header_map.get(col_name_source)
+            
+            if source_col_idx is None:
+                logger.warning(f"Advertencia: Columna '{col_name_source}' no encontrada en la hoja origen. Se saltará.")
+                continue
+
+            source_col_letter = get_column_letter(source_col_idx)
+            number_format, fill = layout.consolidated_style(col_name_con)
+            
+            # Aplicar formato de encabezado (negrita y color)
+            header_cell = ws_consolidado.cell(row=1, column=col_idx_con + 1)
+            header_cell.font = font_black_bold
+            if fill is not None:
+                header_cell.fill = fill
+            
+            # Recorrer todas las filas de datos (empezando desde la fila 2): fórmula de vinculación y formato de número
+            estilo = _styled_cell(ws_consolidado, number_format=number_format)._style if number_format else None
+            for row_idx, (cell,) in enumerate(ws_consolidado.iter_rows(min_row=2, max_row=max_row, min_col=col_idx_con + 1, max_col=col_idx_con + 1), start=2):
+                cell.value = f"='{processed_sheet_name}'!{source_col_letter}{row_idx}"
+                if estilo is not None:
+                    cell._style = copy(estilo)
+
+    except Exception as e:
+        logger.error(f"❌ Error al aplicar las fórmulas de Excel con openpyxl: {e}")
+        return
+
+# --- FUNCIÓN 3: Escritura y Formateo de la Hoja Procesada con Fórmulas
+
+def build_processed_header(initial_cols, cost_names_internal, output_cost_names):
+    """Encabezado de la hoja procesada: columnas iniciales, un bloque de 5 columnas por costo y resultados."""
+    header = initial_cols[:]
+    for costo in cost_names_internal:
+        costo_output = output_cost_names.get(costo, costo)
+        header.extend([
+            f'{costo_output} Actual',
+            f'{costo_output} Antes',
+            '% desv',
+            '% parti',
+            f'Impacto {costo_output}'
+        ])
+    header.extend(['Result actualizado', 'Resultado anterior', '% Variacion Resultado', 'Suma %Parti', 'Suma Impacto'])
+    return header
+
+class SheetLayout:
+    """
+    Disposición de las hojas de salida, construida una sola vez por combinación de columnas (ver sheet_layout):
+    encabezado de la hoja procesada con la letra y la columna del DataFrame de cada posición, encabezado del
+    consolidado, plantillas de fórmula y los roles de columna como conjuntos (porcentaje, entero, moneda, primera
+    y última de bloque). El estilo de cada nombre de columna se resuelve aquí y lo comparten la escritura y el formato.
+    """
+
+    def __init__(self, initial_cols, cost_names_internal, cost_output_names):
+        self.initial_cols = list(initial_cols)
+        self.cost_names_internal = list(cost_names_internal)
+        self.header = build_processed_header(self.initial_cols, self.cost_names_internal, cost_output_names)
+        self.letters = [get_column_letter(idx + 1) for idx in range(len(self.header))]
+        # Nombre -> posición (base 1) / letra; los nombres repetidos ('% desv', '% parti') quedan con la última
+        self.header_map = {name: idx + 1 for idx, name in enumerate(self.header)}
+        self.col_map = {name: self.letters[idx - 1] for name, idx in self.header_map.items()}
+        self.plantillas = build_formula_templates(self.initial_cols, self.cost_names_internal)
+
+        # Columna del DataFrame de cada columna de valores (None = fórmula)
+        self.sources = list(self.initial_cols)
+        for costo_interno in self.cost_names_internal:
+            self.sources.extend([f'{costo_interno} Actual', f'{costo_interno} Antes', None, None, None])
+        self.sources.extend(['Result actualizado', 'Resultado anterior', None, None, None])
+
+        costos_salida = [cost_output_names.get(c, c) for c in self.cost_names_internal]
+        self.consolidated_header = [CLAVE_MERGE, 'Texto breve material', 'Result actualizado', 'Resultado anterior', '% Variacion Resultado']
+        self.consolidated_header += [f'Impacto {costo_output}' for costo_output in costos_salida]
+
+        # Roles por nombre de columna (los costos Actual / Antes llevan el nombre interno, como siempre)
+        self.percentage_names = frozenset(['% desv', '% parti', '% Variacion Resultado', 'Suma %Parti', 'Suma Impacto'] + [f'Impacto {c}' for c in costos_salida])
+        self.integer_names = frozenset([f'{c} Actual' for c in COLUMNAS_ENTEROS] + [f'{c} Antes' for c in COLUMNAS_ENTEROS])
+        self.currency_names = frozenset([f'{c} Actual' for c in self.cost_names_internal] + [f'{c} Antes' for c in self.cost_names_internal] + ['Result actualizado', 'Resultado anterior'])
+        self.first_in_block_names = frozenset(f'{c} Actual' for c in costos_salida)
+        self.last_in_block_names = frozenset(f'Impacto {c}' for c in costos_salida)
+
+        self._processed_styles = {name: self._resolve_processed_style(name) for name in self.header}
+        self._consolidated_styles = {name: self._resolve_consolidated_style(name) for name in self.consolidated_header}
+
+    def _resolve_processed_style(self, name):
+        if name is None:
+            return None, None, None
+
+        number_format = None
+        if name in self.percentage_names:
+            number_format = percentage_format
+        elif name in self.integer_names:
+            number_format = integer_format
+        elif name in self.currency_names:
+            number_format = currency_format
+
+        fill = None
+        if name == '% Variacion Resultado':
+            fill = fill_variacion_blue
+        elif 'Impacto' in name:
+            fill = fill_impacto_green
+        elif 'Actual' in name or name == 'Result actualizado':
+            fill = fill_actual_orange
+
+        border = None
+        if name in self.first_in_block_names:
+            border = border_first
+        elif name in self.last_in_block_names:
+            border = border_last
+        return number_format, fill, border
+
+    def _resolve_consolidated_style(self, name):
+        # Las columnas de porcentaje / impacto tienen prioridad para evitar conflictos de formato
+        number_format = None
+        if name == '% Variacion Resultado' or 'Impacto' in name:
+            number_format = percentage_format
+        elif 'Result' in name:
+            number_format = currency_format
+
+        fill = None
+        if 'Impacto' in name:
+            fill = fill_impacto_green
+        elif name == '% Variacion Resultado':
+            fill = fill_variacion_blue
+        return number_format, fill
+
+    def processed_style(self, name):
+        """(formato numérico, relleno del encabezado, borde) de una columna de la hoja procesada."""
+        estilo = self._processed_styles.get(name)
+        return estilo if estilo is not None else self._resolve_processed_style(name)
+
+    def consolidated_style(self, name):
+        """(formato numérico, relleno del encabezado) de una columna del consolidado."""
+        estilo = self._consolidated_styles.get(name)
+        return estilo if estilo is not None else self._resolve_consolidated_style(name)
+
+
+_disposiciones = {}
+_disposiciones_lock = threading.Lock()
+
+
+def sheet_layout(initial_cols=None, cost_names_internal=None, cost_output_names=None):
+    """
+    SheetLayout de la combinación de columnas dada (por defecto COLUMNAS_INICIALES, NOMBRES_COSTOS_INTERNOS y
+    output_cost_names). Se construye una sola vez por proceso y combinación; después es de solo lectura.
+    """
+    initial_cols = COLUMNAS_INICIALES if initial_cols is None else initial_cols
+    cost_names_internal = NOMBRES_COSTOS_INTERNOS if cost_names_internal is None else cost_names_internal
+    cost_output_names = output_cost_names if cost_output_names is None else cost_output_names
+    clave = (tuple(initial_cols), tuple(cost_names_internal), tuple(cost_output_names.items()))
+    with _disposiciones_lock:
+        if clave not in _disposiciones:
+            _disposiciones[clave] = SheetLayout(initial_cols, cost_names_internal, cost_output_names)
+        return _disposiciones[clave]
+
+
+
+def write_processed_sheet_with_formulas(wb, sheet_name, df_data, cost_names_internal, output_cost_names, initial_cols, layout=None):
+
+    try:
+        
+        # 1. Determinar la posición (índice) de la hoja procesada
+        index = 0
+        if sheet_name in wb.sheetnames:
+            # Obtener el índice actual de la hoja para recrearla en la misma posición
+            sheet_names_list = wb.sheetnames
+            index = sheet_names_list.index(sheet_name)
+            del wb[sheet_name]
+        
+        # Crear la hoja en su posición original
+        ws = wb.create_sheet(sheet_name, index=index)
+
+        # 2. Encabezado final, columnas de valores y plantillas de fórmula de la disposición compartida
+        if layout is None:
+            layout = sheet_layout(initial_cols, cost_names_internal, output_cost_names)
+        header = list(layout.header)
+        
+        # Escribir el encabezado (Fila 1)
+        ws.append(header)
+        
+        # Por posición: (columna, columna del DataFrame) de los valores estáticos y (columna, plantilla) de las fórmulas
+        columnas_valor = [(idx + 1, fuente) for idx, fuente in enumerate(layout.sources) if fuente is not None]
+        columnas_formula = [(idx + 1, layout.plantillas[idx]) for idx, fuente in enumerate(layout.sources) if fuente is None]
+        
+        # 3. Iterar sobre las filas de datos de pandas e insertar valores/fórmulas
+        filas = df_data[[fuente for _, fuente in columnas_valor]].itertuples(index=False, name=None)
+        for row_idx, valores in zip(df_data.index, filas):
+            excel_row_num = row_idx + 2 # Fila de Excel: 1 (Encabezado) + 1 (Index 0 de Pandas)
+            
+            # --- Columnas iniciales, costos Actual / Antes y resultados (Datos Estáticos) ---
+            for (col_idx, _), valor in zip(columnas_valor, valores):
+                ws.cell(row=excel_row_num, column=col_idx, value=valor)
+            
+            # --- % desv, % parti, Impacto y totales (Fórmulas con el signo de igualdad) ---
+            for col_idx, plantilla in columnas_formula:
+                ws.cell(row=excel_row_num, column=col_idx, value=plantilla.format(excel_row_num))
+            
+        return header # Retornar el encabezado final para el mapeo del Consolidado
+        
+    except Exception as e:
+        logger.error(f"❌ Error al escribir la hoja procesada con fórmulas: {e}")
+        return []
+
+# --- FUNCIÓN 4: Carga Única de las Hojas de Origen ---
+def read_table(datos, formato):
+    """Lee una tabla columnar (Parquet, Feather o CSV) desde sus bytes."""
+    if formato == FORMATO_PARQUET:
+        return pd.read_parquet(io.BytesIO(datos))
+    if formato == FORMATO_FEATHER:
+        return pd.read_feather(io.BytesIO(datos))
+    return pd.read_csv(io.BytesIO(datos))
+
+
+def load_source_sheets(excel_data, input_format=FORMATO_XLSX, previous_data=None):
+    """
+    Abre el archivo una sola vez (modo de solo lectura de openpyxl) y devuelve
+    las hojas ACTUAL y ANTERIOR como DataFrames. El resto del libro no se carga.
+    Con un formato columnar cada período es un archivo: excel_data es la tabla ACTUAL
+    y previous_data la tabla ANTERIOR.
+    """
+    if input_format != FORMATO_XLSX:
+        if previous_data is None:
+            raise ValueError(f"falta la tabla del período anterior ('{HOJA_ANTERIOR}')")
+        df_actual, df_anterior = read_table(excel_data, input_format), read_table(previous_data, input_format)
+        # Una clave que mezclaba números y texto queda como texto al guardarla (write_parquet);
+        # si solo una de las tablas la tiene así, la otra se lleva también a texto para poder cruzarlas
+        if pd.api.types.is_string_dtype(df_actual[CLAVE_MERGE]) != pd.api.types.is_string_dtype(df_anterior[CLAVE_MERGE]):
+            df_actual[CLAVE_MERGE] = df_actual[CLAVE_MERGE].astype(str)
+            df_anterior[CLAVE_MERGE] = df_anterior[CLAVE_MERGE].astype(str)
+        return df_actual, df_anterior
+
+    hojas = pd.read_excel(io.BytesIO(excel_data), sheet_name=[HOJA_ACTUAL, HOJA_ANTERIOR], header=0, engine='openpyxl')
+    return hojas[HOJA_ACTUAL], hojas[HOJA_ANTERIOR]
+
+
+# --- FUNCIÓN 5: Ensamblado del Libro de Salida (copia directa de las hojas no modificadas) ---
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+REL_WORKSHEET = NS_REL + '/worksheet'
+CONTENT_TYPE_WORKSHEET = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+TAMANO_BLOQUE_XML = 4 * 1024 * 1024
+PATRON_ESTILO_CELDA = re.compile(rb' s="(\d+)"')
+
+ET.register_namespace('', NS_MAIN)
+
+# Orden de los elementos de styles.xml según el esquema (para insertar bloques faltantes)
+ORDEN_ESTILOS = ['numFmts', 'fonts', 'fills', 'borders', 'cellStyleXfs', 'cellXfs', 'cellStyles', 'dxfs', 'tableStyles', 'colors', 'extLst']
+# Elementos de workbook.xml que deben ir después de <calcPr>
+POSTERIORES_CALCPR = ['oleSize', 'customWorkbookViews', 'pivotCaches', 'smartTagPr', 'smartTagTypes', 'webPublishing', 'fileRecoveryPr', 'webPublishObjects', 'extLst']
+
+
+def new_output_workbook():
+    """Libro vacío donde se escriben solo las hojas que el proceso regenera."""
+    wb = Workbook()
+    del wb[wb.active.title]
+    return wb
+
+
+def _resolve_target(base_dir, target):
+    # Las relaciones pueden usar rutas absolutas ('/xl/...') o relativas a la carpeta del workbook
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(base_dir, target))
+
+
+def _read_sheet_parts(zf):
+    """Devuelve [(nombre, sheetId, ruta de la parte)] en el orden del libro."""
+    wb_xml = ET.fromstring(zf.read('xl/workbook.xml'))
+    rels_xml = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): _resolve_target('xl', rel.get('Target')) for rel in rels_xml}
+
+    parts = []
+    for sheet in wb_xml.iter(f'{{{NS_MAIN}}}sheet'):
+        r_id = sheet.get(f'{{{NS_REL}}}id')
+        parts.append((sheet.get('name'), int(sheet.get('sheetId')), targets.get(r_id)))
+    return parts
+
+
+def _xml_fragment(element):
+    # Serializar sin la declaración del namespace principal (ya está en la raíz del destino)
+    return ET.tostring(element, encoding='unicode').replace(f' xmlns="{NS_MAIN}"', '')
+
+
+def _append_to_block(xml, tag, items, total):
+    """Agrega fragmentos al bloque <tag> de styles.xml y actualiza su atributo count."""
+    if not items:
+        return xml
+
+    match = re.search(rf'<{tag}\b([^>]*?)(/?)>', xml)
+    if match is None:
+        # El bloque no existe: crearlo antes del siguiente elemento que sí exista
+        bloque = f'<{tag} count="{total}">{"".join(items)}</{tag}>'
+        for siguiente in ORDEN_ESTILOS[ORDEN_ESTILOS.index(tag) + 1:]:
+            pos = xml.find(f'<{siguiente}')
+            if pos != -1:
+                return xml[:pos] + bloque + xml[pos:]
+        pos = xml.rfind('</styleSheet>')
+        return xml[:pos] + bloque + xml[pos:]
+
+    atributos = re.sub(r'\s*count="\d+"', '', match.group(1))
+    apertura = f'<{tag} count="{total}"{atributos}>'
+    if match.group(2):
+        # Bloque vacío autocerrado (<fills count="0"/>)
+        return xml[:match.start()] + apertura + ''.join(items) + f'</{tag}>' + xml[match.end():]
+
+    cierre = xml.find(f'</{tag}>', match.end())
+    return xml[:match.start()] + apertura + xml[match.end():cierre] + ''.join(items) + xml[cierre:]
+
+
+def _merge_styles(styles_original, styles_nuevo):
+    """
+    Anexa al styles.xml original los estilos usados por las hojas nuevas.
+    Devuelve el XML combinado y el mapeo de índices de estilo de celda (nuevo -> combinado).
+    """
+    original = ET.fromstring(styles_original)
+    nuevo = ET.fromstring(styles_nuevo)
+
+    def children(root, tag):
+        node = root.find(f'{{{NS_MAIN}}}{tag}')
+        return list(node) if node is not None else []
+
+    # Formatos numéricos personalizados: reutilizar los existentes por código de formato
+    formatos = {nf.get('formatCode'): int(nf.get('numFmtId')) for nf in children(original, 'numFmts')}
+    siguiente_id = max([163] + list(formatos.values())) + 1
+    mapa_formatos = {}
+    formatos_nuevos = []
+    for nf in children(nuevo, 'numFmts'):
+        id_nuevo = int(nf.get('numFmtId'))
+        codigo = nf.get('formatCode')
+        if codigo not in formatos:
+            formatos[codigo] = siguiente_id
+            nf.set('numFmtId', str(siguiente_id))
+            formatos_nuevos.append(_xml_fragment(nf))
+            siguiente_id += 1
+        mapa_formatos[id_nuevo] = formatos[codigo]
+
+    xml = styles_original.decode('utf-8')
+    xml = _append_to_block(xml, 'numFmts', formatos_nuevos, len(children(original, 'numFmts')) + len(formatos_nuevos))
+
+    # Fuentes, rellenos y bordes se anexan completos (el libro nuevo solo tiene unos pocos)
+    desplazamientos = {}
+    for tag, atributo in (('fonts', 'fontId'), ('fills', 'fillId'), ('borders', 'borderId')):
+        existentes = children(original, tag)
+        agregados = children(nuevo, tag)
+        desplazamientos[atributo] = len(existentes)
+        xml = _append_to_block(xml, tag, [_xml_fragment(e) for e in agregados], len(existentes) + len(agregados))
+
+    existentes_xf = children(original, 'cellXfs')
+    xfs_nuevos = []
+    mapa_estilos = {}
+    for idx, xf in enumerate(children(nuevo, 'cellXfs')):
+        for atributo, desplazamiento in desplazamientos.items():
+            xf.set(atributo, str(int(xf.get(atributo, 0)) + desplazamiento))
+        num_fmt = int(xf.get('numFmtId', 0))
+        xf.set('numFmtId', str(mapa_formatos.get(num_fmt, num_fmt)))
+        xf.set('xfId', '0')
+        xfs_nuevos.append(_xml_fragment(xf))
+        mapa_estilos[idx] = len(existentes_xf) + idx
+    xml = _append_to_block(xml, 'cellXfs', xfs_nuevos, len(existentes_xf) + len(xfs_nuevos))
+
+    return xml.encode('utf-8'), mapa_estilos
+
+
+def _update_workbook_xml(xml, agregadas):
+    """Registra las hojas agregadas al inicio del libro y fuerza el recálculo al abrir."""
+    if agregadas:
+        prefijo = re.search(r'<sheet\b[^>]*?\s(\w+):id="', xml)
+        prefijo = prefijo.group(1) if prefijo else 'r'
+        nuevas = ''.join(
+            f'<sheet name={quoteattr(nombre)} sheetId="{sheet_id}" {prefijo}:id="{r_id}"/>'
+            for nombre, sheet_id, r_id, _ in agregadas
+        )
+        xml = xml.replace('<sheets>', '<sheets>' + nuevas, 1)
+
+        # Las referencias por posición de hoja se desplazan igual que las hojas existentes
+        xml = re.sub(r'\b(localSheetId|activeTab)="(\d+)"',
+                     lambda m: f'{m.group(1)}="{int(m.group(2)) + len(agregadas)}"', xml)
+
+    # Igual que openpyxl: Excel recalcula las fórmulas al abrir (la cadena de cálculo se descarta)
+    match = re.search(r'<calcPr\b[^>]*?/?>', xml)
+    if match:
+        calc = re.sub(r'\s*fullCalcOnLoad="\w+"', '', match.group(0))
+        calc = calc.replace('<calcPr', '<calcPr fullCalcOnLoad="1"', 1)
+        return xml[:match.start()] + calc + xml[match.end():]
+
+    for siguiente in POSTERIORES_CALCPR + ['/workbook']:
+        pos = xml.find(f'<{siguiente}')
+        if pos != -1:
+            return xml[:pos] + '<calcPr calcId="124519" fullCalcOnLoad="1"/>' + xml[pos:]
+    return xml
+
+
+def _copy_sheet_xml(origen, destino, mapa_estilos):
+    """Copia el XML de una hoja nueva por bloques de filas, traduciendo los índices de estilo."""
+    def traducir(match):
+        return b' s="%d"' % mapa_estilos[int(match.group(1))]
+
+    pendiente = b''
+    while True:
+        bloque = origen.read(TAMANO_BLOQUE_XML)
+        datos = pendiente + bloque
+        if not bloque:
+            destino.write(PATRON_ESTILO_CELDA.sub(traducir, datos))
+            return
+
+        # Cortar siempre al final de una fila para no partir una etiqueta
+        corte = datos.rfind(b'</row>')
+        if corte == -1:
+            pendiente = datos
+            continue
+        corte += len(b'</row>')
+        destino.write(PATRON_ESTILO_CELDA.sub(traducir, datos[:corte]))
+        pendiente = datos[corte:]
+
+
+def _copy_external_sheet_xml(plantilla, filas, dimension, destino, mapa_estilos):
+    """Inserta las filas escritas por el motor streaming en el XML (vacío) que openpyxl generó para la hoja."""
+    xml = re.sub(r'<dimension ref="[^"]*"', f'<dimension ref="{dimension}"', plantilla.decode('utf-8'), count=1)
+    match = re.search(r'<sheetData\s*/>|<sheetData>\s*</sheetData>', xml)
+    destino.write(xml[:match.start()].encode('utf-8') + b'<sheetData>')
+    filas.seek(0)
+    _copy_sheet_xml(filas, destino, mapa_estilos)
+    destino.write(b'</sheetData>' + xml[match.end():].encode('utf-8'))
+
+
+def merge_output_sheets(excel_data, wb_nuevo, output_file, hojas_xml=None):
+    """
+    Genera el archivo final copiando tal cual las partes del libro original y
+    reemplazando solo las hojas contenidas en wb_nuevo. Las hojas que no existían
+    se agregan al inicio del libro, en el orden de wb_nuevo.
+
+    hojas_xml: {nombre de hoja: (archivo con las filas <row>, dimensión)} para las hojas
+    que el motor streaming escribió por fuera de openpyxl.
+    """
+    # El libro intermedio va a un archivo temporal para no duplicar en memoria las hojas nuevas
+    with tempfile.TemporaryFile() as buffer_nuevo:
+        wb_nuevo.save(buffer_nuevo)
+        buffer_nuevo.seek(0)
+        _merge_packages(excel_data, buffer_nuevo, output_file, hojas_xml or {})
+
+    return output_file
+
+
+def _merge_packages(excel_data, buffer_nuevo, output_file, hojas_xml):
+    # El libro original puede venir en memoria (bytes) o como archivo (procesamiento por bloques)
+    origen = io.BytesIO(excel_data) if isinstance(excel_data, (bytes, bytearray)) else excel_data
+    with zipfile.ZipFile(origen) as zf_orig, zipfile.ZipFile(buffer_nuevo) as zf_nuevo:
+        hojas_orig = _read_sheet_parts(zf_orig)
+        rutas_orig = {nombre: ruta for nombre, _, ruta in hojas_orig}
+        ids_hoja = [sheet_id for _, sheet_id, _ in hojas_orig]
+        styles_xml, mapa_estilos = _merge_styles(zf_orig.read('xl/styles.xml'), zf_nuevo.read('xl/styles.xml'))
+
+        rels_xml = zf_orig.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+        ids_rel = set(re.findall(r'\bId="([^"]+)"', rels_xml))
+        partes_existentes = set(zf_orig.namelist())
+
+        # Ruta de salida -> (nombre, ruta de la hoja en el libro nuevo)
+        reemplazos = {}
+        agregadas = []
+        for nombre, _, ruta_nueva in _read_sheet_parts(zf_nuevo):
+            if nombre in rutas_orig:
+                reemplazos[rutas_orig[nombre]] = (nombre, ruta_nueva)
+                continue
+
+            n = 1
+            while f'xl/worksheets/sheet{n}.xml' in partes_existentes:
+                n += 1
+            ruta = f'xl/worksheets/sheet{n}.xml'
+            partes_existentes.add(ruta)
+
+            n = 1
+            while f'rId{n}' in ids_rel:
+                n += 1
+            ids_rel.add(f'rId{n}')
+
+            agregadas.append((nombre, max(ids_hoja) + len(agregadas) + 1, f'rId{n}', ruta))
+            reemplazos[ruta] = (nombre, ruta_nueva)
+
+        # La cadena de cálculo y las relaciones de las hojas reemplazadas ya no son válidas
+        omitidas = {posixpath.join(posixpath.dirname(ruta), '_rels', posixpath.basename(ruta) + '.rels') for ruta in reemplazos}
+        omitidas.update(nombre for nombre in partes_existentes if nombre.endswith('calcChain.xml'))
+
+        rels_xml = re.sub(r'<Relationship\b[^>]*calcChain[^>]*/>', '', rels_xml)
+        rels_xml = rels_xml.replace('</Relationships>', ''.join(
+            f'<Relationship Id="{r_id}" Type="{REL_WORKSHEET}" Target="/{ruta}"/>' for _, _, r_id, ruta in agregadas
+        ) + '</Relationships>')
+
+        tipos_xml = zf_orig.read('[Content_Types].xml').decode('utf-8')
+        tipos_xml = re.sub(r'<Override\b[^>]*calcChain[^>]*/>', '', tipos_xml)
+        tipos_xml = tipos_xml.replace('</Types>', ''.join(
+            f'<Override PartName="/{ruta}" ContentType="{CONTENT_TYPE_WORKSHEET}"/>' for _, _, _, ruta in agregadas
+        ) + '</Types>')
+
+        modificadas = {
+            'xl/workbook.xml': _update_workbook_xml(zf_orig.read('xl/workbook.xml').decode('utf-8'), agregadas).encode('utf-8'),
+            'xl/_rels/workbook.xml.rels': rels_xml.encode('utf-8'),
+            '[Content_Types].xml': tipos_xml.encode('utf-8'),
+            'xl/styles.xml': styles_xml,
+        }
+
+        with zipfile.ZipFile(output_file, 'w', zipfile.ZIP_DEFLATED) as zf_out:
+
+            def copiar_hoja_nueva(ruta):
+                nombre, ruta_nueva = reemplazos[ruta]
+                with zf_nuevo.open(ruta_nueva) as origen, zf_out.open(ruta, 'w') as destino:
+                    if nombre in hojas_xml:
+                        filas, dimension = hojas_xml[nombre]
+                        _copy_external_sheet_xml(origen.read(), filas, dimension, destino, mapa_estilos)
+                    else:
+                        _copy_sheet_xml(origen, destino, mapa_estilos)
+
+            for info in zf_orig.infolist():
+                if info.filename in omitidas:
+                    continue
+                if info.filename in modificadas:
+                    zf_out.writestr(info.filename, modificadas[info.filename])
+                elif info.filename in reemplazos:
+                    copiar_hoja_nueva(info.filename)
+                else:
+                    # Hojas y partes no modificadas: se copian sin interpretarlas
+                    with zf_orig.open(info) as origen, zf_out.open(info.filename, 'w') as destino:
+                        shutil.copyfileobj(origen, destino, TAMANO_BLOQUE_XML)
+
+            for _, _, _, ruta in agregadas:
+                copiar_hoja_nueva(ruta)
+
+
+# --- FUNCIÓN 6: Rejilla de Fórmulas Vectorizada ---
+POTENCIAS_10 = 10 ** np.arange(1, 19, dtype=np.int64)
+
+
+def build_formula_templates(initial_cols, cost_names_internal):
+    """
+    Plantillas de fórmula de la hoja procesada por posición de columna (base 0), con '{0}'
+    en lugar del número de fila. Las letras de cada bloque son fijas: se calculan una sola vez.
+    """
+    plantillas = {}
+    idx_resultados = len(initial_cols) + 5 * len(cost_names_internal)
+    result_actual_letter = get_column_letter(idx_resultados + 1)
+    result_antes_letter = get_column_letter(idx_resultados + 2)
+
+    parti_cols = []
+    impacto_cols = []
+    for bloque in range(len(cost_names_internal)):
+        idx = len(initial_cols) + 5 * bloque
+        col_actual, col_antes, col_desv, col_parti, col_impacto = (get_column_letter(idx + k + 1) for k in range(5))
+        plantillas[idx + 2] = f"=IFERROR(ROUND(({col_actual}{{0}}-{col_antes}{{0}})/{col_antes}{{0}}, 4), 0)"
+        plantillas[idx + 3] = f"=IFERROR(ROUND({col_actual}{{0}}/{result_actual_letter}{{0}}, 4), 0)"
+        plantillas[idx + 4] = f"=ROUND({col_desv}{{0}}*{col_parti}{{0}}, 4)"
+        parti_cols.append(f'{col_parti}{{0}}')
+        impacto_cols.append(f'{col_impacto}{{0}}')
+
+    plantillas[idx_resultados + 2] = f"=IFERROR(ROUND(({result_actual_letter}{{0}}-{result_antes_letter}{{0}})/{result_antes_letter}{{0}}, 4), 0)"
+    plantillas[idx_resultados + 3] = f"=ROUND(SUM({'+'.join(parti_cols)}), 4)"
+    plantillas[idx_resultados + 4] = f"=ROUND(SUM({'+'.join(impacto_cols)}), 4)"
+    return plantillas
+
+
+def fill_row_template(plantilla, filas):
+    """
+    Sustituye '{0}' por cada número de fila sin recorrer las filas en Python: los tramos fijos
+    de la plantilla y los dígitos de cada fila se copian por columnas a una matriz de bytes.
+    Devuelve un arreglo de bytes UTF-8 (dtype 'S'), uno por fila.
+    """
+    filas = np.asarray(filas, dtype=np.int64)
+    partes = [np.frombuffer(parte.encode('utf-8'), dtype=np.uint8) for parte in plantilla.split('{0}')]
+    ocurrencias = len(partes) - 1
+    largo_fijo = sum(len(parte) for parte in partes)
+
+    # Las filas de un mismo lote tienen a lo sumo dos cantidades de dígitos distintas
+    n_digitos = np.searchsorted(POTENCIAS_10, filas, side='right') + 1
+    resultado = np.empty(len(filas), dtype=f'S{max(largo_fijo + ocurrencias * int(n_digitos.max(initial=1)), 1)}')
+    for d in np.unique(n_digitos):
+        seleccion = n_digitos == d
+        digitos = ((filas[seleccion, None] // 10 ** np.arange(d - 1, -1, -1)) % 10 + ord('0')).astype(np.uint8)
+
+        matriz = np.empty((len(digitos), largo_fijo + ocurrencias * d), dtype=np.uint8)
+        pos = 0
+        for i, parte in enumerate(partes):
+            matriz[:, pos:pos + len(parte)] = parte
+            pos += len(parte)
+            if i < ocurrencias:
+                matriz[:, pos:pos + d] = digitos
+                pos += d
+        resultado[seleccion] = matriz.view(f'S{matriz.shape[1]}').ravel()
+    return resultado
+
+
+def build_formula_grid(plantillas, filas):
+    """
+    Matriz de fórmulas (filas x columnas de fórmula, en orden de posición) para los números
+    de fila de Excel dados, como bytes UTF-8. Se construye columna por columna con fill_row_template.
+    """
+    return np.column_stack([fill_row_template(plantillas[pos], filas) for pos in sorted(plantillas)])
+
+
+# --- FUNCIÓN 7: Cálculo Vectorizado de las Métricas (mismos resultados que las fórmulas) ---
+def excel_round(valores, decimales=4):
+    """
+    ROUND de Excel con NumPy: el .5 se redondea alejándose de cero y el valor se toma a 15 cifras
+    significativas antes de redondear (ROUND(2.675, 2) = 2.68 aunque en binario sea 2.67499...).
+    """
+    valores = np.asarray(valores, dtype=np.float64)
+    escala = 10.0 ** decimales
+    absolutos = np.abs(valores) * escala
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponente = np.clip(np.floor(np.log10(absolutos)), -1, 14)
+    ajuste = 10.0 ** (14 - np.nan_to_num(exponente))
+    absolutos = np.round(absolutos * ajuste) / ajuste
+    # + 0.0 convierte -0.0 en 0.0 (Excel no tiene cero negativo)
+    return np.copysign(np.floor(absolutos + 0.5) / escala, valores) + 0.0
+
+
+def excel_iferror(valores, valor_si_error=0):
+    """IFERROR de Excel: los errores (NaN / infinito en el cálculo vectorizado) se reemplazan."""
+    return np.where(np.isfinite(valores), valores, valor_si_error)
+
+
+def _formula_operand(serie):
+    """Valor de una celda como operando de Excel: vacía = 0, texto no numérico = error (NaN)."""
+    numeros = pd.to_numeric(serie, errors='coerce')
+    return numeros.mask(serie.isna(), 0).to_numpy(dtype=np.float64)
+
+
+def compute_formula_values(df_data, initial_cols, cost_names_internal):
+    """
+    Resultados de las fórmulas de build_formula_templates calculados por columnas, con la misma
+    posición (base 0) como clave. Replica ROUND(..., 4) e IFERROR(..., 0) de Excel.
+    """
+    resultados = {}
+    idx_resultados = len(initial_cols) + 5 * len(cost_names_internal)
+    result_actual = _formula_operand(df_data['Result actualizado'])
+    result_antes = _formula_operand(df_data['Resultado anterior'])
+    suma_parti = np.zeros(len(df_data))
+    suma_impacto = np.zeros(len(df_data))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for bloque, costo_interno in enumerate(cost_names_internal):
+            idx = len(initial_cols) + 5 * bloque
+            actual = _formula_operand(df_data[f'{costo_interno} Actual'])
+            antes = _formula_operand(df_data[f'{costo_interno} Antes'])
+
+            desv = excel_iferror(excel_round((actual - antes) / antes, 4), 0)
+            parti = excel_iferror(excel_round(actual / result_actual, 4), 0)
+            impacto = excel_round(desv * parti, 4)
+            resultados[idx + 2], resultados[idx + 3], resultados[idx + 4] = desv, parti, impacto
+
+            # SUM de Excel: suma de izquierda a derecha
+            suma_parti = suma_parti + parti
+            suma_impacto = suma_impacto + impacto
+
+        resultados[idx_resultados + 2] = excel_iferror(excel_round((result_actual - result_antes) / result_antes, 4), 0)
+    resultados[idx_resultados + 3] = excel_round(suma_parti, 4)
+    resultados[idx_resultados + 4] = excel_round(suma_impacto, 4)
+    return resultados
+
+
+# --- FUNCIÓN 8: Motor de Escritura en Streaming (XML de la hoja escrito directamente) ---
+MOTOR_CELDAS = 'celdas'
+MOTOR_STREAMING = 'streaming'
+# Vínculos del consolidado: una fórmula por celda, fórmula compartida o fórmula de matriz por columna
+VINCULO_CELDAS = 'celdas'
+VINCULO_COMPARTIDO = 'compartido'
+VINCULO_MATRIZ = 'matriz'
+TAMANO_LOTE_FILAS = 5000
+# Contenido de las columnas calculadas según el modo de salida (aviso de éxito)
+CONTENIDO_SALIDA = {
+    MODO_FORMULAS: 'fórmulas Excel',
+    MODO_FORMULAS_CACHE: 'fórmulas Excel con sus valores ya calculados',
+    MODO_VALORES: 'valores estáticos (sin fórmulas)',
+}
+# Número de fila de los fragmentos producidos con con_marca=True (el XML no admite el carácter NUL)
+MARCA_FILA = '\x00'
+
+
+def _style_attr(ws, number_format=None, font=None, fill=None, border=None):
+    """Atributo s="N" de la combinación de estilo, registrada en el libro de ws (vacío si no hay estilo)."""
+    cell = _styled_cell(ws, number_format, font, fill, border)
+    return f' s="{cell.style_id}"' if cell.has_style else ''
+
+
+def _xml_cell(ref, cell, s):
+    """Serializa una celda igual que el escritor de openpyxl (cell ya tiene el valor asignado)."""
+    value = cell._value
+    if value is None:
+        return f'<c r="{ref}"{s} />' if s else ''
+
+    data_type = cell.data_type
+    if data_type == 'f':
+        return f'<c r="{ref}"{s}><f>{escape(value[1:])}</f><v /></c>'
+    if data_type == 's':
+        if value == '':
+            return f'<c r="{ref}"{s} t="inlineStr" />'
+        space = ' xml:space="preserve"' if value.strip() and value != value.strip() else ''
+        return f'<c r="{ref}"{s} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+    if data_type == 'd':
+        value = to_excel(value)
+        if value is None:
+            return f'<c r="{ref}"{s} t="n" />'
+        data_type = 'n'
+
+    value = safe_string(value)
+    if value == '':
+        return f'<c r="{ref}"{s} t="{data_type}"><v /></c>'
+    return f'<c r="{ref}"{s} t="{data_type}"><v>{escape(value)}</v></c>'
+
+
+def _formula_result_xml(valor):
+    """Atributo t y contenido de <v> del resultado en caché de una fórmula que devuelve valor."""
+    if valor is None or pd.isna(valor):
+        # Una referencia a una celda vacía devuelve 0
+        return b'', b'0'
+    if isinstance(valor, str):
+        return b' t="str"', escape(valor).encode('utf-8')
+    if isinstance(valor, bool):
+        return b' t="b"', b'1' if valor else b'0'
+    if not isinstance(valor, (int, float)):
+        valor = to_excel(valor)
+    return b'', safe_string(valor).encode('utf-8')
+
+
+def _batch_values(valores, inicio, fin):
+    """
+    Posiciones [inicio, fin) de una Serie, un arreglo o una lista como lista de Python. Los productores
+    reciben la columna entera y convierten solo el lote que escriben, así la memoria no crece con las filas.
+    """
+    if isinstance(valores, pd.Series):
+        return valores.iloc[inicio:fin].tolist()
+    if isinstance(valores, np.ndarray):
+        return valores[inicio:fin].tolist()
+    return list(valores[inicio:fin])
+
+
+def _value_column(ws, letra, valores, s_valor, s_vacio, number_format=None, border=None, fila_inicial=2, valor_vacio=None):
+    """
+    Productor de fragmentos <c> para una columna de valores del DataFrame (valores[0] va en fila_inicial).
+    Con valor_vacio, las celdas vacías (None / NaN) se escriben con ese valor. Como todos los productores,
+    con con_marca=True deja MARCA_FILA en lugar del número de fila (plantilla de la fila).
+    """
+    celda = WriteOnlyCell(ws)
+    estilos_fecha = {}
+
+    def producir(inicio, fin, con_marca=False):
+        lote = _batch_values(valores, inicio - fila_inicial, fin - fila_inicial)
+        if valor_vacio is not None:
+            lote = [valor_vacio if pd.isna(valor) else valor for valor in lote]
+        fragmentos = []
+        for excel_row_num, valor in zip(range(inicio, fin), lote):
+            celda.value = valor
+            s = s_valor if valor is not None else s_vacio
+            if celda.data_type == 'd' and not number_format:
+                # openpyxl asigna el formato de fecha al escribir el valor
+                formato = celda.number_format
+                if formato not in estilos_fecha:
+                    estilos_fecha[formato] = _style_attr(ws, formato, border=border)
+                s = estilos_fecha[formato]
+            fragmentos.append(_xml_cell(f'{letra}{MARCA_FILA if con_marca else excel_row_num}', celda, s).encode('utf-8'))
+        return fragmentos
+
+    return producir
+
+
+def _template_column(plantilla_xml):
+    """Productor de fragmentos <c> a partir de una plantilla con '{0}' en lugar del número de fila."""
+    marcado = plantilla_xml.replace('{0}', MARCA_FILA).encode('utf-8')
+
+    def producir(inicio, fin, con_marca=False):
+        if con_marca:
+            return [marcado] * (fin - inicio)
+        return fill_row_template(plantilla_xml, np.arange(inicio, fin)).tolist()
+    return producir
+
+
+def _cached_column(plantilla_xml, valores, fila_inicial=2):
+    """
+    Productor de fragmentos <c> de fórmula con su resultado en caché. La plantilla lleva '{0}' en lugar
+    del número de fila, '{t}' donde va el atributo de tipo y '{v}' donde va el valor (valores[0] va en fila_inicial).
+    """
+    apertura, resto = plantilla_xml.split('{t}')
+    formula, cierre = resto.split('{v}')
+    cierre = cierre.encode('utf-8')
+    apertura_marcada, formula_marcada = (parte.replace('{0}', MARCA_FILA).encode('utf-8') for parte in (apertura, formula))
+
+    def producir(inicio, fin, con_marca=False):
+        fragmentos = []
+        lote = _batch_values(valores, inicio - fila_inicial, fin - fila_inicial)
+        if con_marca:
+            aperturas, formulas = [apertura_marcada] * len(lote), [formula_marcada] * len(lote)
+        else:
+            filas = np.arange(inicio, fin)
+            aperturas, formulas = fill_row_template(apertura, filas).tolist(), fill_row_template(formula, filas).tolist()
+        for a, f, valor in zip(aperturas, formulas, lote):
+            t, v = _formula_result_xml(valor)
+            fragmentos.append(a + t + f + v + cierre)
+        return fragmentos
+
+    return producir
+
+
+def _first_row_column(fragmento_fila_2, producir):
+    """Productor que usa fragmento_fila_2 para la primera fila de datos y producir para las demás."""
+    def producir_con_primera(inicio, fin, con_marca=False):
+        fragmentos = producir(inicio, fin, con_marca)
+        if inicio == 2:
+            fragmentos[0] = fragmento_fila_2
+        return fragmentos
+    return producir_con_primera
+
+
+def _write_xml_rows(destino, encabezado_xml, columnas, num_rows, fila_inicial=2):
+    """
+    Escribe las filas <row> de la hoja por lotes: cada columna genera su lote y luego se unen por fila.
+    Con encabezado_xml=None se escriben solo las num_rows filas de datos desde fila_inicial.
+    """
+    if encabezado_xml is not None:
+        destino.write(f'<row r="1">{encabezado_xml}</row>'.encode('utf-8'))
+    for inicio in range(fila_inicial, fila_inicial + num_rows, TAMANO_LOTE_FILAS):
+        fin = min(inicio + TAMANO_LOTE_FILAS, fila_inicial + num_rows)
+        lote = [producir(inicio, fin) for producir in columnas]
+        filas = (b'<row r="%d">%s</row>' % (excel_row_num, b''.join(celdas)) for excel_row_num, celdas in zip(range(inicio, fin), zip(*lote)))
+        destino.write(b''.join(filas))
+
+
+def _header_xml(ws, header, estilos):
+    celda = WriteOnlyCell(ws)
+    fragmentos = []
+    for idx, (name, s) in enumerate(zip(header, estilos)):
+        celda.value = name
+        fragmentos.append(_xml_cell(f'{get_column_letter(idx + 1)}1', celda, s))
+    return ''.join(fragmentos)
+
+
+def _processed_sheet_columns(ws, layout, output_mode):
+    """
+    Estilos del encabezado de la hoja procesada y, por columna, una función (df_data, resultados,
+    fila_inicial) -> productor de fragmentos <c>. Los estilos salen de layout (SheetLayout, mismo
+    criterio que apply_excel_formatting) y se registran una vez por columna, así la hoja puede escribirse por partes.
+    """
+    plantillas = layout.plantillas
+
+    estilos_encabezado = []
+    columnas = []
+    for name, fuente, letra in zip(layout.header, layout.sources, layout.letters):
+        pos = len(columnas)
+        number_format, fill, border = layout.processed_style(name)
+        estilos_encabezado.append(_style_attr(ws, font=font_black_bold, fill=fill, border=border))
+
+        s_valor = _style_attr(ws, number_format, border=border)
+        s_vacio = _style_attr(ws, border=border)
+        if fuente is not None:
+            def columna(df_data, resultados, fila_inicial, letra=letra, fuente=fuente, s_valor=s_valor, s_vacio=s_vacio, number_format=number_format, border=border):
+                return _value_column(ws, letra, df_data[fuente], s_valor, s_vacio, number_format, border, fila_inicial)
+        elif output_mode == MODO_VALORES:
+            def columna(df_data, resultados, fila_inicial, letra=letra, pos=pos, s_valor=s_valor, s_vacio=s_vacio, number_format=number_format, border=border):
+                return _value_column(ws, letra, resultados[pos], s_valor, s_vacio, number_format, border, fila_inicial)
+        elif output_mode == MODO_FORMULAS_CACHE:
+            plantilla = f'<c r="{letra}{{0}}"{s_valor}{{t}}><f>{escape(plantillas[pos][1:])}</f><v>{{v}}</v></c>'
+
+            def columna(df_data, resultados, fila_inicial, plantilla=plantilla, pos=pos):
+                return _cached_column(plantilla, resultados[pos], fila_inicial)
+        else:
+            producir = _template_column(f'<c r="{letra}{{0}}"{s_valor}><f>{escape(plantillas[pos][1:])}</f><v /></c>')
+
+            def columna(df_data, resultados, fila_inicial, producir=producir):
+                return producir
+        columnas.append(columna)
+
+    return estilos_encabezado, columnas
+
+
+def write_processed_sheet_streaming(wb, hojas_xml, sheet_name, df_data, cost_names_internal, output_cost_names, initial_cols, output_mode=MODO_FORMULAS, resultados=None, incremental=None):
+    """
+    Variante de write_processed_sheet_with_formulas + apply_excel_formatting que escribe
+    el XML de la hoja directamente a un archivo temporal, por lotes de filas. Las fórmulas
+    salen de una plantilla precalculada por columna y el estilo se resuelve una vez por columna.
+    En wb solo queda una hoja vacía (posición y registro de estilos); el XML se agrega a hojas_xml.
+    Con MODO_VALORES o MODO_FORMULAS_CACHE las columnas calculadas usan resultados
+    (compute_formula_values) como valor estático o como resultado en caché de la fórmula.
+    Con incremental (IncrementalState ya preparado) las filas sin cambios se copian de la corrida anterior.
+    """
+    try:
+        ws = wb.create_sheet(sheet_name)
+
+        layout = sheet_layout(initial_cols, cost_names_internal, output_cost_names)
+        header = list(layout.header)
+        estilos_encabezado, columnas = _processed_sheet_columns(ws, layout, output_mode)
+
+        destino = tempfile.TemporaryFile()
+        hojas_xml[sheet_name] = (destino, f'A1:{get_column_letter(len(header))}{len(df_data) + 1}')
+        columnas = [columna(df_data, resultados, 2) for columna in columnas]
+        if incremental is not None:
+            incremental.write_rows(destino, sheet_name, _header_xml(ws, header, estilos_encabezado), columnas, len(df_data))
+        else:
+            _write_xml_rows(destino, _header_xml(ws, header, estilos_encabezado), columnas, len(df_data))
+
+        return header
+
+    except Exception as e:
+        logger.error(f"❌ Error al escribir la hoja procesada en modo streaming: {e}")
+        return []
+
+
+def _consolidation_columns(ws_consolidado, processed_sheet_name, df_output_headers, df_consolidado_headers, output_mode, link_mode, layout=None):
+    """
+    Estilos del encabezado del consolidado y, por columna, una función (df_data, resultados, fila_inicial,
+    num_rows) -> productor de fragmentos <c>. num_rows (filas de la hoja completa) solo se usa para la
+    fórmula compartida o de matriz de la fila 2, que abarca la columna entera.
+    """
+    if layout is None:
+        layout = sheet_layout()
+    if list(df_output_headers) == layout.header:
+        header_map = layout.header_map
+    else:
+        header_map = {col_name: idx + 1 for idx, col_name in enumerate(df_output_headers)}
+
+    estilos_encabezado = []
+    columnas = []
+    formulas_compartidas = 0
+    for col_idx_con, col_name_con in enumerate(df_consolidado_headers):
+        letra = get_column_letter(col_idx_con + 1)
+        source_col_idx = header_map.get(col_name_con)
+        if source_col_idx is None:
+            # Igual que en el modo por celdas: la columna queda con ceros y sin formato
+            logger.warning(f"Advertencia: Columna '{col_name_con}' no encontrada en la hoja origen. Se saltará.")
+            estilos_encabezado.append('')
+            producir = _template_column(f'<c r="{letra}{{0}}" t="n"><v>0</v></c>')
+            columnas.append(lambda df_data, resultados, fila_inicial, num_rows, producir=producir: producir)
+            continue
+
+        number_format, fill = layout.consolidated_style(col_name_con)
+        estilos_encabezado.append(_style_attr(ws_consolidado, font=font_black_bold, fill=fill))
+
+        s_valor = _style_attr(ws_consolidado, number_format)
+        si = None
+        if link_mode == VINCULO_COMPARTIDO:
+            si = formulas_compartidas
+            formulas_compartidas += 1
+
+        def columna(df_data, resultados, fila_inicial, num_rows, letra=letra, col_name_con=col_name_con, pos=source_col_idx - 1,
+                    letra_origen=get_column_letter(source_col_idx), number_format=number_format, s_valor=s_valor, si=si):
+            valores = None
+            if output_mode != MODO_FORMULAS:
+                valores = resultados[pos] if pos in resultados else df_data[col_name_con]
+
+            if output_mode == MODO_VALORES:
+                # La fórmula vinculante devolvería 0 para las celdas vacías
+                return _value_column(ws_consolidado, letra, valores, s_valor, s_valor, number_format, fila_inicial=fila_inicial, valor_vacio=0)
+
+            def celda(formula_xml):
+                # Celda con el contenido de <f> dado (con '{0}' = fila), con o sin resultado en caché
+                if output_mode == MODO_FORMULAS:
+                    return _template_column(f'<c r="{letra}{{0}}"{s_valor}>{formula_xml}<v /></c>')
+                return _cached_column(f'<c r="{letra}{{0}}"{s_valor}{{t}}>{formula_xml}<v>{{v}}</v></c>', valores, fila_inicial)
+
+            hoja_origen = f"'{processed_sheet_name}'!"
+            if num_rows == 0 or link_mode == VINCULO_CELDAS:
+                return celda(f'<f>{escape(hoja_origen + letra_origen)}{{0}}</f>')
+
+            if link_mode == VINCULO_MATRIZ:
+                if output_mode == MODO_FORMULAS:
+                    resto = _template_column(f'<c r="{letra}{{0}}"{s_valor} />')
+                else:
+                    resto = _cached_column(f'<c r="{letra}{{0}}"{s_valor}{{t}}><v>{{v}}</v></c>', valores, fila_inicial)
+            else:
+                resto = celda(f'<f t="shared" si="{si}" />')
+            if fila_inicial != 2:
+                return resto
+
+            # La fila 2 define la fórmula de la columna entera
+            rango = f'{letra}2:{letra}{num_rows + 1}'
+            if link_mode == VINCULO_MATRIZ:
+                formula = escape(f'{hoja_origen}{letra_origen}2:{letra_origen}{num_rows + 1}')
+                maestra = celda(f'<f t="array" ref="{rango}">{formula}</f>')(2, 3)[0]
+            else:
+                maestra = celda(f'<f t="shared" ref="{rango}" si="{si}">{escape(hoja_origen + letra_origen)}2</f>')(2, 3)[0]
+            return _first_row_column(maestra, resto)
+
+        columnas.append(columna)
+
+    return estilos_encabezado, columnas
+
+
+def write_consolidation_streaming(wb, hojas_xml, processed_sheet_name, consolidated_sheet_name, df_output_headers, df_consolidado_headers, num_rows, output_mode=MODO_FORMULAS, df_data=None, resultados=None, link_mode=VINCULO_COMPARTIDO, incremental=None):
+    """
+    Variante de apply_consolidation_formulas para el motor streaming: escribe directamente
+    las fórmulas vinculantes, sin llenar antes la hoja con valores dummy. En los modos con
+    valores calculados, el valor de cada celda es el de la hoja procesada (df_data o resultados).
+    link_mode define cómo se escriben los vínculos de cada columna:
+    - VINCULO_COMPARTIDO: una fórmula compartida (la fila 2 la define, el resto la reutiliza).
+    - VINCULO_MATRIZ: una fórmula de matriz sobre el rango completo de la columna origen;
+      las filas no se pueden editar por separado.
+    - VINCULO_CELDAS: una fórmula independiente por celda, como el modo por celdas.
+    Con incremental (IncrementalState ya preparado) las filas sin cambios se copian de la corrida anterior.
+    """
+    try:
+        ws_consolidado = wb.create_sheet(consolidated_sheet_name, index=0)
+        estilos_encabezado, columnas = _consolidation_columns(ws_consolidado, processed_sheet_name, df_output_headers, df_consolidado_headers, output_mode, link_mode)
+
+        destino = tempfile.TemporaryFile()
+        hojas_xml[consolidated_sheet_name] = (destino, f'A1:{get_column_letter(len(df_consolidado_headers))}{num_rows + 1}')
+        encabezado_xml = _header_xml(ws_consolidado, df_consolidado_headers, estilos_encabezado)
+        columnas = [columna(df_data, resultados, 2, num_rows) for columna in columnas]
+        if incremental is not None:
+            incremental.write_rows(destino, consolidated_sheet_name, encabezado_xml, columnas, num_rows)
+        else:
+            _write_xml_rows(destino, encabezado_xml, columnas, num_rows)
+
+    except Exception as e:
+        logger.error(f"❌ Error al escribir el consolidado en modo streaming: {e}")
+        return
+
+
+def write_frame_sheet_streaming(wb, hojas_xml, sheet_name, df, number_formats, index=None):
+    """
+    Escribe df como hoja de valores con el motor streaming: encabezado en negrita (con los colores de
+    la hoja procesada para variaciones e impactos) y number_formats {columna: formato} por columna.
+    Las celdas NaN quedan vacías. index: posición de la hoja en wb (por defecto, al final).
+    """
+    ws = wb.create_sheet(sheet_name, index=index)
+
+    estilos_encabezado = []
+    columnas = []
+    for pos, name in enumerate(df.columns):
+        fill = None
+        if name == '% Variacion Resultado':
+            fill = fill_variacion_blue
+        elif 'Impacto' in name:
+            fill = fill_impacto_green
+        estilos_encabezado.append(_style_attr(ws, font=font_black_bold, fill=fill))
+
+        number_format = number_formats.get(name)
+        serie = df[name]
+        valores = serie.astype(object).where(serie.notna(), None)
+        columnas.append(_value_column(ws, get_column_letter(pos + 1), valores, _style_attr(ws, number_format), '', number_format))
+
+    destino = tempfile.TemporaryFile()
+    hojas_xml[sheet_name] = (destino, f'A1:{get_column_letter(len(df.columns))}{len(df) + 1}')
+    _write_xml_rows(destino, _header_xml(ws, list(df.columns), estilos_encabezado), columnas, len(df))
+
+
+# --- FUNCIÓN 9: Caché de Resultados (direccionada por contenido) ---
+class ResultCache:
+    """
+    Caché LRU de resultados de process_excel_data. Las claves son hashes SHA-256 del contenido
+    del libro y de la configuración, de modo que la misma carga repetida (o con otro nombre de
+    archivo) se resuelve sin volver a procesar. Guarda el DataFrame combinado y los bytes del
+    libro de salida, con un tope de max_bytes en memoria; si se indica directorio, también se
+    guardan en disco (tope max_disk_bytes) y sobreviven a reinicios de la aplicación.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, directorio=None, max_disk_bytes=2 * 2**30):
+        self.max_bytes = max_bytes
+        self.directorio = directorio
+        self.max_disk_bytes = max_disk_bytes
+        self._entradas = OrderedDict()  # clave -> (valor, tamaño), de la menos a la más reciente
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._en_curso = {}  # clave -> [lock, solicitudes en curso]
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+
+    @staticmethod
+    def key(*partes):
+        """Hash del contenido de las partes (bytes tal cual; el resto por su repr)."""
+        digest = hashlib.sha256()
+        for parte in partes:
+            datos = parte if isinstance(parte, bytes) else repr(parte).encode('utf-8')
+            digest.update(len(datos).to_bytes(8, 'little'))
+            digest.update(datos)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _size(valor):
+        if isinstance(valor, pd.DataFrame):
+            return int(valor.memory_usage(deep=True).sum())
+        return len(valor)
+
+    def _disk_path(self, clave):
+        return os.path.join(self.directorio, f'{clave}.pkl')
+
+    def get(self, clave):
+        """Valor guardado para la clave (None si no está). Un acierto en disco se sube a memoria."""
+        with self._lock:
+            if clave in self._entradas:
+                self._entradas.move_to_end(clave)
+                return self._entradas[clave][0]
+        if not self.directorio:
+            return None
+        ruta = self._disk_path(clave)
+        try:
+            with open(ruta, 'rb') as archivo:
+                valor = pickle.load(archivo)
+            os.utime(ruta)  # la fecha de modificación hace de "último uso" en disco
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self._remember(clave, valor)
+        return valor
+
+    def put(self, clave, valor):
+        """Guarda el valor. Devuelve False si no quedó en la caché porque supera el tope de memoria y el de disco."""
+        guardado = self._remember(clave, valor)
+        # Un valor más grande que todo el disco de la caché no se escribe: solo desplazaría las demás entradas
+        if self.directorio and self._size(valor) <= self.max_disk_bytes:
+            # Se escribe a un temporal y se renombra: otro proceso nunca lee un archivo a medias
+            temporal = f'{self._disk_path(clave)}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temporal, 'wb') as archivo:
+                pickle.dump(valor, archivo, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporal, self._disk_path(clave))
+            self._evict_disk()
+            guardado = True
+        return guardado
+
+    def _remember(self, clave, valor):
+        tamano = self._size(valor)
+        if tamano > self.max_bytes:
+            return False
+        with self._lock:
+            if clave in self._entradas:
+                self._bytes -= self._entradas.pop(clave)[1]
+            self._entradas[clave] = (valor, tamano)
+            self._bytes += tamano
+            while self._bytes > self.max_bytes:
+                _, (_, tamano_viejo) = self._entradas.popitem(last=False)
+                self._bytes -= tamano_viejo
+        return True
+
+    def _evict_disk(self):
+        archivos = []
+        for nombre in os.listdir(self.directorio):
+            if nombre.endswith('.pkl'):
+                try:
+                    info = os.stat(os.path.join(self.directorio, nombre))
+                except OSError:
+                    continue
+                archivos.append((info.st_mtime, info.st_size, nombre))
+        total = sum(tamano for _, tamano, _ in archivos)
+        for _, tamano, nombre in sorted(archivos):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directorio, nombre))
+            except OSError:
+                pass
+            total -= tamano
+
+    @contextmanager
+    def computing(self, clave):
+        """Serializa el cálculo de una misma clave: las demás solicitudes esperan y luego leen la caché."""
+        with self._lock:
+            entrada = self._en_curso.setdefault(clave, [threading.Lock(), 0])
+            entrada[1] += 1
+        try:
+            with entrada[0]:
+                yield
+        finally:
+            with self._lock:
+                entrada[1] -= 1
+                if not entrada[1]:
+                    del self._en_curso[clave]
+
+
+# --- FUNCIÓN 10: Combinación Validada de ACTUAL con ANTERIOR ---
+MAX_EJEMPLOS_MATERIALES = 10
+
+
+def resolve_duplicates(df, duplicate_policy, hoja, columnas_suma=None):
+    """
+    Deja una sola fila por CLAVE_MERGE según duplicate_policy. Con DUPLICADOS_SUMA se suman
+    columnas_suma (por defecto todas) y del resto se toma el primer valor. Devuelve
+    (DataFrame, materiales repetidos).
+    """
+    claves = df[CLAVE_MERGE]
+    repetidos = claves[claves.duplicated()].unique()
+    if not len(repetidos):
+        return df, repetidos
+
+    if duplicate_policy == DUPLICADOS_ERROR:
+        ejemplos = ', '.join(map(str, repetidos[:MAX_EJEMPLOS_MATERIALES]))
+        raise ValueError(f"{len(repetidos)} materiales repetidos en '{hoja}' (p. ej. {ejemplos})")
+    if duplicate_policy == DUPLICADOS_SUMA:
+        if columnas_suma is None:
+            columnas_suma = [c for c in df.columns if c != CLAVE_MERGE]
+        valores = df[columnas_suma].apply(pd.to_numeric, errors='coerce')
+        agrupado = valores.groupby(claves, sort=False, dropna=False).sum(min_count=1)
+        otras = [c for c in df.columns if c != CLAVE_MERGE and c not in columnas_suma]
+        if otras:
+            agrupado = df[otras].groupby(claves, sort=False, dropna=False).first().join(agrupado)
+        return agrupado.reset_index()[list(df.columns)], repetidos
+
+    conservar = 'last' if duplicate_policy == DUPLICADOS_ULTIMO else 'first'
+    return df[~claves.duplicated(keep=conservar)], repetidos
+
+
+def merge_periods(df_actual, df_anterior, duplicate_policy=DUPLICADOS_PRIMERO):
+    """
+    Combinación izquierda de ACTUAL con ANTERIOR por CLAVE_MERGE sin multiplicar filas. Los materiales
+    repetidos en ANTERIOR se resuelven antes de cruzar según duplicate_policy: DUPLICADOS_PRIMERO
+    (como BUSCARV), DUPLICADOS_ULTIMO, DUPLICADOS_SUMA o DUPLICADOS_ERROR (ValueError).
+    Devuelve (DataFrame combinado, resumen de materiales coincidentes / nuevos / dados de baja).
+    """
+    claves_anterior = df_anterior[CLAVE_MERGE]
+    df_anterior, repetidos_anterior = resolve_duplicates(df_anterior, duplicate_policy, HOJA_ANTERIOR)
+
+    # Índice único sobre el material: el cruce es una búsqueda por hash por fila (tiempo lineal)
+    indice_anterior = pd.Index(df_anterior[CLAVE_MERGE])
+    posiciones = indice_anterior.get_indexer(df_actual[CLAVE_MERGE])
+    df_procesado = df_actual.join(df_anterior.set_index(CLAVE_MERGE), on=CLAVE_MERGE)
+
+    claves_actual = df_actual[CLAVE_MERGE]
+    nuevos = claves_actual[posiciones < 0]
+    dados_de_baja = indice_anterior[~indice_anterior.isin(claves_actual)]
+    resumen = {
+        'filas_actual': len(df_actual),
+        'filas_anterior': len(claves_anterior),
+        'coincidentes': int((posiciones >= 0).sum()),
+        'nuevos': len(nuevos),
+        'dados_de_baja': len(dados_de_baja),
+        'repetidos_actual': int(claves_actual[claves_actual.duplicated()].nunique(dropna=False)),
+        'repetidos_anterior': len(repetidos_anterior),
+        'resolucion_repetidos': duplicate_policy,
+        'ejemplos': {
+            'nuevos': nuevos.head(MAX_EJEMPLOS_MATERIALES).tolist(),
+            'dados_de_baja': dados_de_baja[:MAX_EJEMPLOS_MATERIALES].tolist(),
+            'repetidos_anterior': repetidos_anterior[:MAX_EJEMPLOS_MATERIALES].tolist(),
+        },
+    }
+    return df_procesado, resumen
+
+
+def report_merge_summary(resumen):
+    """Mensajes del resumen de la combinación: un resumen informativo y advertencias por repetidos."""
+    logger.info(f"📋 Materiales: {resumen['coincidentes']} con período anterior, {resumen['nuevos']} nuevos "
+                f"(sin costos anteriores) y {resumen['dados_de_baja']} dados de baja (solo en '{HOJA_ANTERIOR}').")
+    if resumen['repetidos_anterior']:
+        ejemplos = ', '.join(map(str, resumen['ejemplos']['repetidos_anterior']))
+        logger.warning(f"Advertencia: {resumen['repetidos_anterior']} materiales repetidos en '{HOJA_ANTERIOR}' "
+                       f"(p. ej. {ejemplos}). Criterio aplicado: {resumen['resolucion_repetidos']}.")
+    if resumen['repetidos_actual']:
+        logger.warning(f"Advertencia: {resumen['repetidos_actual']} materiales repetidos en '{HOJA_ACTUAL}'; se conservan todas sus filas.")
+
+
+# --- FUNCIÓN 11: Tendencia de Costos de Varios Períodos ---
+COLUMNA_PERIODO = 'Periodo'
+COLUMNA_PERIODO_ANTERIOR = 'Periodo anterior'
+
+
+def workbook_sheet_names(excel_data):
+    """Nombres de las hojas del libro, en orden, sin leer su contenido (modo de solo lectura de openpyxl)."""
+    wb = load_workbook(io.BytesIO(excel_data), read_only=True)
+    try:
+        return wb.sheetnames
+    finally:
+        wb.close()
+
+
+def read_period_sheets(excel_data, sheet_names):
+    """Lee las hojas de período indicadas con una sola apertura del libro: [(hoja, DataFrame)] en el orden dado."""
+    hojas = pd.read_excel(io.BytesIO(excel_data), sheet_name=list(sheet_names), header=0, engine='openpyxl')
+    return [(nombre, hojas[nombre]) for nombre in sheet_names]
+
+
+def stack_periods(periodos, duplicate_policy=DUPLICADOS_PRIMERO):
+    """
+    Apila los períodos [(etiqueta, DataFrame)], en orden cronológico, en un único DataFrame largo con
+    una fila por material y período (COLUMNA_PERIODO categórica, en el orden recibido). Los materiales
+    repetidos dentro de un período se resuelven con duplicate_policy y los costos se redondean igual
+    que en prepare_input_frame. Devuelve (DataFrame, {etiqueta: materiales repetidos}).
+    """
+    etiquetas = [etiqueta for etiqueta, _ in periodos]
+    if len(set(etiquetas)) != len(etiquetas):
+        raise ValueError(f"hay períodos con el mismo nombre: {etiquetas}")
+
+    valores = NOMBRES_COSTOS_INTERNOS + [COLUMNA_RESULTADO]
+    columnas = [CLAVE_MERGE, 'Texto breve material'] + valores
+    marcos = []
+    codigos = []
+    repetidos = {}
+    for orden, (etiqueta, df) in enumerate(periodos):
+        df = df.rename(columns={'Materia': 'Materia_Costo'})
+        faltantes = [c for c in columnas if c not in df.columns]
+        if faltantes:
+            raise ValueError(f"faltan las columnas {faltantes} en el período '{etiqueta}'")
+        df, repetidos_periodo = resolve_duplicates(df[columnas], duplicate_policy, etiqueta, valores)
+        if len(repetidos_periodo):
+            repetidos[etiqueta] = len(repetidos_periodo)
+        marcos.append(df)
+        codigos.append(np.full(len(df), orden, dtype=np.int32))
+
+    largo = pd.concat(marcos, ignore_index=True)
+    largo[COLUMNA_PERIODO] = pd.Categorical.from_codes(np.concatenate(codigos), categories=etiquetas, ordered=True)
+    redondeadas, forzadas = round_numeric_columns(largo, valores, set(COLUMNAS_ENTEROS))
+    for col in valores:
+        largo[col] = redondeadas[col]
+    report_coerced_cells(forzadas, HOJA_TENDENCIA)
+    return largo, repetidos
+
+
+def compute_period_trend(largo):
+    """
+    Tendencia por material: cada fila de stack_periods se compara con el período inmediatamente
+    anterior del mismo material, con las mismas fórmulas de la hoja procesada (compute_formula_values).
+    El período anterior se obtiene con un desplazamiento dentro de cada material (groupby + shift), en
+    tiempo lineal en el total de filas; si el material no estaba en ese período se toma como vacío.
+    Devuelve un DataFrame agrupado por material (en orden de aparición) y ordenado por período.
+    """
+    codigos = largo[COLUMNA_PERIODO].cat.codes.to_numpy()
+    etiquetas = largo[COLUMNA_PERIODO].cat.categories
+
+    # Las filas están apiladas en orden de período: el shift da la aparición anterior del material
+    grupos = pd.DataFrame({'_codigo': codigos}, index=largo.index).join(largo[NOMBRES_COSTOS_INTERNOS + [COLUMNA_RESULTADO]])
+    previo = grupos.groupby(largo[CLAVE_MERGE], sort=False, dropna=False).shift(1)
+    consecutivo = (codigos - previo['_codigo']).eq(1)
+
+    pares = {'Result actualizado': largo[COLUMNA_RESULTADO], 'Resultado anterior': previo[COLUMNA_RESULTADO].where(consecutivo)}
+    for costo_interno in NOMBRES_COSTOS_INTERNOS:
+        pares[f'{costo_interno} Actual'] = largo[costo_interno]
+        pares[f'{costo_interno} Antes'] = previo[costo_interno].where(consecutivo)
+    resultados = compute_formula_values(pd.DataFrame(pares), [], NOMBRES_COSTOS_INTERNOS)
+    idx_resultados = 5 * len(NOMBRES_COSTOS_INTERNOS)
+
+    tendencia = {
+        CLAVE_MERGE: largo[CLAVE_MERGE],
+        'Texto breve material': largo['Texto breve material'],
+        COLUMNA_PERIODO: largo[COLUMNA_PERIODO],
+        COLUMNA_PERIODO_ANTERIOR: pd.Categorical.from_codes(np.where(consecutivo, codigos - 1, -1), categories=etiquetas, ordered=True),
+        COLUMNA_RESULTADO: largo[COLUMNA_RESULTADO],
+        '% Variacion Resultado': resultados[idx_resultados + 2],
+    }
+    for bloque, costo_interno in enumerate(NOMBRES_COSTOS_INTERNOS):
+        costo_output = output_cost_names.get(costo_interno, costo_interno)
+        idx = 5 * bloque
+        tendencia[costo_output] = largo[costo_interno]
+        tendencia[f'% desv {costo_output}'] = resultados[idx + 2]
+        tendencia[f'% parti {costo_output}'] = resultados[idx + 3]
+        tendencia[f'Impacto {costo_output}'] = resultados[idx + 4]
+    tendencia['Suma %Parti'] = resultados[idx_resultados + 3]
+    tendencia['Suma Impacto'] = resultados[idx_resultados + 4]
+
+    # Agrupar por material sin ordenar los materiales: orden estable sobre el código de aparición
+    orden = np.argsort(pd.factorize(largo[CLAVE_MERGE], use_na_sentinel=False)[0], kind='stable')
+    return pd.DataFrame(tendencia).take(orden).reset_index(drop=True)
+
+
+def _base_package(sheet_name):
+    """Libro mínimo (una hoja vacía sheet_name) sobre el que se combinan hojas nuevas sin libro original."""
+    wb = Workbook()
+    wb.active.title = sheet_name
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def process_trend_data(periodos, excel_data=None, duplicate_policy=DUPLICADOS_PRIMERO, profile=None):
+    """
+    Tendencia de costos de varios períodos en una sola pasada. periodos: [(etiqueta, DataFrame)] en
+    orden cronológico (hojas de un libro, ver read_period_sheets, o la hoja ACTUAL de varios archivos).
+    La hoja HOJA_TENDENCIA se agrega al libro excel_data o, si no se indica, a un libro nuevo.
+    Devuelve el BytesIO (None si falla).
+    """
+    if profile is None:
+        profile = PipelineProfile()
+    if len(periodos) < 2:
+        logger.error("❌ Se necesitan al menos dos períodos para calcular la tendencia.")
+        return None
+
+    try:
+        with profile.stage('apilado') as etapa:
+            df_largo, repetidos = stack_periods(periodos, duplicate_policy)
+            etapa['filas'], etapa['celdas'] = len(df_largo), df_largo.size
+    except Exception as e:
+        logger.error(f"❌ ERROR al apilar los períodos: {e}")
+        return None
+
+    for etiqueta, cantidad in repetidos.items():
+        logger.warning(f"Advertencia: {cantidad} materiales repetidos en el período '{etiqueta}'. Criterio aplicado: {duplicate_policy}.")
+    logger.info(f"📋 {df_largo[CLAVE_MERGE].nunique(dropna=False)} materiales en {len(periodos)} períodos ({len(df_largo)} filas).")
+
+    output_file = io.BytesIO()
+    hojas_xml = {}
+    try:
+        with profile.stage('tendencia', filas=len(df_largo)) as etapa:
+            df_tendencia = compute_period_trend(df_largo)
+            etapa['celdas'] = df_tendencia.size
+
+        formatos = {COLUMNA_RESULTADO: '#,##0'}
+        for name in df_tendencia.columns[6:]:
+            formatos[name] = '0.00%' if name.startswith(('%', 'Impacto', 'Suma')) else '#,##0'
+
+        wb = new_output_workbook()
+        with profile.stage('hoja_tendencia', filas=len(df_tendencia), celdas=(len(df_tendencia) + 1) * len(df_tendencia.columns)):
+            write_frame_sheet_streaming(wb, hojas_xml, HOJA_TENDENCIA, df_tendencia, formatos)
+
+        with profile.stage('guardado') as etapa:
+            merge_output_sheets(excel_data if excel_data is not None else _base_package(HOJA_TENDENCIA), wb, output_file, hojas_xml)
+            etapa['bytes'] = output_file.getbuffer().nbytes
+
+    except Exception as e:
+        logger.error(f"❌ Ocurrió un error inesperado al calcular la tendencia: {e}")
+        return None
+
+    finally:
+        for archivo, _ in hojas_xml.values():
+            archivo.close()
+
+    logger.log(EXITO, f"\n¡Tendencia calculada exitosamente! Hoja '{HOJA_TENDENCIA}' con {len(periodos)} períodos.")
+    return output_file
+
+
+# --- FUNCIÓN 12: Resultado en Formato Columnar (Parquet) ---
+def build_result_frame(df_input_for_excel):
+    """
+    DataFrame combinado más las métricas calculadas (compute_formula_values), con un nombre único por
+    columna: '% desv {costo}', '% parti {costo}', 'Impacto {costo}', '% Variacion Resultado',
+    'Suma %Parti' y 'Suma Impacto'.
+    """
+    metricas = named_metrics(compute_formula_values(df_input_for_excel, [], NOMBRES_COSTOS_INTERNOS))
+    return pd.concat([df_input_for_excel.reset_index(drop=True), pd.DataFrame(metricas)], axis=1)
+
+
+def named_metrics(resultados, n_initial_cols=0):
+    """Métricas de compute_formula_values (calculadas con n_initial_cols columnas iniciales) por nombre de columna."""
+    idx_resultados = n_initial_cols + 5 * len(NOMBRES_COSTOS_INTERNOS)
+    metricas = {}
+    for bloque, costo_interno in enumerate(NOMBRES_COSTOS_INTERNOS):
+        costo_output = output_cost_names.get(costo_interno, costo_interno)
+        idx = n_initial_cols + 5 * bloque
+        metricas[f'% desv {costo_output}'] = resultados[idx + 2]
+        metricas[f'% parti {costo_output}'] = resultados[idx + 3]
+        metricas[f'Impacto {costo_output}'] = resultados[idx + 4]
+    metricas['% Variacion Resultado'] = resultados[idx_resultados + 2]
+    metricas['Suma %Parti'] = resultados[idx_resultados + 3]
+    metricas['Suma Impacto'] = resultados[idx_resultados + 4]
+    return metricas
+
+
+def write_parquet(df, destino):
+    """Guarda df en Parquet. Las columnas con tipos mezclados (p. ej. números y texto) se guardan como texto."""
+    como_texto = {}
+    for col in df.columns:
+        serie = df[col]
+        if serie.dtype == object and pd.api.types.infer_dtype(serie, skipna=True).startswith('mixed'):
+            como_texto[col] = serie.astype(str).where(serie.notna(), None)
+    df.assign(**como_texto).to_parquet(destino, index=False)
+
+
+def render_output(excel_data, input_format, df_input_for_excel, output_engine, output_mode, consolidation_links, output_format, profile, incremental=None):
+    """
+    Última etapa: el libro de Excel (write_output_workbook) o, con FORMATO_PARQUET, solo el DataFrame
+    de build_result_frame en Parquet, sin generar el libro. Devuelve el BytesIO (None si falla).
+    """
+    if output_format == FORMATO_PARQUET:
+        if incremental is not None:
+            logger.warning("Advertencia: El reprocesamiento incremental solo aplica a la salida en libro de Excel.")
+        output_file = io.BytesIO()
+        try:
+            with profile.stage('parquet', filas=len(df_input_for_excel)) as etapa:
+                df_resultado = build_result_frame(df_input_for_excel)
+                write_parquet(df_resultado, output_file)
+                etapa['celdas'], etapa['bytes'] = df_resultado.size, output_file.getbuffer().nbytes
+        except Exception as e:
+            logger.error(f"❌ Ocurrió un error inesperado al exportar el resultado a Parquet: {e}")
+            return None
+        logger.log(EXITO, "\n¡El script ha terminado exitosamente! El resultado se exportó en formato Parquet.")
+        return output_file
+
+    # Sin libro de origen (entrada columnar) las hojas se escriben en un libro nuevo
+    if input_format != FORMATO_XLSX:
+        excel_data = _base_package(HOJA_PROCESADA)
+    return write_output_workbook(excel_data, df_input_for_excel, output_engine, output_mode, consolidation_links, profile, incremental)
+
+
+# --- FUNCIÓN 13: Procesamiento por Bloques (libros más grandes que la memoria) ---
+FILAS_POR_BLOQUE = TAMANO_LOTE_FILAS
+# Columna auxiliar del índice de ANTERIOR: celdas no numéricas de la fila, que se cuentan al combinar
+COLUMNA_FORZADAS = '_celdas_forzadas'
+
+
+def _sheet_row_batches(ws, chunk_rows, nombres=None, sin_convertir=()):
+    """
+    Recorre una hoja de un libro abierto en modo de solo lectura y entrega DataFrames de hasta
+    chunk_rows filas, convertidos con el mismo analizador que pd.read_excel (TextParser). Los
+    encabezados son los de la primera fila o, si se indican, nombres (por posición). Las filas vacías
+    del final se omiten y las celdas con error quedan vacías, igual que con pd.read_excel.
+    TextParser deduce el tipo de cada columna con las filas del bloque, no con la hoja entera: las
+    columnas de sin_convertir (las de identificación, como CLAVE_MERGE) se dejan como object con el
+    valor de cada celda tal cual, para que un código de texto como '00000008' no se vuelva 8 en los
+    bloques donde todos los códigos parecen números.
+    """
+    filas = ws.iter_rows(values_only=True)
+    encabezado = next(filas, None)
+    if encabezado is None:
+        return
+    encabezado = ['' if valor is None else valor for valor in (nombres if nombres is not None else encabezado)]
+    ancho = len(encabezado)
+    while ancho and encabezado[ancho - 1] == '':
+        ancho -= 1
+    encabezado = encabezado[:ancho]
+
+    tipos = {col: object for col in sin_convertir if col in encabezado}
+
+    def leer(lote):
+        if nombres is not None:
+            return TextParser(lote, header=None, names=encabezado, dtype=tipos).read()
+        return TextParser([encabezado] + lote, header=0, dtype=tipos).read()
+
+    lote = []
+    vacias = 0
+    for fila in filas:
+        fila = [np.nan if isinstance(valor, str) and valor in ERROR_CODES else ('' if valor is None else valor) for valor in fila[:ancho]]
+        if not any(valor != '' for valor in fila):
+            # Una fila vacía solo se conserva si después hay filas con datos
+            vacias += 1
+            continue
+        lote.extend([[''] * ancho] * vacias)
+        vacias = 0
+        lote.append(fila + [''] * (ancho - len(fila)))
+        if len(lote) >= chunk_rows:
+            yield leer(lote)
+            lote = []
+    if lote:
+        yield leer(lote)
+
+
+def _sheet_header(ws):
+    """Nombres de columna de la primera fila de la hoja, como los deja pd.read_excel."""
+    for lote in _sheet_row_batches(ws, 1):
+        return list(lote.columns)
+    raise ValueError(f"la hoja '{ws.title}' está vacía")
+
+
+def load_previous_values(ws_anterior, nombres, chunk_rows=FILAS_POR_BLOQUE):
+    """
+    Versión compacta de ANTERIOR para el procesamiento por bloques: solo el material, el resultado y los
+    costos (como números), con los nombres de ACTUAL por posición igual que prepare_input_frame. La columna
+    COLUMNA_FORZADAS lleva las celdas con texto no numérico de cada fila (ver round_input_frame).
+    """
+    nombres = [('Materia_Costo' if col == 'Materia' else col) for col in nombres]
+    valores = [COLUMNA_RESULTADO] + NOMBRES_COSTOS_INTERNOS
+    partes = []
+    for lote in _sheet_row_batches(ws_anterior, chunk_rows, nombres, sin_convertir=[CLAVE_MERGE]):
+        numeros = lote[valores].apply(pd.to_numeric, errors='coerce')
+        numeros[COLUMNA_FORZADAS] = (numeros.isna() & lote[valores].notna()).sum(axis=1).astype(np.int16)
+        partes.append(pd.concat([lote[[CLAVE_MERGE]], numeros], axis=1))
+    if partes:
+        df_anterior = pd.concat(partes, ignore_index=True)
+    else:
+        df_anterior = pd.DataFrame(columns=[CLAVE_MERGE] + valores + [COLUMNA_FORZADAS])
+    return df_anterior.rename(columns={COLUMNA_RESULTADO: 'Resultado anterior', **{c: f'{c} Antes' for c in NOMBRES_COSTOS_INTERNOS}})
+
+
+def process_excel_chunked(origen, destino, output_mode=MODO_FORMULAS, consolidation_links=VINCULO_COMPARTIDO, profile=None, duplicate_policy=DUPLICADOS_PRIMERO, chunk_rows=FILAS_POR_BLOQUE):
+    """
+    Variante de process_excel_data (motor streaming) para libros que no caben en memoria. origen
+    (ruta o archivo binario) se abre en modo de solo lectura: ANTERIOR se reduce a un índice compacto
+    (load_previous_values, un material por fila) y ACTUAL se lee por bloques de chunk_rows filas que se combinan, redondean,
+    calculan y escriben uno a uno en las hojas de salida (archivos temporales). El libro final se
+    escribe en destino (ruta o archivo binario), no en memoria. La memoria queda acotada por el tamaño
+    del bloque y el índice de ANTERIOR, no por el tamaño del libro.
+    Devuelve True si se escribió la salida.
+    """
+    if profile is None:
+        profile = PipelineProfile()
+
+    layout = sheet_layout()
+    initial_cols = layout.initial_cols
+    cols_consolidado = layout.consolidated_header
+    # En el libro de origen la columna de costo 'Materia_Costo' se llama 'Materia'
+    rename_actual = {('Materia' if c == 'Materia_Costo' else c): f'{c} Actual' for c in NOMBRES_COSTOS_INTERNOS}
+    rename_actual[COLUMNA_RESULTADO] = 'Result actualizado'
+
+    # --- 1. Índice de ANTERIOR ---
+    try:
+        wb_origen = load_workbook(origen, read_only=True, data_only=True, keep_links=False)
+    except Exception as e:
+        logger.error(f"❌ ERROR al abrir el libro: {e}")
+        return False
+
+    hojas_xml = {}
+    try:
+        try:
+            ws_actual, ws_anterior = wb_origen[HOJA_ACTUAL], wb_origen[HOJA_ANTERIOR]
+            with profile.stage('indice_anterior') as etapa:
+                nombres = _sheet_header(ws_actual)
+                df_anterior = load_previous_values(ws_anterior, nombres, chunk_rows)
+                etapa['filas'], etapa['celdas'] = len(df_anterior), df_anterior.size
+        except Exception as e:
+            logger.error(f"❌ ERROR al cargar las hojas de Excel: Asegúrese de que existen las hojas '{HOJA_ACTUAL}' y '{HOJA_ANTERIOR}'. Error: {e}")
+            return False
+
+        try:
+            filas_anterior = len(df_anterior)
+            df_anterior, repetidos_anterior = resolve_duplicates(df_anterior, duplicate_policy, HOJA_ANTERIOR)
+            df_anterior = df_anterior.set_index(CLAVE_MERGE)
+        except Exception as e:
+            logger.error(f"❌ ERROR al combinar '{HOJA_ACTUAL}' con '{HOJA_ANTERIOR}': {e}")
+            return False
+
+        # --- 2. Hojas de salida: estilos y productores por columna, una sola vez ---
+        wb = new_output_workbook()
+        ws_procesada = wb.create_sheet(HOJA_PROCESADA)
+        header = layout.header
+        estilos_procesada, columnas_procesada = _processed_sheet_columns(ws_procesada, layout, output_mode)
+        ws_consolidado = wb.create_sheet(HOJA_CONSOLIDADO, index=0)
+        estilos_consolidado, columnas_consolidado = _consolidation_columns(ws_consolidado, HOJA_PROCESADA, header, cols_consolidado, output_mode, consolidation_links, layout)
+
+        hoja_procesada = tempfile.TemporaryFile()
+        hojas_xml[HOJA_PROCESADA] = (hoja_procesada, None)
+        hoja_procesada.write(f'<row r="1">{_header_xml(ws_procesada, header, estilos_procesada)}</row>'.encode('utf-8'))
+        # La fila 2 del consolidado define las fórmulas de la columna entera y necesita el total de
+        # filas: se escribe al final y el resto de las filas va a un archivo aparte
+        resto_consolidado = tempfile.TemporaryFile()
+        hojas_xml['_resto_consolidado'] = (resto_consolidado, None)
+
+        # --- 3. ACTUAL por bloques: combinación, redondeo, cálculo y escritura ---
+        fila = 2
+        primera_fila = None
+        vistos_anterior = np.zeros(len(df_anterior), dtype=bool)
+        coincidentes = 0
+        nuevos = []
+        claves_actual = []
+        sumas_impacto = []
+        forzadas = 0
+        with profile.stage('bloques') as etapa:
+            etapa['bloques'] = 0
+            for lote in _sheet_row_batches(ws_actual, chunk_rows, sin_convertir=initial_cols):
+                lote = lote.rename(columns=rename_actual)
+                posiciones = df_anterior.index.get_indexer(lote[CLAVE_MERGE])
+                vistos_anterior[posiciones[posiciones >= 0]] = True
+                coincidentes += int((posiciones >= 0).sum())
+                nuevos.append(lote[CLAVE_MERGE][posiciones < 0])
+                claves_actual.append(lote[CLAVE_MERGE])
+
+                combinado = lote.join(df_anterior, on=CLAVE_MERGE)
+                df_lote, forzadas_lote = round_input_frame(combinado)
+                df_lote = df_lote.reset_index(drop=True)
+                # Las celdas de ANTERIOR ya son números en el índice: se suman las de las filas combinadas
+                forzadas += forzadas_lote + int(combinado[COLUMNA_FORZADAS].sum())
+                filas_lote = len(df_lote)
+                resultados = compute_formula_values(df_lote, initial_cols, NOMBRES_COSTOS_INTERNOS)
+                sumas_impacto.append(impact_group_sums(df_lote, named_metrics(resultados, len(initial_cols))))
+                if output_mode == MODO_FORMULAS:
+                    resultados = None
+                _write_xml_rows(hoja_procesada, None, [columna(df_lote, resultados, fila) for columna in columnas_procesada], len(df_lote), fila)
+
+                inicio_consolidado = fila
+                if fila == 2:
+                    primera_fila = (df_lote.iloc[:1], {pos: valores[:1] for pos, valores in resultados.items()} if resultados else None)
+                    df_lote = df_lote.iloc[1:]
+                    resultados = {pos: valores[1:] for pos, valores in resultados.items()} if resultados else None
+                    inicio_consolidado = 3
+                _write_xml_rows(resto_consolidado, None, [columna(df_lote, resultados, inicio_consolidado, None) for columna in columnas_consolidado], len(df_lote), inicio_consolidado)
+
+                fila += filas_lote
+                etapa['bloques'] += 1
+            num_rows = fila - 2
+            etapa['filas'], etapa['celdas'] = num_rows, num_rows * (len(header) + len(cols_consolidado))
+            etapa['forzadas'] = forzadas
+        report_coerced_cells(forzadas, HOJA_PROCESADA)
+
+        # --- 4. Resumen de la combinación (mismo que merge_periods) ---
+        claves_actual = pd.concat(claves_actual, ignore_index=True) if claves_actual else pd.Series(dtype=object)
+        nuevos = pd.concat(nuevos, ignore_index=True) if nuevos else pd.Series(dtype=object)
+        dados_de_baja = df_anterior.index[~vistos_anterior]
+        report_merge_summary({
+            'filas_actual': num_rows,
+            'filas_anterior': filas_anterior,
+            'coincidentes': coincidentes,
+            'nuevos': len(nuevos),
+            'dados_de_baja': len(dados_de_baja),
+            'repetidos_actual': int(claves_actual[claves_actual.duplicated()].nunique(dropna=False)),
+            'repetidos_anterior': len(repetidos_anterior),
+            'resolucion_repetidos': duplicate_policy,
+            'ejemplos': {
+                'nuevos': nuevos.head(MAX_EJEMPLOS_MATERIALES).tolist(),
+                'dados_de_baja': dados_de_baja[:MAX_EJEMPLOS_MATERIALES].tolist(),
+                'repetidos_anterior': repetidos_anterior[:MAX_EJEMPLOS_MATERIALES].tolist(),
+            },
+        })
+        del claves_actual, nuevos
+
+        # --- 5. Consolidado: encabezado, fila 2 y el resto de las filas ---
+        hoja_consolidado = tempfile.TemporaryFile()
+        hojas_xml[HOJA_CONSOLIDADO] = (hoja_consolidado, f'A1:{get_column_letter(len(cols_consolidado))}{num_rows + 1}')
+        hoja_consolidado.write(f'<row r="1">{_header_xml(ws_consolidado, cols_consolidado, estilos_consolidado)}</row>'.encode('utf-8'))
+        if primera_fila is not None:
+            df_primera, resultados_primera = primera_fila
+            _write_xml_rows(hoja_consolidado, None, [columna(df_primera, resultados_primera, 2, num_rows) for columna in columnas_consolidado], 1)
+        resto_consolidado.seek(0)
+        shutil.copyfileobj(resto_consolidado, hoja_consolidado)
+        hojas_xml.pop('_resto_consolidado')[0].close()
+        hojas_xml[HOJA_PROCESADA] = (hoja_procesada, f'A1:{get_column_letter(len(header))}{num_rows + 1}')
+
+        # --- 6. Resumen de impactos: las sumas parciales de los bloques se combinan al final ---
+        with profile.stage('resumen_impactos', filas=num_rows) as etapa:
+            resumen = finish_impact_summary(sumas_impacto)
+            write_impact_summary(wb, hojas_xml, resumen)
+            etapa['grupos'] = len(resumen)
+
+        # --- 7. Libro final directamente en destino ---
+        with profile.stage('guardado') as etapa:
+            if hasattr(origen, 'seek'):
+                origen.seek(0)
+            merge_output_sheets(origen, wb, destino, hojas_xml)
+            if hasattr(destino, 'tell'):
+                etapa['bytes'] = destino.tell()
+            else:
+                etapa['bytes'] = os.path.getsize(destino)
+
+    except Exception as e:
+        logger.error(f"❌ Ocurrió un error inesperado durante el procesamiento por bloques: {e}")
+        return False
+
+    finally:
+        wb_origen.close()
+        for archivo, _ in hojas_xml.values():
+            archivo.close()
+
+    logger.log(EXITO, f"\n¡El script ha terminado exitosamente! Las hojas ahora contienen {CONTENIDO_SALIDA[output_mode]} y el orden original se ha mantenido.")
+    return True
+
+
+# --- FUNCIÓN 14: Trabajos en Segundo Plano (cola acotada con avance por etapa) ---
+def _in_memory_file(datos, nombre):
+    """Archivo en memoria con read() y name, como el archivo cargado en Streamlit."""
+    archivo = io.BytesIO(datos)
+    archivo.name = nombre
+    return archivo
+
+
+def _job_process(perfil, datos, nombre, output_mode=MODO_FORMULAS, duplicate_policy=DUPLICADOS_PRIMERO, previous_data=None, previous_name=None, output_format=FORMATO_XLSX, cache=None, incremental=False):
+    """
+    Tarea TAREA_PROCESAR: process_excel_data. Con incremental, el estado del reprocesamiento incremental
+    se guarda en la caché por nombre de archivo y modo de salida. Devuelve (bytes, nombre de salida) o None.
+    """
+    anterior = _in_memory_file(previous_data, previous_name) if previous_data is not None else None
+    estado = None
+    if incremental and cache is not None:
+        clave_estado = cache.key('incremental', nombre, output_mode)
+        guardado = cache.get(clave_estado)
+        estado = IncrementalState.from_bytes(guardado) if guardado is not None else IncrementalState()
+    output_buffer, output_filename = process_excel_data(_in_memory_file(datos, nombre), output_mode=output_mode, profile=perfil, cache=cache,
+                                                        duplicate_policy=duplicate_policy, previous_file=anterior, output_format=output_format, incremental=estado)
+    if output_buffer is None:
+        return None
+    if estado is not None and estado.clave is not None:
+        datos_estado = estado.to_bytes()
+        if not cache.put(clave_estado, datos_estado):
+            logger.warning(f"Advertencia: El estado del reprocesamiento incremental ({len(datos_estado) / 2**20:.0f} MB) supera el tope de la caché; "
+                           f"la próxima corrida de '{nombre}' reescribirá todas las filas.")
+    return output_buffer.getvalue(), output_filename
+
+
+def _job_chunked(perfil, datos, nombre, output_mode=MODO_FORMULAS, duplicate_policy=DUPLICADOS_PRIMERO, chunk_rows=FILAS_POR_BLOQUE):
+    """Tarea TAREA_BLOQUES: process_excel_chunked sobre un archivo temporal. Devuelve (bytes, nombre de salida) o None."""
+    with tempfile.TemporaryFile() as destino:
+        if not process_excel_chunked(io.BytesIO(datos), destino, output_mode, profile=perfil, duplicate_policy=duplicate_policy, chunk_rows=chunk_rows):
+            return None
+        destino.seek(0)
+        return destino.read(), os.path.splitext(nombre)[0] + '_PROCESADO.xlsx'
+
+
+def _job_trend(perfil, archivos, hojas=None, duplicate_policy=DUPLICADOS_PRIMERO):
+    """
+    Tarea TAREA_TENDENCIA: archivos es [(nombre, bytes)] en orden cronológico. Con hojas, los períodos
+    son esas hojas del único archivo (que se conserva en la salida); si no, la hoja ACTUAL de cada archivo.
+    Devuelve (bytes, nombre de salida) o None.
+    """
+    try:
+        with perfil.stage('lectura') as etapa:
+            if hojas is not None:
+                nombre, excel_data = archivos[0]
+                periodos = read_period_sheets(excel_data, hojas)
+                nombre_salida = os.path.splitext(nombre)[0] + '_TENDENCIA.xlsx'
+            else:
+                excel_data = None
+                periodos = [(os.path.splitext(nombre)[0], read_period_sheets(datos, [HOJA_ACTUAL])[0][1]) for nombre, datos in archivos]
+                nombre_salida = HOJA_TENDENCIA + '.xlsx'
+            etapa['filas'] = sum(len(df) for _, df in periodos)
+    except Exception as e:
+        logger.error(f"❌ ERROR al cargar las hojas de los períodos: {e}")
+        return None
+    output_buffer = process_trend_data(periodos, excel_data, duplicate_policy, perfil)
+    return (output_buffer.getvalue(), nombre_salida) if output_buffer is not None else None
+
+
+TAREAS = {TAREA_PROCESAR: _job_process, TAREA_BLOQUES: _job_chunked, TAREA_TENDENCIA: _job_trend}
+
+# Estado de cada proceso del pool de JobQueue (lo fija _job_worker_init al crear el proceso)
+_eventos_trabajo = None
+_cache_trabajo = None
+
+
+@contextmanager
+def _hidden_main_module():
+    """
+    Oculta el módulo __main__ mientras se crean procesos: spawn vuelve a ejecutar su archivo en cada
+    proceso nuevo y, en Streamlit, ese archivo es la página.
+    """
+    principal = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = principal
+
+
+def _job_worker_init(eventos, directorio_cache, max_disk_bytes):
+    """Inicializa un proceso del pool: la cola de eventos hacia JobQueue y la caché en disco compartida por los procesos."""
+    global _eventos_trabajo, _cache_trabajo
+    _eventos_trabajo = eventos
+    _cache_trabajo = ResultCache(max_bytes=0, directorio=directorio_cache, max_disk_bytes=max_disk_bytes) if directorio_cache else None
+
+
+def _job_worker(job_id, tarea, argumentos, trace_memory, ruta_resultado):
+    """
+    Ejecuta un trabajo en un proceso del pool. Las etapas y los mensajes se envían a JobQueue a medida que
+    ocurren; al terminar, el resultado queda en ruta_resultado y se envía el evento 'fin' con su resumen.
+    """
+    eventos = _eventos_trabajo
+    if tarea == TAREA_PROCESAR:
+        argumentos['cache'] = _cache_trabajo
+    perfil = PipelineProfile(trace_memory, on_stage=lambda nombre: eventos.put(('etapa', job_id, nombre)))
+    resultado = None
+    with capture_messages(lambda nivel, texto: eventos.put(('mensaje', job_id, nivel, texto))):
+        try:
+            salida = TAREAS[tarea](perfil, **argumentos)
+            if salida is not None:
+                # El resumen de impactos se lee de la salida para mostrarlo sin descargar el libro
+                resumen = read_impact_summary(salida[0], argumentos.get('output_format', FORMATO_XLSX)) if tarea != TAREA_TENDENCIA else None
+                with open(ruta_resultado, 'wb') as archivo:
+                    archivo.write(salida[0])
+                resultado = {'nombre_salida': salida[1], 'bytes_resultado': len(salida[0]), 'resumen': resumen}
+        except Exception as e:
+            logger.error(f"❌ ERROR inesperado durante el procesamiento: {e}")
+    eventos.put(('fin', job_id, resultado, perfil.to_dict()))
+
+
+class JobQueue:
+    """
+    Trabajos de procesamiento en segundo plano para la interfaz. Como máximo max_workers trabajos se
+    ejecutan a la vez, cada uno en un proceso del pool: el procesamiento no compite con la interfaz por el
+    intérprete. Otros max_pending esperan turno; submit rechaza los demás. Los procesos comparten la caché
+    en disco (la de cache si tiene directorio, si no una temporal de la cola). El registro de cada trabajo
+    guarda la etapa en curso, el avance estimado y los mensajes, que los procesos envían por una cola de
+    eventos, y al terminar su resumen de impactos. El resultado no queda en memoria: el proceso lo guarda
+    en un archivo temporal y se lee con result(). Los trabajos terminados se conservan hasta que se
+    descartan o se supera el tope de max_finished trabajos o max_finished_bytes de resultados (se quitan
+    los más antiguos; el más reciente se conserva aunque supere el tope de bytes).
+    """
+
+    def __init__(self, max_workers=MAX_TRABAJOS_SIMULTANEOS, max_pending=MAX_TRABAJOS_EN_ESPERA, max_finished=MAX_TRABAJOS_TERMINADOS, cache=None,
+                 max_finished_bytes=MAX_BYTES_TRABAJOS_TERMINADOS):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.max_finished_bytes = max_finished_bytes
+        self.cache = cache
+        # Se borra con todo su contenido al cerrar la cola (shutdown) o al terminar el proceso
+        self._directorio = tempfile.TemporaryDirectory(prefix='trabajos_costos_')
+        directorio_cache = None
+        if cache is not None:
+            directorio_cache = cache.directorio or os.path.join(self._directorio.name, 'cache')
+        # spawn y no fork en todos los sistemas: el proceso de Streamlit ya tiene varios hilos en curso
+        contexto = multiprocessing.get_context('spawn')
+        self._eventos = contexto.Queue()
+        self._nuevo_pool = lambda: ProcessPoolExecutor(max_workers, mp_context=contexto, initializer=_job_worker_init,
+                                                       initargs=(self._eventos, directorio_cache, cache.max_disk_bytes if cache is not None else 0))
+        self._executor = self._nuevo_pool()
+        self._trabajos = OrderedDict()  # id -> registro, del más antiguo al más reciente
+        self._pendientes = deque()  # (id, argumentos, trace_memory) de los trabajos en cola, en orden
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._oyente = threading.Thread(target=self._listen, name='trabajos_costos_eventos', daemon=True)
+        self._oyente.start()
+
+    def submit(self, tarea, descripcion, trace_memory=False, **argumentos):
+        """
+        Encola el trabajo (tarea de TAREAS con sus argumentos). Con trace_memory, su medición por etapa
+        incluye el pico de memoria de Python (tracemalloc, más lento). Devuelve su id o None si la cola está llena.
+        """
+        with self._lock:
+            activos = sum(t['estado'] in (TRABAJO_EN_COLA, TRABAJO_EN_CURSO) for t in self._trabajos.values())
+            if activos >= self.max_workers + self.max_pending:
+                return None
+            job_id = next(self._ids)
+            self._trabajos[job_id] = {
+                'id': job_id, 'tarea': tarea, 'descripcion': descripcion, 'estado': TRABAJO_EN_COLA,
+                'etapa': None, 'avance': 0.0, 'mensajes': [], 'perfil': None, 'archivo_resultado': None, 'bytes_resultado': 0, 'nombre_salida': None,
+                'resumen': None, 'creado': time.time(), 'inicio': None, 'fin': None,
+            }
+            self._pendientes.append((job_id, argumentos, trace_memory))
+            self._dispatch()
+        return job_id
+
+    def status(self, job_id):
+        """Copia del registro del trabajo (None si no existe o ya se descartó)."""
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            return dict(trabajo, mensajes=list(trabajo['mensajes'])) if trabajo is not None else None
+
+    def result(self, job_id):
+        """Bytes del resultado de un trabajo terminado (None si no existe, no terminó o ya se descartó)."""
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            ruta = trabajo['archivo_resultado'] if trabajo is not None else None
+        if ruta is None:
+            return None
+        try:
+            with open(ruta, 'rb') as archivo:
+                return archivo.read()
+        except OSError:
+            # Descartado mientras se leía
+            return None
+
+    def position(self, job_id):
+        """Trabajos en cola delante de job_id (0 si ya está en curso o terminó)."""
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is None or trabajo['estado'] != TRABAJO_EN_COLA:
+                return 0
+            return sum(t['estado'] == TRABAJO_EN_COLA and t['id'] < job_id for t in self._trabajos.values())
+
+    def discard(self, job_id):
+        """Descarta un trabajo terminado (y su resultado) o cancela uno que aún no empezó. Devuelve True si se quitó."""
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is None or trabajo['estado'] == TRABAJO_EN_CURSO:
+                return False
+            self._pendientes = deque(pendiente for pendiente in self._pendientes if pendiente[0] != job_id)
+            self._remove(job_id)
+            return True
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._pendientes.clear()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        self._eventos.put(None)
+        self._directorio.cleanup()
+
+    def _result_path(self, job_id):
+        return os.path.join(self._directorio.name, f'trabajo_{job_id}')
+
+    def _remove(self, job_id):
+        """Quita el registro del trabajo y borra su resultado (con self._lock tomado)."""
+        ruta = self._trabajos.pop(job_id)['archivo_resultado']
+        if ruta is not None:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+
+    def _dispatch(self):
+        """Envía al pool los trabajos en cola mientras haya procesos libres (con self._lock tomado)."""
+        en_curso = sum(t['estado'] == TRABAJO_EN_CURSO for t in self._trabajos.values())
+        while self._pendientes and en_curso < self.max_workers:
+            job_id, argumentos, trace_memory = self._pendientes.popleft()
+            trabajo = self._trabajos[job_id]
+            trabajo['estado'], trabajo['inicio'] = TRABAJO_EN_CURSO, time.time()
+            en_curso += 1
+            tarea = (_job_worker, job_id, trabajo['tarea'], argumentos, trace_memory, self._result_path(job_id))
+            with _hidden_main_module():
+                try:
+                    futuro = self._executor.submit(*tarea)
+                except BrokenProcessPool:
+                    # Un proceso terminó de golpe (por ejemplo, sin memoria) y el pool quedó inutilizable
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._nuevo_pool()
+                    futuro = self._executor.submit(*tarea)
+            futuro.add_done_callback(lambda futuro, job_id=job_id: self._on_done(job_id, futuro))
+
+    def _on_done(self, job_id, futuro):
+        # Un trabajo que termina normalmente ya envió 'fin'; si su proceso murió, se informa por la misma cola
+        if not futuro.cancelled() and futuro.exception() is not None:
+            self._eventos.put(('mensaje', job_id, logging.ERROR, f"❌ ERROR: El proceso del trabajo terminó de forma inesperada ({futuro.exception()})."))
+            self._eventos.put(('fin', job_id, None, None))
+
+    def _listen(self):
+        """Aplica en orden los eventos que envían los procesos del pool (hasta recibir None en shutdown)."""
+        while True:
+            evento = self._eventos.get()
+            if evento is None:
+                return
+            tipo, job_id, *datos = evento
+            if tipo == 'etapa':
+                self._on_stage(job_id, *datos)
+            elif tipo == 'mensaje':
+                self._on_message(job_id, *datos)
+            else:
+                self._finish(job_id, *datos)
+
+    def _on_stage(self, job_id, nombre):
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is not None:
+                etapas = ETAPAS_TAREA[trabajo['tarea']]
+                trabajo['etapa'] = nombre
+                if nombre in etapas:
+                    trabajo['avance'] = max(trabajo['avance'], etapas.index(nombre) / len(etapas))
+
+    def _on_message(self, job_id, nivel, texto):
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is not None:
+                trabajo['mensajes'].append((nivel, texto))
+
+    def _finish(self, job_id, resultado, perfil):
+        """Registra el final de un trabajo, aplica los topes de trabajos terminados y envía al pool los siguientes."""
+        with self._lock:
+            trabajo = self._trabajos.get(job_id)
+            if trabajo is None or trabajo['estado'] != TRABAJO_EN_CURSO:
+                # Ya terminado o descartado: su resultado (si lo hay) no se usará
+                if trabajo is None and resultado is not None:
+                    try:
+                        os.remove(self._result_path(job_id))
+                    except OSError:
+                        pass
+                return
+            trabajo['perfil'], trabajo['fin'] = perfil, time.time()
+            if resultado is not None:
+                trabajo.update(resultado, archivo_resultado=self._result_path(job_id))
+                trabajo['estado'], trabajo['avance'] = TRABAJO_TERMINADO, 1.0
+            else:
+                trabajo['estado'] = TRABAJO_FALLIDO
+            # Topes de trabajos terminados: se descartan los más antiguos con su resultado
+            terminados = [t for t in self._trabajos.values() if t['estado'] in (TRABAJO_TERMINADO, TRABAJO_FALLIDO)]
+            total = sum(t['bytes_resultado'] for t in terminados)
+            for antiguo in terminados[:-1]:
+                if len(terminados) <= self.max_finished and total <= self.max_finished_bytes:
+                    break
+                total -= antiguo['bytes_resultado']
+                terminados.remove(antiguo)
+                self._remove(antiguo['id'])
+            self._dispatch()
+
+
+# --- FUNCIÓN 15: Resumen de Impactos por Planta, Versión y Pr ---
+VALOR_VACIO = '(sin valor)'
+
+
+def impact_group_sums(df_data, metricas, group_cols=COLUMNAS_AGRUPACION):
+    """
+    Sumas por grupo del resumen de impactos, para cada columna de group_cols y cada uno de sus valores:
+    materiales, resultado actual y anterior, y cada impacto (metricas: 'Impacto {costo}' y 'Suma Impacto',
+    ver named_metrics) multiplicado por el resultado actual. Son parciales: las de varios bloques se
+    combinan con finish_impact_summary.
+    """
+    peso = np.nan_to_num(_formula_operand(df_data['Result actualizado']))
+    sumas = pd.DataFrame({
+        'Materiales': np.ones(len(df_data), dtype=np.int64),
+        'Result actualizado': peso,
+        'Resultado anterior': np.nan_to_num(_formula_operand(df_data['Resultado anterior'])),
+        **{nombre: np.asarray(metricas[nombre], dtype=np.float64) * peso for nombre in COLUMNAS_IMPACTO_RESUMEN},
+    })
+    partes = []
+    for col in group_cols:
+        parte = sumas.groupby(df_data[col].to_numpy(dtype=object), sort=False, dropna=False).sum()
+        partes.append(parte.rename_axis(COLUMNA_VALOR).reset_index().assign(**{COLUMNA_AGRUPACION: col}))
+    return pd.concat(partes, ignore_index=True)
+
+
+def finish_impact_summary(partes):
+    """
+    Resumen de impactos a partir de las sumas de impact_group_sums (de uno o varios bloques). Por grupo:
+    materiales, resultados, % de variación del resultado del grupo e impacto de cada componente
+    ponderado por el resultado actual (suma de impacto x resultado / suma de resultados), con el
+    redondeo de las fórmulas. Dentro de cada agrupación, los grupos de mayor resultado primero.
+    """
+    if not partes:
+        partes = [pd.DataFrame(columns=[COLUMNA_VALOR, 'Materiales', 'Result actualizado', 'Resultado anterior', *COLUMNAS_IMPACTO_RESUMEN, COLUMNA_AGRUPACION])]
+    sumas = pd.concat(partes, ignore_index=True)
+    sumas = sumas.groupby([COLUMNA_AGRUPACION, COLUMNA_VALOR], sort=False, dropna=False).sum().reset_index()
+    actual = sumas['Result actualizado'].to_numpy()
+    anterior = sumas['Resultado anterior'].to_numpy()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resumen = pd.DataFrame({
+            COLUMNA_AGRUPACION: sumas[COLUMNA_AGRUPACION],
+            COLUMNA_VALOR: sumas[COLUMNA_VALOR].where(sumas[COLUMNA_VALOR].notna(), VALOR_VACIO),
+            'Materiales': sumas['Materiales'],
+            'Result actualizado': np.round(actual, 2),
+            'Resultado anterior': np.round(anterior, 2),
+            '% Variacion Resultado': excel_iferror(excel_round((actual - anterior) / anterior, 4), 0),
+            **{nombre: excel_iferror(excel_round(sumas[nombre].to_numpy() / actual, 4), 0) for nombre in COLUMNAS_IMPACTO_RESUMEN},
+        })
+    orden = np.lexsort((-actual, pd.factorize(resumen[COLUMNA_AGRUPACION])[0]))
+    return resumen.take(orden).reset_index(drop=True)
+
+
+def write_impact_summary(wb, hojas_xml, resumen):
+    """Hoja HOJA_RESUMEN_IMPACTOS (primera del libro) con el resumen de finish_impact_summary como valores."""
+    formatos = {'Materiales': '#,##0', 'Result actualizado': '#,##0', 'Resultado anterior': '#,##0', '% Variacion Resultado': '0.00%'}
+    formatos.update({nombre: '0.00%' for nombre in COLUMNAS_IMPACTO_RESUMEN})
+    write_frame_sheet_streaming(wb, hojas_xml, HOJA_RESUMEN_IMPACTOS, resumen, formatos, index=0)
+
+
+def _read_value_sheet(zf, ruta):
+    """
+    Filas (listas de valores) de una hoja escrita por write_frame_sheet_streaming: texto en línea, números
+    y booleanos, sin cadenas compartidas. Más rápido que pd.read_excel, que carga las cadenas compartidas
+    de todo el libro aunque solo se lea esta hoja.
+    """
+    filas = []
+    for evento, elemento in ET.iterparse(zf.open(ruta), events=('start', 'end')):
+        if evento == 'start':
+            if elemento.tag == f'{{{NS_MAIN}}}row':
+                filas.append([])
+            continue
+        if elemento.tag == f'{{{NS_MAIN}}}row':
+            elemento.clear()
+        elif elemento.tag == f'{{{NS_MAIN}}}c':
+            tipo = elemento.get('t', 'n')
+            texto = elemento.findtext(f'{{{NS_MAIN}}}v')
+            if tipo == 'inlineStr':
+                valor = ''.join(t.text or '' for t in elemento.iter(f'{{{NS_MAIN}}}t'))
+            elif not texto:
+                valor = None
+            elif tipo == 'b':
+                valor = texto == '1'
+            elif tipo == 'n':
+                valor = int(texto) if texto.lstrip('-').isdigit() else float(texto)
+            else:
+                valor = texto
+            columna = column_index_from_string(elemento.get('r').rstrip('0123456789')) - 1
+            filas[-1].extend([None] * (columna + 1 - len(filas[-1])))
+            filas[-1][columna] = valor
+    ancho = len(filas[0]) if filas else 0
+    return [fila + [None] * (ancho - len(fila)) for fila in filas]
+
+
+def read_impact_summary(datos, output_format=FORMATO_XLSX):
+    """
+    Resumen de impactos de una salida ya generada (bytes): la hoja HOJA_RESUMEN_IMPACTOS del libro o,
+    con FORMATO_PARQUET, calculado a partir de la tabla. None si la salida no lo tiene.
+    """
+    try:
+        if output_format == FORMATO_PARQUET:
+            columnas = COLUMNAS_AGRUPACION + ['Result actualizado', 'Resultado anterior'] + COLUMNAS_IMPACTO_RESUMEN
+            df = pd.read_parquet(io.BytesIO(datos), columns=columnas)
+            return finish_impact_summary([impact_group_sums(df, df)])
+        with zipfile.ZipFile(io.BytesIO(datos)) as zf:
+            rutas = {nombre: ruta for nombre, _, ruta in _read_sheet_parts(zf)}
+            filas = _read_value_sheet(zf, rutas[HOJA_RESUMEN_IMPACTOS])
+        return pd.DataFrame(filas[1:], columns=filas[0])
+    except (ValueError, KeyError, zipfile.BadZipFile) as e:
+        logger.warning(f"Advertencia: No se pudo leer el resumen de impactos: {e}")
+        return None
+
+
+# --- FUNCIÓN 16: Reprocesamiento Incremental (solo se reescriben las filas nuevas o modificadas) ---
+VERSION_ESTADO_INCREMENTAL = 3
+EXTENSION_ESTADO_INCREMENTAL = '.huellas'
+# Las plantillas de las filas se guardan comprimidas por bloques de estas filas (divide a TAMANO_LOTE_FILAS)
+FILAS_BLOQUE_ESTADO = 1000
+# Registros de estilos del libro de salida: al restaurarlos, los índices s="N" de las filas copiadas siguen siendo válidos
+REGISTROS_ESTILO = ('_cell_styles', '_fonts', '_fills', '_borders', '_number_formats', '_alignments', '_protections', '_date_formats', '_timedelta_formats')
+
+
+def _is_number(valor):
+    return isinstance(valor, (int, float, np.number)) and not isinstance(valor, (bool, np.bool_))
+
+
+def row_fingerprints(df):
+    """
+    Huella (hash de 64 bits) de cada fila de df, independiente del tipo de cada columna: un número da la misma
+    huella en una columna numérica (de cualquier ancho: round_numeric_columns elige int32 / float32 según los
+    valores) que en una de objetos, y en una columna de objetos el número 1 no es el texto '1'. Cada columna
+    se reparte en una parte numérica (float64) y una de texto con el tipo de cada valor que no es número.
+    """
+    sin_texto = pd.Series(None, index=df.index, dtype=object)
+    partes = {}
+    for pos, col in enumerate(df.columns):
+        serie = df[col]
+        if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            numeros, textos = serie.astype(np.float64), sin_texto
+        elif serie.dtype == object:
+            es_numero = serie.map(_is_number).astype(bool)
+            numeros = pd.to_numeric(serie.where(es_numero), errors='coerce').astype(np.float64)
+            textos = serie.where(~es_numero).map(lambda valor: f'{type(valor).__name__}:{valor}', na_action='ignore')
+        else:
+            numeros, textos = serie, sin_texto
+        partes[(pos, 'numero')], partes[(pos, 'texto')] = numeros, textos
+    return pd.util.hash_pandas_object(pd.DataFrame(partes, index=df.index), index=False).to_numpy()
+
+
+def _row_keys(materiales):
+    """
+    Clave de cada fila para el reprocesamiento incremental: la huella del material y su número de aparición
+    (los materiales repetidos en ACTUAL conservan todas sus filas: la segunda se compara con la segunda).
+    """
+    ocurrencias = pd.Series(materiales).groupby(materiales, sort=False).cumcount().to_numpy()
+    return pd.MultiIndex.from_arrays([materiales, ocurrencias])
+
+
+class IncrementalState:
+    """
+    Estado del reprocesamiento incremental de un libro: por material (_row_keys), la huella de su fila escrita en
+    la corrida anterior (row_fingerprints); las filas <row> de las hojas procesada y consolidada como plantillas
+    con MARCA_FILA en lugar del número de fila, comprimidas con zlib por bloques de FILAS_BLOQUE_ESTADO filas
+    (el XML de una fila ocupa unos 3 KB; comprimido, de 10 a 20 veces menos), y los registros de estilos del
+    libro de salida. En la corrida siguiente, los materiales con la misma huella se copian de su plantilla con
+    su nueva posición en lugar de producirse de nuevo, aunque se hayan agregado o quitado materiales antes.
+    write_output_workbook lo usa y lo actualiza en el lugar (igual que PipelineProfile); se guarda como archivo
+    auxiliar (save) o en bytes (to_bytes).
+    """
+
+    def __init__(self):
+        self.clave = None
+        self.materiales = None
+        self.huellas = None
+        self.estilos = None
+        self.hojas = {}  # hoja -> (bloques comprimidos de plantillas de las filas de datos, largo de cada plantilla)
+        self.resumen = None  # filas reutilizadas / reescritas en la última corrida
+        self._preparado = None
+
+    @classmethod
+    def from_bytes(cls, datos):
+        """Estado guardado con to_bytes. Si no se puede leer, uno vacío (se reescriben todas las filas)."""
+        estado = cls()
+        try:
+            guardado = pickle.loads(datos)
+            if guardado['version'] != VERSION_ESTADO_INCREMENTAL:
+                raise ValueError(f"versión {guardado['version']}")
+            estado.clave, estado.materiales, estado.huellas = guardado['clave'], guardado['materiales'], guardado['huellas']
+            estado.estilos, estado.hojas = guardado['estilos'], guardado['hojas']
+        except (pickle.UnpicklingError, EOFError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Advertencia: No se pudo leer el estado del reprocesamiento incremental ({e}); se reescriben todas las filas.")
+        return estado
+
+    def to_bytes(self):
+        return pickle.dumps({'version': VERSION_ESTADO_INCREMENTAL, 'clave': self.clave, 'materiales': self.materiales, 'huellas': self.huellas,
+                             'estilos': self.estilos, 'hojas': self.hojas}, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, ruta):
+        """Estado guardado en el archivo auxiliar ruta (vacío si todavía no existe)."""
+        try:
+            with open(ruta, 'rb') as archivo:
+                return cls.from_bytes(archivo.read())
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, ruta):
+        # Se escribe a un temporal y se renombra, como ResultCache: nunca queda un estado a medias
+        temporal = f'{ruta}.{os.getpid()}.tmp'
+        with open(temporal, 'wb') as archivo:
+            archivo.write(self.to_bytes())
+        os.replace(temporal, ruta)
+
+    def prepare(self, wb, clave, huellas, materiales):
+        """
+        Busca cada fila a escribir en la corrida anterior por su material (materiales: row_fingerprints de la
+        columna CLAVE_MERGE) y compara su huella. Si la configuración (clave) es la misma, restaura en wb los
+        registros de estilos de esa corrida: debe llamarse antes de registrar estilos en wb. Devuelve la
+        cantidad de filas que se copiarán sin producirlas.
+        """
+        origen = np.full(len(huellas), -1, dtype=np.int64)
+        if self.clave == clave and self.huellas is not None and self.hojas:
+            for registro, valor in pickle.loads(self.estilos).items():
+                setattr(wb, registro, valor)
+            previas = _row_keys(self.materiales).get_indexer(_row_keys(materiales))
+            encontradas = np.flatnonzero(previas >= 0)
+            sin_cambios = encontradas[self.huellas[previas[encontradas]] == huellas[encontradas]]
+            origen[sin_cambios] = previas[sin_cambios]
+            # La fila 2 del consolidado define las fórmulas de la columna entera (depende del total de filas):
+            # nunca se copia ni se usa como plantilla de otra fila
+            origen[origen == 0] = -1
+            origen[:1] = -1
+        self._preparado = {'clave': clave, 'materiales': materiales, 'huellas': huellas, 'origen': origen, 'escritas': {}}
+        return int((origen >= 0).sum())
+
+    def write_rows(self, destino, nombre, encabezado_xml, columnas, num_rows):
+        """
+        Igual que _write_xml_rows, pero las filas sin cambios (ver prepare) se copian de la plantilla de la corrida
+        anterior con su nueva posición. Los tramos de filas nuevas o modificadas se producen por columnas con
+        con_marca=True; las plantillas de todas las filas se comprimen por bloques para la corrida siguiente.
+        """
+        destino.write(f'<row r="1">{encabezado_xml}</row>'.encode('utf-8'))
+        origen = self._preparado['origen']
+        if nombre in self.hojas:
+            fila_previa = self._previous_rows(*self.hojas[nombre], origen)
+        else:
+            origen = np.full(num_rows, -1, dtype=np.int64)
+
+        bloques = []
+        largos = np.zeros(num_rows, dtype=np.uint32)
+        marca = MARCA_FILA.encode('utf-8')
+        for inicio in range(0, num_rows, TAMANO_LOTE_FILAS):
+            fin = min(inicio + TAMANO_LOTE_FILAS, num_rows)
+            origen_lote = origen[inicio:fin]
+            filas = [fila_previa(o) if o >= 0 else None for o in origen_lote.tolist()]
+            # Tramos de filas a producir dentro del lote
+            producir_filas = np.concatenate(([False], origen_lote < 0, [False]))
+            cortes = np.flatnonzero(np.diff(producir_filas))
+            for a, b in zip(cortes[::2].tolist(), cortes[1::2].tolist()):
+                lote = [producir(inicio + a + 2, inicio + b + 2, con_marca=True) for producir in columnas]
+                filas[a:b] = [b'<row r="%s">%s</row>' % (marca, b''.join(celdas)) for celdas in zip(*lote)]
+            largos[inicio:fin] = [len(fila) for fila in filas]
+            bloques.extend(zlib.compress(b''.join(filas[i:i + FILAS_BLOQUE_ESTADO]), 1) for i in range(0, len(filas), FILAS_BLOQUE_ESTADO))
+            destino.write(b''.join(fila.replace(marca, b'%d' % excel_row_num) for excel_row_num, fila in zip(range(inicio + 2, fin + 2), filas)))
+        self._preparado['escritas'][nombre] = (bloques, largos)
+
+    @staticmethod
+    def _previous_rows(bloques, largos, origen):
+        """
+        Función posición -> plantilla de esa fila en la corrida anterior. Los bloques se descomprimen a medida
+        que se piden y se conservan los dos últimos (las filas copiadas suelen seguir el orden anterior); si las
+        filas cambiaron mucho de orden, todos los bloques se descomprimen una sola vez.
+        """
+        desplazamientos = np.concatenate(([0], np.cumsum(largos, dtype=np.int64))).tolist()
+        bloques_pedidos = origen[origen >= 0] // FILAS_BLOQUE_ESTADO
+        max_abiertos = len(bloques) if np.count_nonzero(np.diff(bloques_pedidos)) > 2 * len(bloques) else 2
+        abiertos = {}
+
+        def fila_previa(posicion):
+            bloque = posicion // FILAS_BLOQUE_ESTADO
+            datos = abiertos.get(bloque)
+            if datos is None:
+                if len(abiertos) >= max_abiertos:
+                    del abiertos[next(iter(abiertos))]
+                datos = abiertos[bloque] = zlib.decompress(bloques[bloque])
+            base = desplazamientos[bloque * FILAS_BLOQUE_ESTADO]
+            return datos[desplazamientos[posicion] - base:desplazamientos[posicion + 1] - base]
+
+        return fila_previa
+
+    def commit(self, wb):
+        """Toma como nuevo estado las filas escritas en esta corrida y los registros de estilos de wb (tras guardar el libro)."""
+        preparado = self._preparado
+        reutilizadas = int((preparado['origen'] >= 0).sum())
+        self.clave, self.materiales, self.huellas = preparado['clave'], preparado['materiales'], preparado['huellas']
+        self.hojas = preparado['escritas']
+        self.estilos = pickle.dumps({registro: getattr(wb, registro) for registro in REGISTROS_ESTILO}, protocol=pickle.HIGHEST_PROTOCOL)
+        self.resumen = {'reescritas': len(preparado['origen']) - reutilizadas, 'reutilizadas': reutilizadas}
+        self._preparado = None
+
+
+# --- FUNCIÓN PRINCIPAL DE PROCESAMIENTO ---
+def coerce_numeric_block(df, columnas):
+    """
+    Convierte las columnas a un solo bloque 2-D float64 (filas x columnas, por columnas en memoria).
+    Las columnas numéricas se copian tal cual; las demás se convierten juntas con una sola llamada
+    a pd.to_numeric. Devuelve (bloque, cantidad de celdas con texto no numérico que quedaron vacías).
+    """
+    bloque = np.empty((len(df), len(columnas)), dtype=np.float64, order='F')
+    otras = []
+    for j, col in enumerate(columnas):
+        if pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col]):
+            bloque[:, j] = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            otras.append(j)
+    forzadas = 0
+    if otras:
+        celdas = df[[columnas[j] for j in otras]].to_numpy(dtype=object).ravel(order='F')
+        numeros = pd.to_numeric(pd.Series(celdas, dtype=object), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        forzadas = int((np.isnan(numeros) & ~pd.isna(celdas)).sum())
+        bloque[:, otras] = numeros.reshape((len(df), len(otras)), order='F')
+    return bloque, forzadas
+
+
+def round_numeric_columns(df, columnas, columnas_enteras):
+    """
+    Redondeo de las columnas como un solo bloque: las de columnas_enteras a 0 decimales (vacías = 0)
+    y las demás a 2. Cada columna se reduce a int32 / float32 cuando sus valores caben sin pérdida.
+    Devuelve ({columna: array}, cantidad de celdas no numéricas que quedaron vacías).
+    """
+    # Enteras primero: cada parte del bloque es una vista contigua que se redondea en el lugar
+    orden = [col for col in columnas if col in columnas_enteras] + [col for col in columnas if col not in columnas_enteras]
+    bloque, forzadas = coerce_numeric_block(df, orden)
+    n_enteras = sum(col in columnas_enteras for col in columnas)
+    enteros, decimales = bloque[:, :n_enteras], bloque[:, n_enteras:]
+    np.round(enteros, 0, out=enteros)
+    np.nan_to_num(enteros, copy=False, nan=0.0)
+    np.round(decimales, 2, out=decimales)
+
+    info = np.iinfo(np.int32)
+    caben_int32 = (enteros.min(axis=0, initial=0) >= info.min) & (enteros.max(axis=0, initial=0) <= info.max)
+    # float32 solo si conserva el valor exacto: el libro y las fórmulas usan el valor de 64 bits
+    decimales32 = decimales.astype(np.float32, order='F')
+    exactas_float32 = ((decimales32 == decimales) | np.isnan(decimales)).all(axis=0)
+
+    columnas_redondeadas = {}
+    for j, col in enumerate(orden[:n_enteras]):
+        columnas_redondeadas[col] = enteros[:, j].astype(np.int32 if caben_int32[j] else np.int64)
+    for j, col in enumerate(orden[n_enteras:]):
+        # (copia: una vista mantendría vivo todo el bloque)
+        columnas_redondeadas[col] = (decimales32 if exactas_float32[j] else decimales)[:, j].copy()
+    return columnas_redondeadas, forzadas
+
+
+def report_coerced_cells(forzadas, hoja):
+    """Advierte sobre las celdas de costo con texto no numérico, que se tratan como vacías."""
+    if forzadas:
+        logger.warning(f"Advertencia: {forzadas} celdas de costo con valores no numéricos en '{hoja}' se trataron como vacías.")
+
+
+def round_input_frame(df_procesado):
+    """
+    Columnas del DataFrame combinado que se escriben, en su orden, con el redondeo de los costos.
+    Devuelve (DataFrame, cantidad de celdas no numéricas que quedaron vacías).
+    """
+    cols_to_keep = COLUMNAS_INICIALES + ['Result actualizado', 'Resultado anterior']
+    
+    for costo in NOMBRES_COSTOS_INTERNOS:
+        cols_to_keep.append(f'{costo} Actual')
+        cols_to_keep.append(f'{costo} Antes')
+    
+    # Columnas numéricas que se usarán en fórmulas: un solo bloque con el redondeo solicitado
+    # (0 decimales para los costos enteros, 2 para los demás)
+    cols_numeric = [f'{c} Actual' for c in NOMBRES_COSTOS_INTERNOS] + [f'{c} Antes' for c in NOMBRES_COSTOS_INTERNOS] + ['Result actualizado', 'Resultado anterior']
+    cols_integer = {f'{c} Actual' for c in COLUMNAS_ENTEROS} | {f'{c} Antes' for c in COLUMNAS_ENTEROS}
+    redondeadas, forzadas = round_numeric_columns(df_procesado, cols_numeric, cols_integer)
+    
+    df_input_for_excel = pd.DataFrame({col: redondeadas[col] if col in redondeadas else df_procesado[col] for col in cols_to_keep}, index=df_procesado.index)
+    return df_input_for_excel, forzadas
+
+
+def prepare_input_frame(excel_data, profile, duplicate_policy=DUPLICADOS_PRIMERO, input_format=FORMATO_XLSX, previous_data=None):
+    """
+    Lee las hojas de origen (ver load_source_sheets), las combina por material y aplica el redondeo.
+    Devuelve el DataFrame con el que se escriben las hojas de salida (None si no se pudieron leer o combinar).
+    """
+    # 1. Carga del archivo: una sola lectura del libro para obtener ambas hojas de origen
+    try:
+        with profile.stage('lectura') as etapa:
+            df_actual, df_anterior = load_source_sheets(excel_data, input_format, previous_data)
+            etapa['filas'] = len(df_actual) + len(df_anterior)
+            etapa['celdas'] = df_actual.size + df_anterior.size
+        
+    except Exception as e:
+        if input_format != FORMATO_XLSX:
+            logger.error(f"❌ ERROR al cargar las tablas de origen ({input_format}): {e}")
+            return None
+        logger.error(f"❌ ERROR al cargar las hojas de Excel: Asegúrese de que existen las hojas '{HOJA_ACTUAL}' y '{HOJA_ANTERIOR}'. Error: {e}")
+        return None
+
+    # --- Asignar nombres únicos para manejo interno (Materia vs Material) ---
+    column_names_for_df = list(df_actual.columns)
+    column_names_for_df = [('Materia_Costo' if col == 'Materia' else col) for col in column_names_for_df]
+    
+    df_actual.columns = column_names_for_df
+    df_anterior.columns = column_names_for_df
+    
+    # --- 3. Preparación de columnas para la combinación ---
+    df_actual = df_actual.rename(columns={COLUMNA_RESULTADO: 'Result actualizado'})
+    df_anterior = df_anterior.rename(columns={COLUMNA_RESULTADO: 'Resultado anterior'})
+    
+    rename_actual = {col: f'{col} Actual' for col in NOMBRES_COSTOS_INTERNOS}
+    rename_anterior = {col: f'{col} Antes' for col in NOMBRES_COSTOS_INTERNOS}
+    
+    df_actual_renamed = df_actual.rename(columns=rename_actual).copy()
+    df_anterior_renamed = df_anterior.rename(columns=rename_anterior).copy()
+    
+    cols_to_keep_anterior = [CLAVE_MERGE, 'Resultado anterior'] + list(rename_anterior.values())
+    df_anterior_slim = df_anterior_renamed[cols_to_keep_anterior]
+    
+    # --- 4. Combinación (Merge) ---
+    try:
+        with profile.stage('combinacion') as etapa:
+            df_procesado, resumen_materiales = merge_periods(df_actual_renamed, df_anterior_slim, duplicate_policy)
+            etapa['filas'], etapa['celdas'] = len(df_procesado), df_procesado.size
+            etapa['materiales'] = {k: v for k, v in resumen_materiales.items() if k != 'ejemplos'}
+    except Exception as e:
+        logger.error(f"❌ ERROR al combinar '{HOJA_ACTUAL}' con '{HOJA_ANTERIOR}': {e}")
+        return None
+    
+    report_merge_summary(resumen_materiales)
+    
+    # --- 5. Preparación de datos y columnas a mantener (Aplicación de redondeo) ---
+    with profile.stage('redondeo', filas=len(df_procesado), celdas=len(df_procesado) * 2 * (len(NOMBRES_COSTOS_INTERNOS) + 1)) as etapa:
+        df_input_for_excel, etapa['forzadas'] = round_input_frame(df_procesado)
+    report_coerced_cells(etapa['forzadas'], HOJA_PROCESADA)
+    
+    return df_input_for_excel
+
+
+def write_output_workbook(excel_data, df_input_for_excel, output_engine, output_mode, consolidation_links, profile, incremental=None):
+    """
+    Escribe las hojas de salida y las combina con el libro original. Devuelve el BytesIO (None si falla).
+    Con incremental (IncrementalState) las filas de las hojas procesada y consolidada de los materiales que no
+    cambiaron desde la corrida anterior se copian de ella (en su nueva posición), y el estado se actualiza con esta corrida.
+    """
+    # -------------------------------------------------------------------------------------
+    # --- 6. Guardar y Formatear las hojas en un objeto de memoria ---
+    # -------------------------------------------------------------------------------------
+    
+    output_file = io.BytesIO()
+    hojas_xml = {}
+    
+    try:
+        # Encabezados, estilos y plantillas de fórmula: disposición compartida, construida una vez por proceso
+        layout = sheet_layout()
+        initial_cols = layout.initial_cols
+        df_consolidado_headers = layout.consolidated_header
+        num_rows = len(df_input_for_excel)
+        
+        # Libro nuevo solo con las hojas regeneradas; el resto se copia del original al guardar
+        wb = new_output_workbook()
+        resultados = None
+        
+        if incremental is not None and output_engine != MOTOR_STREAMING:
+            logger.warning("Advertencia: El reprocesamiento incremental requiere el motor streaming; se reescriben todas las filas.")
+            incremental = None
+        if incremental is not None:
+            # Antes de registrar estilos: las filas copiadas conservan sus índices de estilo
+            with profile.stage('huellas', filas=num_rows) as etapa:
+                clave_incremental = ResultCache.key(VERSION_ESTADO_INCREMENTAL, HOJA_PROCESADA, HOJA_CONSOLIDADO, initial_cols, df_consolidado_headers,
+                                                    NOMBRES_COSTOS_INTERNOS, output_cost_names, output_mode, consolidation_links)
+                etapa['reutilizables'] = incremental.prepare(wb, clave_incremental, row_fingerprints(df_input_for_excel),
+                                                              row_fingerprints(df_input_for_excel[[CLAVE_MERGE]]))
+        
+        if output_engine == MOTOR_STREAMING:
+            # Valores de las columnas calculadas (solo si se escriben en el archivo)
+            if output_mode != MODO_FORMULAS:
+                with profile.stage('valores_calculados', filas=num_rows) as etapa:
+                    resultados = compute_formula_values(df_input_for_excel, initial_cols, NOMBRES_COSTOS_INTERNOS)
+                    etapa['celdas'] = num_rows * len(resultados)
+            
+            # El XML de las hojas se escribe directo a archivos temporales, ya formateado
+            with profile.stage('hoja_procesada', filas=num_rows) as etapa:
+                df_output_headers = write_processed_sheet_streaming(wb, hojas_xml, HOJA_PROCESADA, df_input_for_excel, NOMBRES_COSTOS_INTERNOS, output_cost_names, initial_cols, output_mode, resultados, incremental)
+                etapa['celdas'] = (num_rows + 1) * len(df_output_headers)
+            
+            if not df_output_headers:
+                logger.error("\nEl script se detuvo debido a un error al escribir la hoja procesada.")
+                return None
+            
+            with profile.stage('consolidado', filas=num_rows, celdas=(num_rows + 1) * len(df_consolidado_headers)):
+                write_consolidation_streaming(wb, hojas_xml, HOJA_PROCESADA, HOJA_CONSOLIDADO, df_output_headers, df_consolidado_headers, num_rows, output_mode, df_input_for_excel, resultados, consolidation_links, incremental)
+        
+        else:
+            if output_mode != MODO_FORMULAS:
+                logger.warning("Advertencia: El motor por celdas solo escribe fórmulas; los valores calculados requieren el motor streaming.")
+            
+            # 6.1 Escritura de la Hoja PROCESADA con FÓRMULAS
+            with profile.stage('hoja_procesada', filas=num_rows) as etapa:
+                df_output_headers = write_processed_sheet_with_formulas(wb, HOJA_PROCESADA, df_input_for_excel, NOMBRES_COSTOS_INTERNOS, output_cost_names, initial_cols, layout)
+                etapa['celdas'] = (num_rows + 1) * len(df_output_headers)
+            
+            if not df_output_headers:
+                logger.error("\nEl script se detuvo debido a un error al escribir la hoja procesada.")
+                return None
+            
+            # 6.2 Aplicar formato a la hoja de PROCESADO
+            with profile.stage('formato', filas=num_rows, celdas=(num_rows + 1) * len(df_output_headers)):
+                apply_excel_formatting(wb, HOJA_PROCESADA, layout)
+
+            # -------------------------------------------------------------------------------------
+            # --- 6.5. PREPARACIÓN Y ESCRITURA DEL CONSOLIDADO 
+            # -------------------------------------------------------------------------------------
+            
+            with profile.stage('consolidado', filas=num_rows, celdas=(num_rows + 1) * len(df_consolidado_headers)):
+                index_consolidado = 0
+                if HOJA_CONSOLIDADO in wb.sheetnames:
+                    index_consolidado = wb.sheetnames.index(HOJA_CONSOLIDADO)
+                    del wb[HOJA_CONSOLIDADO]
+                    
+                ws_consolidado = wb.create_sheet(HOJA_CONSOLIDADO, index=index_consolidado)
+                
+                # Escribir el encabezado
+                ws_consolidado.append(df_consolidado_headers)
+                # Llenar con celdas dummy (el contenido será reemplazado por fórmulas)
+                for _ in range(num_rows):
+                    ws_consolidado.append([0] * len(df_consolidado_headers))
+
+                # 6.3 Aplicar FÓRMULAS VINCULANTES y formato a la hoja de CONSOLIDADO
+                apply_consolidation_formulas(wb, HOJA_PROCESADA, HOJA_CONSOLIDADO, df_output_headers, df_consolidado_headers, layout)
+
+        # Totales por planta, versión y Pr calculados aquí: la hoja no depende del recálculo de Excel
+        with profile.stage('resumen_impactos', filas=num_rows) as etapa:
+            if resultados is None:
+                resultados = compute_formula_values(df_input_for_excel, initial_cols, NOMBRES_COSTOS_INTERNOS)
+            resumen = finish_impact_summary([impact_group_sums(df_input_for_excel, named_metrics(resultados, len(initial_cols)))])
+            write_impact_summary(wb, hojas_xml, resumen)
+            etapa['grupos'] = len(resumen)
+
+        # Combinar las hojas nuevas con el libro original en el buffer de memoria
+        with profile.stage('guardado') as etapa:
+            merge_output_sheets(excel_data, wb, output_file, hojas_xml)
+            etapa['bytes'] = output_file.getbuffer().nbytes
+        
+        if incremental is not None:
+            incremental.commit(wb)
+            logger.info(f"♻️ Reprocesamiento incremental: {incremental.resumen['reescritas']} filas nuevas o modificadas se reescribieron "
+                        f"y {incremental.resumen['reutilizadas']} sin cambios se copiaron de la corrida anterior.")
+        
+        logger.log(EXITO, f"\n¡El script ha terminado exitosamente! Las hojas ahora contienen {CONTENIDO_SALIDA[output_mode]} y el orden original se ha mantenido.")
+        
+        return output_file
+
+    except Exception as e:
+        logger.error(f"❌ Ocurrió un error inesperado durante el procesamiento final: {e}")
+        return None
+
+    finally:
+        for archivo, _ in hojas_xml.values():
+            archivo.close()
+
+
+def process_excel_data(uploaded_file, output_engine=MOTOR_STREAMING, output_mode=MODO_FORMULAS, consolidation_links=VINCULO_COMPARTIDO, profile=None, cache=None, duplicate_policy=DUPLICADOS_PRIMERO, previous_file=None, output_format=FORMATO_XLSX, incremental=None):
+    """
+    Procesa el libro cargado (objeto con read() y name). Devuelve (BytesIO, nombre de salida)
+    o (None, None) si falla. duplicate_policy indica cómo resolver materiales repetidos en
+    ANTERIOR (ver merge_periods). Con cache (ResultCache) se reutilizan el DataFrame combinado y el
+    libro de salida de cargas anteriores con el mismo contenido y la misma configuración.
+    Si uploaded_file es Parquet, Feather o CSV (según su extensión) es la tabla ACTUAL y
+    previous_file la tabla ANTERIOR. Con output_format=FORMATO_PARQUET no se genera el libro:
+    la salida es el DataFrame combinado con las métricas calculadas (build_result_frame).
+    Con incremental (IncrementalState de la corrida anterior del mismo libro) solo se reescriben las filas
+    nuevas o modificadas; el estado queda actualizado para la próxima corrida.
+    """
+    # Medición por etapa: se llena el PipelineProfile recibido (o uno descartable)
+    if profile is None:
+        profile = PipelineProfile()
+    
+    excel_data = uploaded_file.read()
+    input_format = file_format(uploaded_file.name)
+    previous_data = previous_file.read() if previous_file is not None else None
+    extension_salida = '.parquet' if output_format == FORMATO_PARQUET else '.xlsx'
+    output_filename = os.path.splitext(uploaded_file.name)[0] + '_PROCESADO' + extension_salida
+    
+    if cache is None:
+        df_input_for_excel = prepare_input_frame(excel_data, profile, duplicate_policy, input_format, previous_data)
+        if df_input_for_excel is None:
+            return None, None
+        output_file = render_output(excel_data, input_format, df_input_for_excel, output_engine, output_mode, consolidation_links, output_format, profile, incremental)
+        return (output_file, output_filename) if output_file is not None else (None, None)
+    
+    clave_datos = cache.key(excel_data, previous_data, input_format, HOJA_ACTUAL, HOJA_ANTERIOR, COLUMNA_RESULTADO, CLAVE_MERGE, NOMBRES_COSTOS_INTERNOS, COLUMNAS_ENTEROS, duplicate_policy)
+    clave_salida = cache.key(clave_datos, HOJA_PROCESADA, HOJA_CONSOLIDADO, HOJA_RESUMEN_IMPACTOS, COLUMNAS_AGRUPACION, output_cost_names, output_engine, output_mode, consolidation_links, output_format)
+    
+    # Si otra sesión está procesando el mismo libro con la misma configuración, se espera su resultado
+    with cache.computing(clave_salida):
+        with profile.stage('cache') as etapa:
+            guardado = cache.get(clave_salida)
+            etapa['acierto'] = guardado is not None
+        if guardado is not None:
+            logger.log(EXITO, "\n¡Resultado recuperado de la caché! El libro ya se había procesado con la misma configuración.")
+            return io.BytesIO(guardado), output_filename
+        
+        with cache.computing(clave_datos):
+            df_input_for_excel = cache.get(clave_datos)
+            if df_input_for_excel is None:
+                df_input_for_excel = prepare_input_frame(excel_data, profile, duplicate_policy, input_format, previous_data)
+                if df_input_for_excel is None:
+                    return None, None
+                cache.put(clave_datos, df_input_for_excel)
+        
+        # Las etapas de escritura no modifican el DataFrame, por eso puede compartirse con la caché
+        output_file = render_output(excel_data, input_format, df_input_for_excel, output_engine, output_mode, consolidation_links, output_format, profile, incremental)
+        if output_file is None:
+            return None, None
+        cache.put(clave_salida, output_file.getvalue())
+        return output_file, output_filename
@@ -0,0 +1,233 @@
+"""
+Procesamiento por lotes (sin interfaz) de los libros de costos.
+
+Cada libro se procesa con process_excel_data en un proceso independiente y el resultado
+se guarda junto al original como *_PROCESADO.xlsx (o *_PROCESADO.parquet con
+--formato-salida parquet, sin generar el libro). Al final se imprime un resumen con
+el estado y el tiempo de cada archivo; con --reporte-json se guarda además la medición
+por etapa (tiempo, memoria, filas y celdas) de cada archivo.
+
+Con --tendencia las entradas son períodos (en orden de nombre de archivo, o las hojas indicadas
+con --hojas de un único libro) y se genera un solo libro con la tendencia por material.
+
+Una entrada Parquet, Feather o CSV es la tabla ACTUAL y se indica la tabla ANTERIOR con --anterior.
+Con --bloques los libros se leen y escriben por bloques de filas, sin cargarlos enteros en memoria.
+Con --incremental se guarda junto a cada salida un archivo *_PROCESADO.huellas; en la corrida siguiente
+solo se reescriben los materiales nuevos o modificados desde entonces (los demás se copian aunque cambien de fila).
+
+Uso:
+    python procesar_lote.py CARPETA_O_PATRON [...] [--procesos N] [--modo formulas] [--reporte-json RUTA]
+    python procesar_lote.py ACTUAL.parquet --anterior ANTERIOR.parquet [--formato-salida parquet]
+    python procesar_lote.py LIBRO_GRANDE.xlsx --bloques [FILAS]
+    python procesar_lote.py CARPETA_O_PATRON [...] --incremental
+    python procesar_lote.py CARPETA_O_PATRON [...] --tendencia SALIDA.xlsx [--hojas HOJA [...]]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from procesamiento_costos import (
+    DUPLICADOS_ERROR, DUPLICADOS_PRIMERO, DUPLICADOS_SUMA, DUPLICADOS_ULTIMO, EXTENSION_ESTADO_INCREMENTAL, EXTENSIONES_FORMATO, FORMATO_PARQUET, FORMATO_XLSX, HOJA_ACTUAL,
+    MODO_FORMULAS, MODO_FORMULAS_CACHE, MODO_VALORES, MOTOR_CELDAS, MOTOR_STREAMING, FILAS_POR_BLOQUE, IncrementalState, PipelineProfile, ResultCache,
+    capture_messages, process_excel_chunked, process_excel_data, process_trend_data, read_period_sheets
+)
+
+SUFIJO_SALIDA = '_PROCESADO'
+# Extensiones que se buscan en una carpeta: libros de Excel y las tablas que admite file_format
+EXTENSIONES_ENTRADA = ['.xlsx', *EXTENSIONES_FORMATO]
+
+
+def find_workbooks(entradas, excluir=()):
+    """
+    Libros a procesar: carpetas (sus archivos con una de EXTENSIONES_ENTRADA), patrones glob o rutas de
+    archivo, sin repetir. Las rutas de excluir (la tabla ANTERIOR de --anterior) no se procesan como entrada.
+    """
+    excluir = {os.path.abspath(ruta) for ruta in excluir}
+    rutas = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            candidatos = sorted(ruta for extension in EXTENSIONES_ENTRADA for ruta in glob.glob(os.path.join(entrada, f'*{extension}')))
+        else:
+            candidatos = sorted(glob.glob(entrada)) or [entrada]
+        for ruta in candidatos:
+            nombre = os.path.basename(ruta)
+            # Se omiten las salidas de corridas anteriores y los archivos de bloqueo de Excel
+            if os.path.splitext(nombre)[0].endswith(SUFIJO_SALIDA) or nombre.startswith('~$'):
+                continue
+            ruta = os.path.abspath(ruta)
+            if ruta not in rutas and ruta not in excluir:
+                rutas.append(ruta)
+    return rutas
+
+
+def process_workbook(ruta, output_engine=MOTOR_STREAMING, output_mode=MODO_FORMULAS, trace_memory=False, cache_dir=None, duplicate_policy=DUPLICADOS_PRIMERO, previous_path=None, output_format=FORMATO_XLSX, chunk_rows=None, incremental=False):
+    """
+    Procesa un libro (o la tabla ACTUAL, con previous_path como tabla ANTERIOR) y escribe la
+    salida junto al original. Con chunk_rows se procesa por bloques (process_excel_chunked) y la
+    salida se escribe directamente en el archivo. Con incremental, el estado del reprocesamiento
+    incremental se lee y se guarda en *_PROCESADO.huellas junto al original. Devuelve el resumen del archivo.
+    """
+    mensajes = []
+    perfil = PipelineProfile(trace_memory)
+    # Cada proceso procesa un libro a la vez: solo interesa la caché en disco, compartida entre procesos
+    cache = ResultCache(max_bytes=0, directorio=cache_dir) if cache_dir else None
+    inicio = time.perf_counter()
+    salida = None
+    try:
+        with capture_messages(lambda nivel, texto: mensajes.append((logging.getLevelName(nivel), texto.strip()))):
+            if chunk_rows:
+                destino = Path(ruta).with_name(Path(ruta).stem + SUFIJO_SALIDA + '.xlsx')
+                if process_excel_chunked(ruta, str(destino), output_mode, profile=perfil, duplicate_policy=duplicate_policy, chunk_rows=chunk_rows):
+                    salida = str(destino)
+                elif destino.exists():
+                    destino.unlink()
+            else:
+                ruta_estado = Path(ruta).with_name(Path(ruta).stem + SUFIJO_SALIDA + EXTENSION_ESTADO_INCREMENTAL)
+                estado = IncrementalState.load(ruta_estado) if incremental else None
+                with open(ruta, 'rb') as archivo:
+                    anterior = open(previous_path, 'rb') if previous_path else None
+                    try:
+                        output_buffer, output_filename = process_excel_data(archivo, output_engine, output_mode, profile=perfil, cache=cache, duplicate_policy=duplicate_policy,
+                                                                            previous_file=anterior, output_format=output_format, incremental=estado)
+                    finally:
+                        if anterior:
+                            anterior.close()
+                if output_buffer:
+                    salida = str(Path(ruta).with_name(Path(output_filename).name))
+                    with open(salida, 'wb') as destino:
+                        destino.write(output_buffer.getbuffer())
+                    if estado is not None and estado.clave is not None:
+                        estado.save(ruta_estado)
+    except Exception as e:
+        mensajes.append(('ERROR', f'❌ {e}'))
+
+    return {
+        'archivo': ruta,
+        'estado': 'OK' if salida else 'ERROR',
+        'segundos': time.perf_counter() - inicio,
+        'salida': salida,
+        'mensajes': mensajes,
+        'perfil': perfil.to_dict(),
+    }
+
+
+def process_batch(rutas, procesos=None, output_engine=MOTOR_STREAMING, output_mode=MODO_FORMULAS, trace_memory=False, cache_dir=None, duplicate_policy=DUPLICADOS_PRIMERO, previous_path=None, output_format=FORMATO_XLSX, chunk_rows=None, incremental=False):
+    """Procesa los libros en paralelo (un proceso por libro). Entrega cada resumen a medida que termina."""
+    with ProcessPoolExecutor(max_workers=procesos) as executor:
+        futuros = [executor.submit(process_workbook, ruta, output_engine, output_mode, trace_memory, cache_dir, duplicate_policy, previous_path, output_format, chunk_rows, incremental) for ruta in rutas]
+        for futuro in as_completed(futuros):
+            yield futuro.result()
+
+
+def process_trend(rutas, salida, hojas=None, duplicate_policy=DUPLICADOS_PRIMERO, trace_memory=False):
+    """
+    Tendencia de varios períodos: las hojas indicadas de un único libro (que se conserva en la salida)
+    o la hoja ACTUAL de cada libro, con el nombre del archivo como período. Devuelve el resumen.
+    """
+    mensajes = []
+    perfil = PipelineProfile(trace_memory)
+    inicio = time.perf_counter()
+    output_buffer = None
+    try:
+        with capture_messages(lambda nivel, texto: mensajes.append((logging.getLevelName(nivel), texto.strip()))):
+            if hojas:
+                excel_data = Path(rutas[0]).read_bytes()
+                periodos = read_period_sheets(excel_data, hojas)
+            else:
+                excel_data = None
+                periodos = [(Path(ruta).stem, read_period_sheets(Path(ruta).read_bytes(), [HOJA_ACTUAL])[0][1]) for ruta in rutas]
+            output_buffer = process_trend_data(periodos, excel_data, duplicate_policy, perfil)
+        if output_buffer:
+            with open(salida, 'wb') as destino:
+                destino.write(output_buffer.getbuffer())
+    except Exception as e:
+        mensajes.append(('ERROR', f'❌ {e}'))
+
+    return {
+        'archivo': salida,
+        'estado': 'OK' if output_buffer else 'ERROR',
+        'segundos': time.perf_counter() - inicio,
+        'salida': salida if output_buffer else None,
+        'mensajes': mensajes,
+        'perfil': perfil.to_dict(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Procesa por lotes los libros de variación de costos.')
+    parser.add_argument('entradas', nargs='+', help='Carpetas, patrones glob o archivos .xlsx, .parquet, .feather o .csv')
+    parser.add_argument('--procesos', type=int, default=None, help='Procesos en paralelo (por defecto, uno por núcleo)')
+    parser.add_argument('--motor', choices=[MOTOR_STREAMING, MOTOR_CELDAS], default=MOTOR_STREAMING)
+    parser.add_argument('--modo', choices=[MODO_FORMULAS, MODO_FORMULAS_CACHE, MODO_VALORES], default=MODO_FORMULAS)
+    parser.add_argument('--reporte-json', help='Guarda el resumen y la medición por etapa de cada archivo en este JSON')
+    parser.add_argument('--duplicados', choices=[DUPLICADOS_PRIMERO, DUPLICADOS_ULTIMO, DUPLICADOS_SUMA, DUPLICADOS_ERROR], default=DUPLICADOS_PRIMERO,
+                        help='Cómo resolver materiales repetidos en la hoja ANTERIOR')
+    parser.add_argument('--cache', help='Directorio de caché: los libros ya procesados con la misma configuración no se reprocesan')
+    parser.add_argument('--trazar-memoria', action='store_true', help='Mide el pico de memoria de cada etapa con tracemalloc (más lento)')
+    parser.add_argument('--anterior', help='Tabla ANTERIOR (Parquet, Feather o CSV) cuando la entrada es la tabla ACTUAL en uno de esos formatos')
+    parser.add_argument('--formato-salida', choices=[FORMATO_XLSX, FORMATO_PARQUET], default=FORMATO_XLSX,
+                        help='parquet: guarda el DataFrame combinado con las métricas calculadas, sin generar el libro')
+    parser.add_argument('--bloques', metavar='FILAS', type=int, nargs='?', const=FILAS_POR_BLOQUE,
+                        help=f'Procesa por bloques de FILAS filas (por defecto {FILAS_POR_BLOQUE}) para libros que no caben en memoria; sin caché')
+    parser.add_argument('--incremental', action='store_true',
+                        help=f'Solo reescribe los materiales nuevos o modificados desde la corrida anterior (estado en *{SUFIJO_SALIDA}{EXTENSION_ESTADO_INCREMENTAL})')
+    parser.add_argument('--tendencia', metavar='SALIDA', help='Calcula la tendencia de los períodos de entrada y la guarda en este libro')
+    parser.add_argument('--hojas', nargs='+', help='Con --tendencia: hojas de período (en orden) de un único libro de entrada')
+    args = parser.parse_intermixed_args(argv)
+
+    rutas = find_workbooks(args.entradas, [args.anterior] if args.anterior else [])
+    if not rutas:
+        print(f"No se encontraron archivos {', '.join(EXTENSIONES_ENTRADA)} para procesar.", file=sys.stderr)
+        return 2
+
+    if args.tendencia:
+        if args.hojas and len(rutas) != 1:
+            print('--hojas requiere un único libro de entrada.', file=sys.stderr)
+            return 2
+        resultado = process_trend(rutas, args.tendencia, args.hojas, args.duplicados, args.trazar_memoria)
+        print(f"{resultado['estado']:<5} {resultado['segundos']:8.1f} s  {resultado['archivo']}", flush=True)
+        for nivel, texto in resultado['mensajes']:
+            if nivel != 'EXITO':
+                print(f'        {nivel}: {texto}', flush=True)
+        if args.reporte_json:
+            with open(args.reporte_json, 'w', encoding='utf-8') as reporte:
+                json.dump([resultado], reporte, ensure_ascii=False, indent=2)
+        return 0 if resultado['estado'] == 'OK' else 1
+
+    if args.anterior and len(rutas) != 1:
+        print('--anterior requiere una única entrada (la tabla ACTUAL).', file=sys.stderr)
+        return 2
+    if args.bloques and (args.motor != MOTOR_STREAMING or args.anterior or args.formato_salida != FORMATO_XLSX):
+        print('--bloques solo admite libros .xlsx con el motor streaming y salida xlsx.', file=sys.stderr)
+        return 2
+    if args.incremental and (args.bloques or args.motor != MOTOR_STREAMING or args.formato_salida != FORMATO_XLSX):
+        print('--incremental solo admite el motor streaming con salida xlsx, sin --bloques.', file=sys.stderr)
+        return 2
+
+    inicio = time.perf_counter()
+    resumen = []
+    for resultado in process_batch(rutas, args.procesos, args.motor, args.modo, args.trazar_memoria, args.cache, args.duplicados, args.anterior, args.formato_salida, args.bloques, args.incremental):
+        resumen.append(resultado)
+        print(f"[{len(resumen)}/{len(rutas)}] {resultado['estado']:<5} {resultado['segundos']:8.1f} s  {resultado['archivo']}", flush=True)
+        for nivel, texto in resultado['mensajes']:
+            if nivel != 'EXITO':
+                print(f'        {nivel}: {texto}', flush=True)
+
+    if args.reporte_json:
+        with open(args.reporte_json, 'w', encoding='utf-8') as reporte:
+            json.dump(resumen, reporte, ensure_ascii=False, indent=2)
+
+    fallidos = [r for r in resumen if r['estado'] != 'OK']
+    print(f"\n{len(resumen) - len(fallidos)} de {len(resumen)} libros procesados en {time.perf_counter() - inicio:.1f} s "
+          f"(suma de tiempos por archivo: {sum(r['segundos'] for r in resumen):.1f} s).")
+    return 1 if fallidos else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,9 @@
+"""
+Configuración de las pruebas: el motor (procesamiento_costos) y el generador de libros sintéticos
+de los benchmarks (generar_libro) se importan desde la raíz del repositorio.
+"""
+import sys
+from pathlib import Path
+
+RAIZ = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(RAIZ), str(RAIZ / 'benchmarks')]
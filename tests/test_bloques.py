@@ -0,0 +1,59 @@
+"""
+El procesamiento por bloques (process_excel_chunked) escribe el mismo libro que el procesamiento en memoria
+(process_excel_data) para cada modo de salida, tipo de vínculo del consolidado y tamaño de bloque.
+
+El libro de prueba tiene claves de material mezcladas: códigos de texto con ceros a la izquierda ('00000008'),
+alfanuméricos ('ABC3') y números, repartidos de forma que hay bloques con solo códigos que parecen números.
+"""
+import io
+import zipfile
+
+import pytest
+
+import procesamiento_costos as app
+from generar_libro import PRIMER_MATERIAL, generate_cost_frames, write_cost_workbook
+
+MODOS = [app.MODO_FORMULAS, app.MODO_FORMULAS_CACHE, app.MODO_VALORES]
+VINCULOS = [app.VINCULO_COMPARTIDO, app.VINCULO_MATRIZ, app.VINCULO_CELDAS]
+FILAS_POR_BLOQUE = [1, 4, 7, 5000]
+
+
+def mixed_key(material):
+    """Código de material del libro de prueba: texto con ceros a la izquierda, alfanumérico o número."""
+    n = material - PRIMER_MATERIAL
+    if n % 3:
+        return f'{n:08d}'
+    return f'ABC{n}' if n % 2 else material
+
+
+def workbook_parts(libro):
+    """Contenido de cada parte del paquete, sin docProps/core.xml (lleva la fecha de creación)."""
+    with zipfile.ZipFile(libro) as zf:
+        return {nombre: zf.read(nombre) for nombre in zf.namelist() if nombre != 'docProps/core.xml'}
+
+
+@pytest.fixture(scope='module')
+def origen(tmp_path_factory):
+    ruta = tmp_path_factory.mktemp('bloques') / 'claves_mezcladas.xlsx'
+    df_actual, df_anterior = generate_cost_frames(40, 0.9, 1)
+    for df in (df_actual, df_anterior):
+        df[app.CLAVE_MERGE] = df[app.CLAVE_MERGE].map(mixed_key).astype(object)
+    write_cost_workbook(ruta, df_actual, df_anterior)
+    return ruta
+
+
+@pytest.mark.parametrize('vinculos', VINCULOS)
+@pytest.mark.parametrize('modo', MODOS)
+def test_chunked_output_matches_in_memory(origen, modo, vinculos, tmp_path):
+    archivo = io.BytesIO(origen.read_bytes())
+    archivo.name = origen.name
+    salida, _ = app.process_excel_data(archivo, output_mode=modo, consolidation_links=vinculos)
+    esperado = workbook_parts(salida)
+
+    for filas_bloque in FILAS_POR_BLOQUE:
+        destino = tmp_path / f'bloques_{filas_bloque}.xlsx'
+        assert app.process_excel_chunked(origen, destino, modo, vinculos, chunk_rows=filas_bloque)
+        obtenido = workbook_parts(destino)
+        assert obtenido.keys() == esperado.keys()
+        distintas = [nombre for nombre in esperado if obtenido[nombre] != esperado[nombre]]
+        assert not distintas, f'bloques de {filas_bloque} filas: partes distintas {distintas}'
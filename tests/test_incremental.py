@@ -0,0 +1,174 @@
+"""
+Reprocesamiento incremental (IncrementalState): la salida es la misma que la de una corrida completa tras
+ediciones, altas, bajas y cambios de orden de materiales, y las filas se reutilizan o se invalidan por material.
+"""
+import io
+import logging
+import pickle
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import procesamiento_costos as app
+from generar_libro import generate_cost_frames, write_cost_workbook
+
+FILAS = 60
+NUEVO_MATERIAL = 9_000_000
+
+
+def workbook_parts(libro):
+    """Contenido de cada parte del paquete, sin docProps/core.xml (lleva la fecha de creación)."""
+    with zipfile.ZipFile(libro) as zf:
+        return {nombre: zf.read(nombre) for nombre in zf.namelist() if nombre != 'docProps/core.xml'}
+
+
+def in_memory_file(ruta):
+    archivo = io.BytesIO(ruta.read_bytes())
+    archivo.name = ruta.name
+    return archivo
+
+
+def with_new_row(df, posicion, material):
+    """df con una copia de la fila posicion insertada en esa posición, con otro material."""
+    fila = df.iloc[[posicion]].assign(**{app.CLAVE_MERGE: material})
+    return pd.concat([df.iloc[:posicion], fila, df.iloc[posicion:]], ignore_index=True)
+
+
+def edit_rounds(df_actual):
+    """Versiones sucesivas de la hoja ACTUAL, como las correcciones de un mes a otro."""
+    editado = with_new_row(df_actual, 0, NUEVO_MATERIAL)
+    editado.loc[30, 'Cif'] += 17
+    bajas = with_new_row(editado.drop(index=[5, 6, 7, 40]).reset_index(drop=True), 25, NUEVO_MATERIAL + 1)
+    # Material repetido: se conservan todas sus filas
+    repetido = with_new_row(bajas, 10, bajas.loc[20, app.CLAVE_MERGE])
+    return [df_actual, editado, bajas, repetido, repetido.iloc[::-1].reset_index(drop=True), df_actual]
+
+
+@pytest.fixture(scope='module')
+def periodos():
+    return generate_cost_frames(FILAS, 0.9, 3)
+
+
+@pytest.mark.parametrize('vinculos', [app.VINCULO_COMPARTIDO, app.VINCULO_MATRIZ, app.VINCULO_CELDAS])
+@pytest.mark.parametrize('modo', [app.MODO_FORMULAS, app.MODO_FORMULAS_CACHE, app.MODO_VALORES])
+def test_incremental_output_matches_full_rewrite(periodos, modo, vinculos, tmp_path):
+    df_actual, df_anterior = periodos
+    estado = app.IncrementalState()
+    reutilizadas = []
+    for ronda, df in enumerate(edit_rounds(df_actual)):
+        ruta = tmp_path / f'ronda_{ronda}.xlsx'
+        write_cost_workbook(ruta, df, df_anterior)
+        # El estado pasa por bytes, como en la caché de la interfaz o el archivo .huellas
+        estado = app.IncrementalState.from_bytes(estado.to_bytes())
+        incremental, _ = app.process_excel_data(in_memory_file(ruta), output_mode=modo, consolidation_links=vinculos, incremental=estado)
+        completo, _ = app.process_excel_data(in_memory_file(ruta), output_mode=modo, consolidation_links=vinculos)
+        assert workbook_parts(incremental) == workbook_parts(completo), f'ronda {ronda}'
+        assert estado.resumen['reescritas'] + estado.resumen['reutilizadas'] == len(df)
+        reutilizadas.append(estado.resumen['reutilizadas'])
+
+    # Se reescriben la fila 2 (define las fórmulas del consolidado y nunca se copia), los materiales nuevos o
+    # modificados y la fila que ocupaba la fila 2 en la corrida anterior; el resto se copia aunque cambie de fila
+    rondas = edit_rounds(df_actual)
+    reescritas = [len(rondas[0]),
+                  3,  # material nuevo en la fila 2 (desplaza a la anterior) y costo editado
+                  2,  # 4 bajas y material nuevo en el medio
+                  3,  # material repetido: su primera aparición cambia y la segunda es nueva
+                  4,  # orden invertido: las apariciones del repetido se intercambian; la fila 2 anterior pasa al final
+                  7]  # vuelta al original: las 4 bajas, el costo editado y la fila 2 anterior
+    assert reutilizadas == [len(df) - n for df, n in zip(rondas, reescritas)]
+
+
+def prepared_state(materiales, huellas, estilos=None):
+    """Estado de una corrida anterior con las huellas dadas por material (sin filas escritas reales)."""
+    estado = app.IncrementalState()
+    estado.clave = 'clave'
+    estado.materiales = np.array(materiales, dtype=np.uint64)
+    estado.huellas = np.array(huellas, dtype=np.uint64)
+    estado.estilos = pickle.dumps(estilos or {})
+    estado.hojas = {app.HOJA_PROCESADA: ([], np.zeros(len(materiales), dtype=np.uint32))}
+    return estado
+
+
+def prepare(estado, materiales, huellas, clave='clave', wb=None):
+    reutilizables = estado.prepare(wb or app.new_output_workbook(), clave, np.array(huellas, dtype=np.uint64), np.array(materiales, dtype=np.uint64))
+    return reutilizables, estado._preparado['origen'].tolist()
+
+
+def test_prepare_matches_rows_by_material():
+    estado = prepared_state([1, 2, 3, 4], [10, 20, 30, 40])
+    # Material nuevo al principio: los demás se copian desde su posición anterior
+    assert prepare(estado, [9, 1, 2, 3, 4], [90, 10, 20, 30, 40]) == (3, [-1, -1, 1, 2, 3])
+    # Material modificado y material dado de baja
+    assert prepare(estado, [1, 3, 2], [10, 31, 20]) == (1, [-1, -1, 1])
+
+
+def test_prepare_never_copies_the_first_data_row():
+    # La fila 2 del consolidado define las fórmulas de la columna entera: ni se copia ni se usa como plantilla
+    estado = prepared_state([1, 2, 3], [10, 20, 30])
+    assert prepare(estado, [1, 2, 3], [10, 20, 30]) == (2, [-1, 1, 2])
+    assert prepare(estado, [2, 1, 3], [20, 10, 30]) == (1, [-1, -1, 2])
+
+
+def test_prepare_matches_repeated_materials_by_occurrence():
+    estado = prepared_state([7, 5, 5], [70, 50, 51])
+    # La segunda aparición del material 5 se compara con la segunda de la corrida anterior
+    assert prepare(estado, [7, 5, 5], [70, 51, 50]) == (0, [-1, -1, -1])
+    assert prepare(estado, [7, 8, 5, 5], [70, 80, 50, 51]) == (2, [-1, -1, 1, 2])
+
+
+def test_prepare_invalidates_state_of_another_configuration():
+    fuentes = ['fuentes de la corrida anterior']
+    estado = prepared_state([1, 2, 3], [10, 20, 30], {'_fonts': fuentes})
+    wb = app.new_output_workbook()
+    assert prepare(estado, [1, 2, 3], [10, 20, 30], clave='otra', wb=wb) == (0, [-1, -1, -1])
+    assert wb._fonts is not fuentes
+    # Con la misma configuración se restauran los estilos: los índices s="N" de las filas copiadas siguen valiendo
+    prepare(estado, [1, 2, 3], [10, 20, 30], wb=wb)
+    assert wb._fonts == fuentes
+
+
+def test_prepare_without_previous_run_rewrites_everything():
+    assert prepare(app.IncrementalState(), [1, 2, 3], [10, 20, 30]) == (0, [-1, -1, -1])
+
+
+@pytest.mark.parametrize('datos', [b'no es un estado', pickle.dumps({'version': app.VERSION_ESTADO_INCREMENTAL - 1})],
+                         ids=['ilegible', 'otra_version'])
+def test_unreadable_state_starts_empty(datos, caplog):
+    with caplog.at_level(logging.WARNING, logger=app.logger.name):
+        estado = app.IncrementalState.from_bytes(datos)
+    assert estado.clave is None and estado.hojas == {}
+    assert 'se reescriben todas las filas' in caplog.text
+
+
+def test_state_stores_compressed_rows(periodos, tmp_path):
+    ruta = tmp_path / 'libro.xlsx'
+    write_cost_workbook(ruta, *periodos)
+    estado = app.IncrementalState()
+    app.process_excel_data(in_memory_file(ruta), incremental=estado)
+    sin_comprimir = sum(int(largos.sum()) for _, largos in estado.hojas.values())
+    assert len(estado.to_bytes()) < sin_comprimir / 4
+
+
+def test_job_warns_when_state_does_not_fit_in_cache(periodos, tmp_path):
+    ruta = tmp_path / 'libro.xlsx'
+    write_cost_workbook(ruta, *periodos)
+    mensajes = []
+    with app.capture_messages(lambda nivel, texto: mensajes.append((nivel, texto))):
+        salida = app._job_process(app.PipelineProfile(), ruta.read_bytes(), ruta.name, cache=app.ResultCache(max_bytes=1024), incremental=True)
+    assert salida is not None
+    assert any(nivel == logging.WARNING and 'supera el tope de la caché' in texto for nivel, texto in mensajes)
+
+    # Con lugar en la caché, la corrida siguiente del mismo archivo reutiliza las filas sin avisar
+    cache = app.ResultCache(directorio=tmp_path / 'cache')
+    app._job_process(app.PipelineProfile(), ruta.read_bytes(), ruta.name, cache=cache, incremental=True)
+    perfil, mensajes = app.PipelineProfile(), []
+    cambiado = tmp_path / 'cambiado' / 'libro.xlsx'
+    cambiado.parent.mkdir()
+    df_actual, df_anterior = periodos
+    write_cost_workbook(cambiado, with_new_row(df_actual, 0, NUEVO_MATERIAL), df_anterior)
+    with app.capture_messages(lambda nivel, texto: mensajes.append((nivel, texto))):
+        app._job_process(perfil, cambiado.read_bytes(), cambiado.name, cache=cache, incremental=True)
+    assert not any('supera el tope' in texto for _, texto in mensajes)
+    assert next(etapa['reutilizables'] for etapa in perfil.etapas if etapa['etapa'] == 'huellas') == FILAS - 1
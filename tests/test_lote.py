@@ -0,0 +1,31 @@
+"""
+Búsqueda de los libros a procesar por lotes (procesar_lote.find_workbooks).
+"""
+import os
+
+import procesar_lote
+
+
+def touch(ruta):
+    ruta.write_bytes(b'')
+    return os.path.abspath(ruta)
+
+
+def test_folder_includes_every_input_format(tmp_path):
+    esperados = [touch(tmp_path / nombre) for nombre in ['a.xlsx', 'b.parquet', 'c.pq', 'd.feather', 'e.arrow', 'f.csv']]
+    for nombre in ['a_PROCESADO.xlsx', 'b_PROCESADO.parquet', '~$a.xlsx', 'notas.txt']:
+        touch(tmp_path / nombre)
+    assert sorted(procesar_lote.find_workbooks([str(tmp_path)])) == sorted(esperados)
+
+
+def test_previous_table_is_not_an_input(tmp_path):
+    actual = touch(tmp_path / 'actual.csv')
+    anterior = touch(tmp_path / 'anterior.csv')
+    assert procesar_lote.find_workbooks([str(tmp_path)], excluir=[anterior]) == [actual]
+
+
+def test_patterns_and_paths_are_not_repeated(tmp_path):
+    libro = touch(tmp_path / 'libro.xlsx')
+    otro = touch(tmp_path / 'otro.parquet')
+    entradas = [str(tmp_path / '*.xlsx'), libro, str(tmp_path), str(tmp_path / 'falta.xlsx')]
+    assert procesar_lote.find_workbooks(entradas) == [libro, otro, os.path.abspath(tmp_path / 'falta.xlsx')]
@@ -0,0 +1,54 @@
+"""
+Cola de trabajos en segundo plano de la interfaz (JobQueue): los trabajos se ejecutan en otros procesos y su
+estado, mensajes, resumen y resultado llegan al registro del trabajo.
+"""
+import time
+
+import pytest
+
+import procesamiento_costos as app
+from generar_libro import generate_cost_workbook
+
+
+def wait_finished(cola, job_id, limite=120):
+    fin = time.monotonic() + limite
+    while time.monotonic() < fin:
+        trabajo = cola.status(job_id)
+        if trabajo['estado'] in (app.TRABAJO_TERMINADO, app.TRABAJO_FALLIDO):
+            return trabajo
+        time.sleep(0.1)
+    raise AssertionError(f'el trabajo {job_id} no terminó en {limite} s')
+
+
+@pytest.fixture
+def cola():
+    cola = app.JobQueue(max_workers=1)
+    yield cola
+    cola.shutdown()
+
+
+def test_job_runs_in_worker_process(cola, tmp_path):
+    ruta = generate_cost_workbook(tmp_path / 'libro.xlsx', 30)
+    job_id = cola.submit(app.TAREA_PROCESAR, ruta.name, datos=ruta.read_bytes(), nombre=ruta.name)
+    trabajo = wait_finished(cola, job_id)
+    assert trabajo['estado'] == app.TRABAJO_TERMINADO
+    assert trabajo['nombre_salida'] and trabajo['resumen'] is not None
+    assert trabajo['perfil'] is not None
+    assert cola.result(job_id)[:2] == b'PK'
+    assert cola.discard(job_id) and cola.status(job_id) is None
+
+
+def test_job_with_unreadable_file_fails(cola):
+    job_id = cola.submit(app.TAREA_PROCESAR, 'roto.xlsx', datos=b'no es un libro', nombre='roto.xlsx')
+    trabajo = wait_finished(cola, job_id)
+    assert trabajo['estado'] == app.TRABAJO_FALLIDO
+    assert trabajo['mensajes'] and cola.result(job_id) is None
+
+
+def test_queued_job_can_be_cancelled(cola, tmp_path):
+    ruta = generate_cost_workbook(tmp_path / 'libro.xlsx', 30)
+    primero = cola.submit(app.TAREA_PROCESAR, ruta.name, datos=ruta.read_bytes(), nombre=ruta.name)
+    segundo = cola.submit(app.TAREA_PROCESAR, ruta.name, datos=ruta.read_bytes(), nombre=ruta.name)
+    assert cola.status(segundo)['estado'] == app.TRABAJO_EN_COLA
+    assert cola.discard(segundo) and cola.status(segundo) is None
+    assert wait_finished(cola, primero)['estado'] == app.TRABAJO_TERMINADO